@@ -7,7 +7,12 @@ import numpy as np
 from datetime import datetime
 from sklearn.externals import joblib
 from sklearn.preprocessing import StandardScaler
-from sklearn.calibration import CalibratedClassifierCV
+from metrix_ml.calibrate.calibrators import (base_probabilities,
+                                             compare_calibrators,
+                                             reliability_curve,
+                                             plot_reliability,
+                                             CalibratedModel,
+                                             METHODS)
 
 ###############################################################################
 #
@@ -40,6 +45,30 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--methods',
+    type=str,
+    nargs='+',
+    dest='methods',
+    default=list(METHODS),
+    choices=METHODS,
+    help='Calibration methods to compare')
+
+  parser.add_argument(
+    '--metric',
+    type=str,
+    dest='metric',
+    default='brier',
+    choices=['brier', 'log_loss'],
+    help='Score used to pick the best calibration method')
+
+  parser.add_argument(
+    '--bins',
+    type=int,
+    dest='bins',
+    default=10,
+    help='Number of bins for the reliability curves')
+
   args = parser.parse_args()
   if args.data == '':
     parser.print_help()
@@ -81,10 +110,15 @@ class Calibrate(object):
      * column transformation and standardising data
      * prediction using loaded model
   '''
-  def __init__(self, data, model, calibrate, bbbb):
+  def __init__(self, data, model, calibrate, bbbb, model_file=None,
+               methods=METHODS, metric='brier', bins=10):
     self.data=data
     self.calibrate=calibrate
     self.model=model   
+    self.model_file=model_file
+    self.methods=methods
+    self.metric=metric
+    self.bins=bins
     self.prepare_data()
     self.calibration()
 
@@ -139,9 +173,32 @@ class Calibrate(object):
     print('*    Calibrating pre-trained model')
     print('*' *80)
 
-    clf_cccv = CalibratedClassifierCV(self.model, cv='prefit')
-    
-    self.calibrated_clf_cccv = clf_cccv.fit(self.X_data_initial, self.y)
+    #the expensive part; every calibrator below works on this one vector
+    self.proba, cached = base_probabilities(self.model, self.X_data_initial, self.calibrate, self.model_file)
+
+    with open(os.path.join(self.calibrate, 'calibrate.txt'), 'a') as text_file:
+      text_file.write('Base model probabilities %s \n' %('read from cache' if cached else 'computed and cached'))
+
+    scores, out_of_fold, fitted = compare_calibrators(self.proba, self.y, self.methods)
+    best = scores[scores['method'] != 'uncalibrated'].sort_values(self.metric)['method'].iloc[0]
+    print(scores)
+
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    scores.to_csv(os.path.join(self.calibrate, 'calibration_scores_'+datestring+'.csv'), index=False)
+    curves = pd.concat([reliability_curve(self.y, proba, self.bins).assign(method=name)
+                        for name, proba in out_of_fold.items()])
+    curves.to_csv(os.path.join(self.calibrate, 'reliability_curves_'+datestring+'.csv'), index=False)
+    plot_reliability(self.y, out_of_fold, self.bins,
+                     os.path.join(self.calibrate, 'reliability_curves_'+datestring+'.png'))
+
+    with open(os.path.join(self.calibrate, 'calibrate.txt'), 'a') as text_file:
+      text_file.write('Brier score and log-loss of 5-fold out-of-fold calibrated probabilities: \n')
+      text_file.write(str(scores))
+      text_file.write('\n')
+      text_file.write('Best calibration method by %s: %s \n' %(self.metric, best))
+
+    self.calibration_map = fitted[best]
+    self.calibrated_clf_cccv = CalibratedModel(self.model, self.calibration_map)
 
     def write_pickle(forest, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
@@ -151,7 +208,11 @@ class Calibrate(object):
     
     write_pickle(self.calibrated_clf_cccv, self.calibrate)
 
-    cal_acc = clf_cccv.score(self.X_data_initial, self.y)
+    #the map on its own is a few numbers and can be applied to stored
+    #probabilities of the same model
+    joblib.dump(self.calibration_map, os.path.join(self.calibrate, 'calibration_map_'+best+'_'+datestring+'.pkl'))
+
+    cal_acc = np.mean((self.calibration_map.transform(self.proba) >= 0.5) == self.y)
 
     print(cal_acc)
 
@@ -174,5 +235,6 @@ def run():
 
   ###############################################################################
 
-  calibrate = Calibrate(data, model, calibrate, bbbb)
+  calibrate = Calibrate(data, model, calibrate, bbbb, args.model,
+                        args.methods, args.metric, args.bins)
 
@@ -0,0 +1,202 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Calibration on cached probabilities; the pre-trained model predicts the
+calibration set once, the result is cached on disk, and every calibrator is
+fitted and scored on that one vector instead of re-running predict_proba of
+the model for each method'''
+import hashlib
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.isotonic import IsotonicRegression
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+
+METHODS = ('sigmoid', 'isotonic', 'beta')
+EPS = 1e-12
+
+###############################################################################
+#
+#  cached base model probabilities
+#
+###############################################################################
+
+def data_fingerprint(X, model_file=None):
+  '''sha1 of the data values and, if given, of the model file name, size and
+  modification time'''
+  sha = hashlib.sha1(np.ascontiguousarray(np.asarray(X, dtype=np.float64)).tobytes())
+  if model_file is not None:
+    stat = os.stat(model_file)
+    sha.update(('%s %s %s' %(os.path.abspath(model_file), stat.st_size,
+                             stat.st_mtime)).encode())
+  return sha.hexdigest()
+
+def base_probabilities(model, X, cache_dir=None, model_file=None):
+  '''Probabilities of class 1 of the pre-trained model for the calibration
+  set, read from cache_dir if the same model and data were seen before.
+  ******
+  Input: fitted classifier, calibration data, cache directory, file the model
+         was loaded from
+  Output: 1D array of probabilities, True if read from the cache
+  '''
+  cache_file = None
+  if cache_dir is not None and model_file is not None:
+    cache_file = os.path.join(cache_dir, 'base_proba_%s.npy' %data_fingerprint(X, model_file))
+    if os.path.exists(cache_file):
+      return np.load(cache_file), True
+  proba = model.predict_proba(X)[:, 1]
+  if cache_file is not None:
+    np.save(cache_file, proba)
+  return proba, False
+
+###############################################################################
+#
+#  calibration maps
+#
+###############################################################################
+
+class CalibrationMap(object):
+  '''Monotone map from uncalibrated to calibrated probabilities of class 1;
+  holds only the fitted parameters so it can be stored on its own next to
+  the model it post-processes'''
+
+  def __init__(self, method='sigmoid'):
+    if method not in METHODS:
+      raise ValueError('unknown calibration method %s, use one of %s'
+                       %(method, ', '.join(METHODS)))
+    self.method = method
+
+  def _features(self, proba):
+    proba = np.clip(np.asarray(proba, dtype=np.float64), EPS, 1 - EPS)
+    if self.method == 'beta':
+      #beta calibration is a logistic regression on log(p) and -log(1-p)
+      return np.column_stack([np.log(proba), -np.log(1 - proba)])
+    return proba.reshape(-1, 1)
+
+  def fit(self, proba, y):
+    y = np.asarray(y)
+    if self.method == 'isotonic':
+      self.isotonic_ = IsotonicRegression(y_min=0, y_max=1, out_of_bounds='clip')
+      self.isotonic_.fit(np.asarray(proba, dtype=np.float64), y)
+      return self
+    features = self._features(proba)
+    self.columns_ = np.arange(features.shape[1])
+    logistic = LogisticRegression(C=1e10, solver='lbfgs').fit(features, y)
+    if self.method == 'beta' and np.any(logistic.coef_[0] < 0):
+      #keep the map monotone by dropping a parameter that came out negative
+      self.columns_ = np.flatnonzero(logistic.coef_[0] >= 0)[:1]
+      if len(self.columns_) == 0:
+        #both negative (a base model worse than chance); the larger one is
+        #clipped at 0, leaving the constant map to the class 1 frequency
+        self.columns_ = np.array([int(np.argmax(logistic.coef_[0]))])
+        self.coef_ = np.zeros(1)
+        rate = np.clip(np.mean(y == 1), EPS, 1 - EPS)
+        self.intercept_ = float(np.log(rate / (1 - rate)))
+        return self
+      logistic.fit(features[:, self.columns_], y)
+    self.coef_ = logistic.coef_[0]
+    self.intercept_ = logistic.intercept_[0]
+    return self
+
+  def transform(self, proba):
+    if self.method == 'isotonic':
+      return self.isotonic_.predict(np.asarray(proba, dtype=np.float64))
+    z = np.dot(self._features(proba)[:, self.columns_], self.coef_) + self.intercept_
+    return 1.0 / (1.0 + np.exp(-z))
+
+class CalibratedModel(BaseEstimator, ClassifierMixin):
+  '''A pre-trained classifier followed by a CalibrationMap; behaves like the
+  classifier for predict and predict_proba so the predict scripts can load
+  it instead of the plain model'''
+
+  def __init__(self, model, calibration):
+    self.model = model
+    self.calibration = calibration
+
+  @property
+  def classes_(self):
+    return self.model.classes_
+
+  def predict_proba(self, X):
+    ones = self.calibration.transform(self.model.predict_proba(X)[:, 1])
+    return np.column_stack([1.0 - ones, ones])
+
+  def predict(self, X):
+    return self.classes_[(self.predict_proba(X)[:, 1] >= 0.5).astype(int)]
+
+###############################################################################
+#
+#  scores and comparison
+#
+###############################################################################
+
+def brier_score(y, proba):
+  return float(np.mean((np.asarray(proba) - np.asarray(y)) ** 2))
+
+def log_loss(y, proba):
+  proba = np.clip(np.asarray(proba, dtype=np.float64), EPS, 1 - EPS)
+  y = np.asarray(y)
+  return float(-np.mean(y * np.log(proba) + (1 - y) * np.log(1 - proba)))
+
+def reliability_curve(y, proba, bins=10):
+  '''Mean predicted probability, fraction of positives and count per
+  equally wide probability bin, each from one bincount'''
+  proba = np.asarray(proba, dtype=np.float64)
+  index = np.clip((proba * bins).astype(int), 0, bins - 1)
+  count = np.bincount(index, minlength=bins)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    predicted = np.bincount(index, weights=proba, minlength=bins) / count
+    observed = np.bincount(index, weights=np.asarray(y, dtype=np.float64), minlength=bins) / count
+  return pd.DataFrame({'bin': np.arange(bins), 'mean_predicted': predicted,
+                       'fraction_positive': observed, 'count': count})
+
+def compare_calibrators(proba, y, methods=METHODS, cv=5, random_state=42):
+  '''Score every calibration method on out-of-fold calibrated probabilities
+  of the cached vector and refit each on all of it.
+  ******
+  Input: cached probabilities of class 1, labels, calibration methods, number
+         of folds, seed of the fold split
+  Output: dataframe with Brier score and log-loss per method (including the
+          uncalibrated probabilities), dict of out-of-fold probabilities per
+          method, dict of CalibrationMaps fitted on all data
+  '''
+  proba = np.asarray(proba, dtype=np.float64)
+  y = np.asarray(y)
+  folds = list(StratifiedKFold(n_splits=cv, shuffle=True,
+                               random_state=random_state).split(proba.reshape(-1, 1), y))
+  out_of_fold = {'uncalibrated': proba}
+  fitted = {}
+  for method in methods:
+    calibrated = np.empty_like(proba)
+    for train, test in folds:
+      calibrated[test] = CalibrationMap(method).fit(proba[train], y[train]).transform(proba[test])
+    out_of_fold[method] = calibrated
+    fitted[method] = CalibrationMap(method).fit(proba, y)
+
+  scores = pd.DataFrame([{'method': name, 'brier': brier_score(y, p),
+                          'log_loss': log_loss(y, p)}
+                         for name, p in out_of_fold.items()])
+  return scores, out_of_fold, fitted
+
+def plot_reliability(y, out_of_fold, bins, file_name):
+  '''Reliability diagram with one curve per method'''
+  plt.plot([0, 1], [0, 1], 'k--', label='perfectly calibrated')
+  for name, proba in out_of_fold.items():
+    curve = reliability_curve(y, proba, bins)
+    curve = curve[curve['count'] > 0]
+    plt.plot(curve['mean_predicted'], curve['fraction_positive'], marker='o', label=name)
+  plt.xlabel('Mean predicted probability')
+  plt.ylabel('Fraction of positives')
+  plt.title('Reliability curves')
+  plt.legend(loc='best')
+  plt.savefig(file_name)
+  plt.close()
@@ -7,8 +7,8 @@
 import argparse
 import os
 
-#import matplotlib
-#matplotlib.use("Agg")
+import matplotlib
+matplotlib.use("Agg")
 
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
@@ -19,6 +19,7 @@ import pandas as pd
 import seaborn as sns
 from datetime import datetime
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
 from sklearn import metrics
 from sklearn.preprocessing import StandardScaler
 
@@ -46,6 +47,28 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--sweep',
+    dest='sweep',
+    action='store_true',
+    help='Run a DBSCAN parameter sweep over all eps/min_samples combinations')
+
+  parser.add_argument(
+    '--eps',
+    type=float,
+    nargs='+',
+    dest='eps',
+    default=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6],
+    help='eps values to use in the sweep')
+
+  parser.add_argument(
+    '--min_samples',
+    type=int,
+    nargs='+',
+    dest='min_samples',
+    default=[3, 5, 10, 20],
+    help='min_samples values to use in the sweep')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -82,11 +105,18 @@ class DBscan(object):
   any strings or NaN values; also remove any columns with 
   categorical data or transform them first; remove any text except column labels'''
 
-  def __init__(self, data, dbscan_clustering):
+  def __init__(self, data, dbscan_clustering, sweep=False, eps=None, min_samples=None):
     self.data = data
     self.dbscan_clustering = dbscan_clustering
     self.prepare_metrix_data()
-    self.clustering()
+    if sweep:
+      self.eps = sorted(eps)
+      self.min_samples = sorted(min_samples)
+      self.neighbour_graph()
+      self.k_distance()
+      self.sweep()
+    else:
+      self.clustering()
    
   ###############################################################################
   #
@@ -182,13 +212,94 @@ class DBscan(object):
 
     plt.title('Estimated number of clusters: %d' % n_clusters_)
     plt.savefig(os.path.join(self.dbscan_clustering, 'alldata_clusters_'+datestring+'.png'))
-    plt.show()
+    plt.close()
 
-    
-#        plt.savefig(os.path.join(self.k_means_clustering, 'Silhouette_autosharp_clusters_'+str(n_clusters)+'_'+datestring+'.png'))
-#        plt.close()
-    #plt.show()
-        
+################################################################################
+#
+#  parameter sweep; the radius-neighbours graph is built once at the largest
+#  eps and every eps/min_samples combination is clustered from that graph
+#
+################################################################################
+
+  def neighbour_graph(self):
+    '''Build the sparse radius-neighbours graph at the largest eps; DBSCAN
+    with metric='precomputed' ignores all stored distances above its own eps,
+    so the same graph serves every smaller eps in the sweep'''
+    print('*' *80)
+    print('*    Building radius-neighbours graph for eps=%s' %self.eps[-1])
+    print('*' *80)
+
+    nn = NearestNeighbors(radius=self.eps[-1]).fit(self.X_data_scaled)
+    self.graph = nn.radius_neighbors_graph(self.X_data_scaled, mode='distance')
+
+    with open(os.path.join(self.dbscan_clustering, 'dbscan_clustering.txt'), 'a') as text_file:
+      text_file.write('Radius-neighbours graph at eps=%s with %s stored distances \n'
+                       %(self.eps[-1], self.graph.nnz))
+
+  def k_distance(self):
+    '''Plot the sorted distance to the k-th nearest neighbour for every
+    min_samples in the sweep; the knee of each curve is a good eps for
+    that min_samples'''
+    print('*' *80)
+    print('*    Calculating k-distance curves')
+    print('*' *80)
+
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+
+    #one kneighbors query at the largest k; smaller k are columns of the same result
+    k_max = self.min_samples[-1]
+    nn = NearestNeighbors(n_neighbors=k_max).fit(self.X_data_scaled)
+    distances, _ = nn.kneighbors(self.X_data_scaled)
+
+    #the query point itself is its own first neighbour, matching how DBSCAN
+    #counts min_samples
+    k_dist = pd.DataFrame({'k='+str(k): np.sort(distances[:, k - 1])[::-1]
+                           for k in self.min_samples})
+    k_dist.to_csv(os.path.join(self.dbscan_clustering, 'k_distance_'+datestring+'.csv'),
+                  index_label='rank')
+
+    for column in k_dist.columns:
+      plt.plot(np.arange(len(k_dist)), k_dist[column], label=column)
+    for e in self.eps:
+      plt.axhline(e, color='k', linestyle=':', linewidth=0.5)
+    plt.xlabel('Samples sorted by k-distance')
+    plt.ylabel('Distance to k-th nearest neighbour')
+    plt.title('k-distance curves')
+    plt.legend(loc='upper right')
+    plt.savefig(os.path.join(self.dbscan_clustering, 'k_distance_'+datestring+'.png'))
+    plt.close()
+
+  def sweep(self):
+    '''Cluster the samples for every eps/min_samples combination using the
+    cached neighbour graph and write all labels into one table'''
+    print('*' *80)
+    print('*    Sweeping eps=%s and min_samples=%s' %(self.eps, self.min_samples))
+    print('*' *80)
+
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+
+    labels = {}
+    summary = []
+    for e in self.eps:
+      for m in self.min_samples:
+        db = DBSCAN(eps=e, min_samples=m, metric='precomputed').fit(self.graph)
+        name = 'eps=%s_min_samples=%s' %(e, m)
+        labels[name] = db.labels_.astype(np.int32)
+        n_clusters_ = len(set(db.labels_)) - (1 if -1 in db.labels_ else 0)
+        n_noise_ = int(np.sum(db.labels_ == -1))
+        summary.append({'eps': e, 'min_samples': m, 'n_clusters': n_clusters_,
+                        'n_noise': n_noise_})
+
+    labels = pd.DataFrame(labels, index=self.X_data.index)
+    labels.to_csv(os.path.join(self.dbscan_clustering, 'sweep_labels_'+datestring+'.csv'))
+
+    summary = pd.DataFrame(summary)
+    summary.to_csv(os.path.join(self.dbscan_clustering, 'sweep_summary_'+datestring+'.csv'),
+                   index=False)
+
+    with open(os.path.join(self.dbscan_clustering, 'dbscan_clustering.txt'), 'a') as text_file:
+      text_file.write('DBSCAN sweep over eps=%s and min_samples=%s \n' %(self.eps, self.min_samples))
+      text_file.write(summary.to_string(index=False)+'\n')
 
 def run():
   args = parse_command_line()
@@ -203,5 +314,5 @@ def run():
 
   ###############################################################################
 
-  dbscan_clustering = DBscan(data, dbscan_clustering)
+  dbscan_clustering = DBscan(data, dbscan_clustering, args.sweep, args.eps, args.min_samples)
 
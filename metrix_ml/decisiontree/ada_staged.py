@@ -0,0 +1,156 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Randomised search for AdaBoost with the number of estimators taken from
+the boosting stages instead of sampled. Every candidate of the other
+parameters is fitted once per fold and its staged predictions score every
+prefix length of the ensemble in one pass over the validation fold; scoring
+stops once the score has not improved for `patience` stages'''
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn import metrics
+from sklearn.base import BaseEstimator, clone
+from sklearn.model_selection import ParameterSampler, check_cv
+
+SCORINGS = ('accuracy', 'roc_auc')
+
+###############################################################################
+#
+#  scoring the boosting stages of one fold
+#
+###############################################################################
+
+def staged_scores(model, X, y, scoring='accuracy', patience=500, min_estimators=1):
+  '''Validation score after every boosting stage.
+  ******
+  Input: fitted AdaBoostClassifier, validation data, labels, one of SCORINGS,
+         stages without improvement before stopping, stages always scored
+  Output: array of scores, one per stage scored; True if scoring stopped
+          because the score no longer improved
+  '''
+  scores = []
+  best = -np.inf
+  since_best = 0
+  for proba in model.staged_predict_proba(X):
+    if scoring == 'accuracy':
+      score = np.mean(model.classes_[np.argmax(proba, axis=1)] == y)
+    else:
+      score = metrics.roc_auc_score(y, proba[:, 1])
+    scores.append(score)
+    if score > best:
+      best, since_best = score, 0
+    else:
+      since_best += 1
+    if len(scores) >= min_estimators and since_best >= patience:
+      return np.asarray(scores), True
+  return np.asarray(scores), False
+
+def staged_fold(estimator, params, X, y, train, test, min_estimators,
+                max_estimators, scoring, patience):
+  '''Stage scores of one candidate on one fold; top level function so it can
+  run in a worker process. The ensemble is grown by refitting with twice the
+  estimators until the score stops improving, boosting ends by itself or
+  max_estimators is reached; with fixed random states the first stages of a
+  refit are the stages of the smaller ensemble.
+  ******
+  Input: unfitted AdaBoostClassifier, candidate parameters, data, labels,
+         train and validation indices, smallest and largest ensemble,
+         one of SCORINGS, stages without improvement before stopping
+  Output: array of scores, one per stage scored
+  '''
+  n_estimators = min(max(min_estimators, 2 * patience), max_estimators)
+  while True:
+    model = clone(estimator).set_params(**params)
+    model.set_params(n_estimators=n_estimators)
+    model.fit(X[train], y[train])
+    scores, stopped = staged_scores(model, X[test], y[test], scoring, patience,
+                                    min_estimators)
+    if stopped or len(scores) < n_estimators or n_estimators == max_estimators:
+      return scores
+    n_estimators = min(2 * n_estimators, max_estimators)
+
+def estimator_range(distribution, default):
+  '''Smallest and largest n_estimators of a search space entry'''
+  if distribution is None:
+    return 1, default
+  if hasattr(distribution, 'support'):
+    low, high = distribution.support()
+    return int(low), int(high)
+  return int(min(distribution)), int(max(distribution))
+
+###############################################################################
+#
+#  staged randomised search
+#
+###############################################################################
+
+class StagedAdaBoostSearch(BaseEstimator):
+  '''Drop-in for RandomizedSearchCV over an AdaBoostClassifier; fit sets
+  best_params_ (including n_estimators), best_score_, best_index_,
+  cv_results_ and, with refit, best_estimator_. The n_estimators entry of
+  param_distributions only gives the range of ensemble sizes scored; folds
+  that stopped early are held at their last score when the folds are
+  averaged, as they showed no improvement for `patience` stages'''
+
+  def __init__(self, estimator, param_distributions, n_iter=10, cv=3,
+               scoring='accuracy', patience=500, refit=True, random_state=None,
+               n_jobs=None):
+    self.estimator = estimator
+    self.param_distributions = param_distributions
+    self.n_iter = n_iter
+    self.cv = cv
+    self.scoring = scoring
+    self.patience = patience
+    self.refit = refit
+    self.random_state = random_state
+    self.n_jobs = n_jobs
+
+  def fit(self, X, y):
+    if self.scoring not in SCORINGS:
+      raise ValueError('unknown scoring %s, use one of %s'
+                       %(self.scoring, ', '.join(SCORINGS)))
+    space = dict(self.param_distributions)
+    min_estimators, max_estimators = estimator_range(space.pop('n_estimators', None),
+                                                     self.estimator.n_estimators)
+    candidates = list(ParameterSampler(space, self.n_iter, random_state=self.random_state))
+    cv = check_cv(self.cv, y, classifier=True)
+    folds = list(cv.split(X, y))
+    X_array = np.asarray(X)
+    y_array = np.asarray(y)
+
+    curves = Parallel(n_jobs=self.n_jobs)(
+      delayed(staged_fold)(self.estimator, params, X_array, y_array, train, test,
+                           min_estimators, max_estimators, self.scoring, self.patience)
+      for params in candidates for train, test in folds)
+
+    results = {'params': [], 'mean_test_score': [], 'std_test_score': [],
+               'n_estimators_scored': []}
+    for k, params in enumerate(candidates):
+      fold_curves = curves[k * len(folds):(k + 1) * len(folds)]
+      length = max(len(curve) for curve in fold_curves)
+      stages = np.stack([np.pad(curve, (0, length - len(curve)), mode='edge')
+                         for curve in fold_curves])
+      mean = stages.mean(axis=0)
+      first = min(min_estimators, length) - 1
+      best = first + int(np.argmax(mean[first:]))
+      results['params'].append(dict(params, n_estimators=best + 1))
+      results['mean_test_score'].append(float(mean[best]))
+      results['std_test_score'].append(float(stages[:, best].std()))
+      results['n_estimators_scored'].append(length)
+
+    mean_scores = np.asarray(results['mean_test_score'])
+    results['rank_test_score'] = [int(rank) + 1 for rank in np.argsort(np.argsort(-mean_scores, kind='stable'))]
+    for name in results['params'][0]:
+      results['param_' + name] = [params[name] for params in results['params']]
+    self.cv_results_ = results
+    self.n_splits_ = len(folds)
+    self.best_index_ = int(np.argmax(mean_scores))
+    self.best_params_ = results['params'][self.best_index_]
+    self.best_score_ = results['mean_test_score'][self.best_index_]
+
+    if self.refit:
+      self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+      self.best_estimator_.fit(X, y)
+    return self
@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 
 import matplotlib
@@ -18,10 +17,8 @@ import seaborn as sns
 import scikitplot as skplt
 #import random
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import cross_val_predict
@@ -29,10 +26,22 @@ from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import randint
 from scipy.stats import uniform
 from sklearn.ensemble import AdaBoostClassifier
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.decisiontree.ada_staged import StagedAdaBoostSearch
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.importance import tree_importances
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -58,6 +67,65 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--staged',
+    dest='staged',
+    action='store_true',
+    help='Take n_estimators from the boosting stages of one fit per candidate instead of sampling it')
+
+  parser.add_argument(
+    '--patience',
+    type=int,
+    dest='patience',
+    default=500,
+    help='Boosting stages without improvement before a staged candidate stops')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -71,8 +139,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
   
 def make_output_folder(outdir):
   output_dir = os.path.join(outdir, 'decisiontree_ada_randomsearch')
@@ -94,7 +162,9 @@ class DecisionTreeAdaRandSearch(object):
      * predict on this new random forest with test data and cross-validated training data
      * analyse the predisctions with graphs and stats
   '''
-  def __init__(self, metrix, output_dir):
+  def __init__(self, metrix, output_dir, staged=False, patience=500):
+    self.staged = staged
+    self.patience = patience
     self.metrix = metrix
     self.output_dir = output_dir
     self.prepare_metrix_data()
@@ -110,6 +180,7 @@ class DecisionTreeAdaRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframe with columns of interest.
     ******
@@ -143,6 +214,7 @@ class DecisionTreeAdaRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -158,7 +230,7 @@ class DecisionTreeAdaRandSearch(object):
     y = self.metrix['MR_success']
 
 #stratified split of samples
-    X_metrix_train, X_metrix_test, y_train, y_test = train_test_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
+    X_metrix_train, X_metrix_test, y_train, y_test = registry_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_metrix.columns.all() == X_metrix_train.columns.all()
 
@@ -179,6 +251,7 @@ class DecisionTreeAdaRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def rand_search(self):
     '''running a randomized search to find the parameter combination for a
     decision tree with AdaBoost which gives the best accuracy score'''
@@ -223,7 +296,16 @@ class DecisionTreeAdaRandSearch(object):
                                      scoring='accuracy',
                                      n_jobs=-1)
 
-    rand_search_fitted = rand_search.fit(self.X_metrix_train, self.y_train)
+    if self.staged:
+      #one fit per candidate and fold; every n_estimators up to the sampled
+      #range is scored from the staged predictions of that fit
+      rand_search = StagedAdaBoostSearch(tree_clf_rand_ada, param_rand, random_state=5,
+                                         cv=3, n_iter=500, scoring='accuracy',
+                                         patience=self.patience, refit=False, n_jobs=-1)
+      with open(os.path.join(self.output_dir, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
+        text_file.write('Staged search, n_estimators from boosting stages with patience %s \n' %self.patience)
+
+    rand_search_fitted = run_search(rand_search, self.X_metrix_train, self.y_train, 'decisiontree_ada_randomsearch_MR')
     with open(os.path.join(self.output_dir,
               'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_fitted.best_params_)+'\n')
@@ -264,6 +346,7 @@ class DecisionTreeAdaRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def forest_best_params(self):
     '''create a new decision tree with AdaBoost using the best parameter
        combination found above'''
@@ -319,16 +402,13 @@ class DecisionTreeAdaRandSearch(object):
 #    feature_importances_best_estimator(feature_importances_transform_ls, 'newdata_minusEP', self.newdata_minusEP)
     
 
+    @stage
     def feature_importances_pandas(clf, X_train, directory):   
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
-      feature_list = []
-      for tree in clf.estimators_:
-        feature_importances_ls = tree.feature_importances_
-        feature_list.append(feature_importances_ls)
-        
-      df = pd.DataFrame(feature_list, columns=X_train.columns)
-      df_mean = df[X_train.columns].mean(axis=0)
-      df_std = df[X_train.columns].std(axis=0)
+      #importances of all trees stacked into one array
+      importances = tree_importances(clf, X_train.columns)
+      df_mean = importances['mean']
+      df_std = importances['std']
       df_mean.plot(kind='bar', color='b', yerr=[df_std], align="center",
                    figsize=(20,10), rot=90)
       plt.title('Histogram of Feature Importances DecisionTree AdaBoostClassifier')
@@ -342,10 +422,11 @@ class DecisionTreeAdaRandSearch(object):
                                self.X_metrix_train,
                                self.output_dir)
 
+    @stage
     def write_pickle(clf, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(clf, os.path.join(directory,
-                                 'best_forest_rand_ada_new_'+datestring+'.pkl'))
+      registry_dump(clf, os.path.join(directory,
+                                  'best_forest_rand_ada_new_'+datestring+'.pkl'))
       with open(os.path.join(directory,
                 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new decision tree with AdaBoost "tree_clf_rand_ada_new" using best parameters \n')
@@ -354,6 +435,7 @@ class DecisionTreeAdaRandSearch(object):
     write_pickle(self.tree_clf_rand_ada_new,
                  self.output_dir)
 
+    @stage
     def visualise_tree(tree_forest, directory, columns):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       trees = tree_forest.estimators_
@@ -390,6 +472,7 @@ class DecisionTreeAdaRandSearch(object):
     print('*    Getting basic stats for new decision tree with AdaBoost')
     print('*' *80)
 
+    @stage
     def basic_stats(tree, X_train, directory):
       #distribution --> accuracy
       accuracy_each_cv = cross_val_score(tree,
@@ -450,6 +533,7 @@ class DecisionTreeAdaRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best tree with AdaBoost an the test set as well as
     training set with 3 cross-validation folds and doing some initial analysis
@@ -460,6 +544,7 @@ class DecisionTreeAdaRandSearch(object):
 
     #try out how well the classifier works to predict from the test set
     self.y_pred = self.tree_clf_rand_ada_new.predict(self.X_metrix_test)
+    registry_test_score(self.tree_clf_rand_ada_new, self.y_test, self.y_pred)
     self.y_pred_proba = self.tree_clf_rand_ada_new.predict_proba(self.X_metrix_test)
     with open(os.path.join(self.output_dir,
               'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
@@ -482,6 +567,7 @@ class DecisionTreeAdaRandSearch(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -518,6 +604,7 @@ class DecisionTreeAdaRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -540,6 +627,7 @@ class DecisionTreeAdaRandSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -659,6 +747,9 @@ class DecisionTreeAdaRandSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '3-fold CV': conf_mat_3CV},
+                                directory, 'decisiontree_ada_randomsearch.txt')
         
     conf_mat(self.y_test,
              self.y_train,
@@ -666,6 +757,7 @@ class DecisionTreeAdaRandSearch(object):
              self.y_train_CV_pred,
              self.output_dir)
 
+    @stage
     def prediction_probas(tree, X_train, y_train, X_test, y_test,
                                 y_pred_proba, y_train_CV_pred_proba, directory): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
@@ -800,8 +892,11 @@ class DecisionTreeAdaRandSearch(object):
                       self.y_train_CV_pred_proba,
                       self.output_dir)    
 
+    bootstrap_report(self.y_test, self.y_pred, self.y_pred_proba[:, 1], self.output_dir, 'decisiontree_ada_randomsearch.txt')
+
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
 ###############################################################################
@@ -810,8 +905,17 @@ def run():
   metrix = load_metrix_data(args.input)
 
   output_dir = make_output_folder(args.outdir)
+  open_profiler(output_dir, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(output_dir, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
 ###############################################################################
 
-  decision_tree_ada_rand_search = DecisionTreeAdaRandSearch(metrix, output_dir)
-
+  try:
+    decision_tree_ada_rand_search = DecisionTreeAdaRandSearch(metrix, output_dir,
+                                                              args.staged, args.patience)
+  finally:
+    close_fit_ledger(output_dir, 'decisiontree_ada_randomsearch_MR')
+    close_profiler()
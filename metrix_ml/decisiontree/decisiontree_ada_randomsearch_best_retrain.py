@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 import matplotlib.pyplot as plt
 import numpy as np
@@ -14,7 +13,6 @@ import seaborn as sns
 import scikitplot as skplt
 #import random
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.metrics import mean_squared_error
 from sklearn.externals import joblib
@@ -29,6 +27,13 @@ from sklearn.externals import joblib
 from scipy.stats import randint
 from scipy.stats import uniform
 from sklearn.ensemble import AdaBoostClassifier
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.importance import tree_importances, tree_importance_matrix
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
 
 ###############################################################################
 #
@@ -54,6 +59,25 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -67,8 +91,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
   
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -110,6 +134,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -127,7 +152,7 @@ class RandomForestAdaRandSearch(object):
     y = self.metrix['EP_success']
     
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
+    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
     
     #assert self.X_metrix.all() == X_newdata_transform_train.columns.all()
 
@@ -148,6 +173,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def forest_best_params(self):
     '''create a new random forest using the best parameter combination found above'''
     print('*' *80)
@@ -179,10 +205,11 @@ class RandomForestAdaRandSearch(object):
     feature_importances_transform = self.tree_clf_rand_ada_new_transform.feature_importances_
     feature_importances_transform_ls = sorted(zip(feature_importances_transform, attr), reverse=True)
     #print(feature_importances_transform_ls)
-    feature_importances_ls = np.mean([tree.feature_importances_ for tree in self.tree_clf_rand_ada_new_transform.estimators_], axis=0)
+    feature_importances_ls = tree_importance_matrix(self.tree_clf_rand_ada_new_transform).mean(axis=0)
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
       text_file.write('Feature importances: %s \n' %feature_importances_transform_ls)
 
+    @stage
     def feature_importances_best_estimator(feature_list, name, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       feature_list.sort(key=lambda x: x[1], reverse=True)
@@ -200,16 +227,13 @@ class RandomForestAdaRandSearch(object):
     feature_importances_best_estimator(feature_importances_transform_ls, 'newdata_minusEP', self.newdata_minusEP)
     
 
+    @stage
     def feature_importances_pandas(clf, X_train, name, directory):   
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
-      feature_list = []
-      for tree in clf.estimators_:
-        feature_importances_ls = tree.feature_importances_
-        feature_list.append(feature_importances_ls)
-        
-      df = pd.DataFrame(feature_list, columns=X_train.columns)
-      df_mean = df[X_train.columns].mean(axis=0)
-      df_std = df[X_train.columns].std(axis=0)
+      #importances of all trees stacked into one array
+      importances = tree_importances(clf, X_train.columns)
+      df_mean = importances['mean']
+      df_std = importances['std']
       df_mean.plot(kind='bar', color='b', yerr=[df_std], align="center", figsize=(20,10), rot=90)
       plt.title('Histogram of Feature Importances over all trees in AdaBoostClassifier using features %s ' %name)
       plt.xlabel('Features')
@@ -219,6 +243,7 @@ class RandomForestAdaRandSearch(object):
       
     feature_importances_pandas(self.tree_clf_rand_ada_new_transform, self.X_newdata_transform_train, 'newdata_minusEP', self.newdata_minusEP)
 
+    @stage
     def write_pickle(forest, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       joblib.dump(forest, os.path.join(directory,'best_forest_rand_ada_'+name+datestring+'.pkl'))
@@ -228,6 +253,7 @@ class RandomForestAdaRandSearch(object):
     
     write_pickle(self.tree_clf_rand_ada_new_transform, self.newdata_minusEP, 'newdata_minusEP')
 
+    @stage
     def visualise_tree(tree_forest, directory, columns, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       trees = tree_forest.estimators_
@@ -254,6 +280,7 @@ class RandomForestAdaRandSearch(object):
     print('*    Getting basic stats for new forest')
     print('*' *80)
 
+    @stage
     def basic_stats(forest, X_train, directory):
       #distribution --> accuracy
       accuracy_each_cv = cross_val_score(forest, X_train, self.y_train, cv=3, scoring='accuracy')
@@ -283,6 +310,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best random forest an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -312,6 +340,7 @@ class RandomForestAdaRandSearch(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -345,6 +374,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -367,6 +397,7 @@ class RandomForestAdaRandSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -477,9 +508,13 @@ class RandomForestAdaRandSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'decisiontree_ada_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
 
+    @stage
     def prediction_probas(tree, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
@@ -577,6 +612,8 @@ class RandomForestAdaRandSearch(object):
         text_file.write('AUC for CV train set class 1: %s \n' %AUC_train_class1)
 
     prediction_probas(self.tree_clf_rand_ada_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
+
+    bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'decisiontree_ada_randomsearch.txt')
     
 def run():
   args = parse_command_line()
@@ -588,8 +625,14 @@ def run():
   metrix = load_metrix_data(args.input)
 
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_fit_ledger()
 
   ###############################################################################
 
-  random_forest_ada_rand_search = RandomForestAdaRandSearch(metrix, newdata_minusEP, bbbb)
-
+  try:
+    random_forest_ada_rand_search = RandomForestAdaRandSearch(metrix, newdata_minusEP, bbbb)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'decisiontree_ada_randomsearch_best_retrain')
+    close_profiler()
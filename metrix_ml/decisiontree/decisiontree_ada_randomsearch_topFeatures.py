@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 
 import matplotlib
@@ -18,10 +17,8 @@ import seaborn as sns
 import scikitplot as skplt
 #import random
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import cross_val_predict
@@ -29,10 +26,22 @@ from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import randint
 from scipy.stats import uniform
 from sklearn.ensemble import AdaBoostClassifier
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.decisiontree.ada_staged import StagedAdaBoostSearch
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.importance import tree_importances, tree_importance_matrix
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -58,6 +67,65 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--staged',
+    dest='staged',
+    action='store_true',
+    help='Take n_estimators from the boosting stages of one fit per candidate instead of sampling it')
+
+  parser.add_argument(
+    '--patience',
+    type=int,
+    dest='patience',
+    default=500,
+    help='Boosting stages without improvement before a staged candidate stops')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -71,8 +139,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
   
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -98,7 +166,9 @@ class RandomForestAdaRandSearch(object):
      * predict on this new random forest with test data and cross-validated training data
      * analyse the predisctions with graphs and stats
   '''
-  def __init__(self, metrix, newdata_minusEP, bbbb):
+  def __init__(self, metrix, newdata_minusEP, bbbb, staged=False, patience=500):
+    self.staged = staged
+    self.patience = patience
     self.metrix=metrix
     self.newdata_minusEP=newdata_minusEP
     self.prepare_metrix_data()
@@ -117,6 +187,7 @@ class RandomForestAdaRandSearch(object):
   #
   ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframes for directly after dataprocessing, after
        adding some protein information and after carrying out some custom solumn
@@ -161,6 +232,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -179,7 +251,7 @@ class RandomForestAdaRandSearch(object):
 #    X_transform_train, X_transform_test, y_train, y_test = train_test_split(self.X_transform, y, test_size=0.2, random_state=42)
 
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
+    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_newdata_transform.columns.all() == X_newdata_transform_train.columns.all()
 
@@ -199,6 +271,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def rand_search(self):
     '''running a randomized search to find the parameter combination for a random forest
      which gives the best accuracy score'''
@@ -238,7 +311,16 @@ class RandomForestAdaRandSearch(object):
     rand_search = RandomizedSearchCV(tree_clf_rand_ada, param_rand, random_state=5,
                               cv=3, n_iter=500, scoring='accuracy', n_jobs=-1)
 
-    rand_search_transform = rand_search.fit(self.X_newdata_transform_train, self.y_train)
+    if self.staged:
+      #one fit per candidate and fold; every n_estimators up to the sampled
+      #range is scored from the staged predictions of that fit
+      rand_search = StagedAdaBoostSearch(tree_clf_rand_ada, param_rand, random_state=5,
+                                         cv=3, n_iter=500, scoring='accuracy',
+                                         patience=self.patience, refit=False, n_jobs=-1)
+      with open(os.path.join(self.newdata_minusEP, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
+        text_file.write('Staged search, n_estimators from boosting stages with patience %s \n' %self.patience)
+
+    rand_search_transform = run_search(rand_search, self.X_newdata_transform_train, self.y_train, 'decisiontree_ada_randomsearch_topFeatures')
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_transform.best_params_)+'\n')
       text_file.write('Best score: ' +str(rand_search_transform.best_score_)+'\n')
@@ -278,6 +360,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def forest_best_params(self):
     '''create a new random forest using the best parameter combination found above'''
     print('*' *80)
@@ -299,10 +382,11 @@ class RandomForestAdaRandSearch(object):
     feature_importances_transform = self.tree_clf_rand_ada_new_transform.feature_importances_
     feature_importances_transform_ls = sorted(zip(feature_importances_transform, attr_newdata_transform), reverse=True)
     #print(feature_importances_transform_ls)
-    feature_importances_ls = np.mean([tree.feature_importances_ for tree in self.tree_clf_rand_ada_new_transform.estimators_], axis=0)
+    feature_importances_ls = tree_importance_matrix(self.tree_clf_rand_ada_new_transform).mean(axis=0)
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
       text_file.write('Feature importances: %s \n' %feature_importances_transform_ls)
 
+    @stage
     def feature_importances_best_estimator(feature_list, name, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       feature_list.sort(key=lambda x: x[1], reverse=True)
@@ -320,16 +404,13 @@ class RandomForestAdaRandSearch(object):
     feature_importances_best_estimator(feature_importances_transform_ls, 'newdata_minusEP', self.newdata_minusEP)
     
 
+    @stage
     def feature_importances_pandas(clf, X_train, name, directory):   
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
-      feature_list = []
-      for tree in clf.estimators_:
-        feature_importances_ls = tree.feature_importances_
-        feature_list.append(feature_importances_ls)
-        
-      df = pd.DataFrame(feature_list, columns=X_train.columns)
-      df_mean = df[X_train.columns].mean(axis=0)
-      df_std = df[X_train.columns].std(axis=0)
+      #importances of all trees stacked into one array
+      importances = tree_importances(clf, X_train.columns)
+      df_mean = importances['mean']
+      df_std = importances['std']
       df_mean.plot(kind='bar', color='b', yerr=[df_std], align="center", figsize=(20,10), rot=90)
       plt.title('Histogram of Feature Importances over all trees in AdaBoostClassifier using features %s ' %name)
       plt.xlabel('Features')
@@ -339,15 +420,17 @@ class RandomForestAdaRandSearch(object):
       
     feature_importances_pandas(self.tree_clf_rand_ada_new_transform, self.X_newdata_transform_train, 'newdata_minusEP', self.newdata_minusEP)
 
+    @stage
     def write_pickle(forest, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(forest, os.path.join(directory,'best_forest_rand_ada_'+name+datestring+'.pkl'))
+      registry_dump(forest, os.path.join(directory,'best_forest_rand_ada_'+name+datestring+'.pkl'))
       with open(os.path.join(directory, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new random forest "forest_clf_rand_ada_new_%s" using best parameters \n' %name)
         text_file.write('Creating pickle file for best forest as best_forest_rand_ada_%s.pkl \n' %name)
     
     write_pickle(self.tree_clf_rand_ada_new_transform, self.newdata_minusEP, 'newdata_minusEP')
 
+    @stage
     def visualise_tree(tree_forest, directory, columns, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       trees = tree_forest.estimators_
@@ -374,6 +457,7 @@ class RandomForestAdaRandSearch(object):
     print('*    Getting basic stats for new forest')
     print('*' *80)
 
+    @stage
     def basic_stats(forest, X_train, directory):
       #distribution --> accuracy
       accuracy_each_cv = cross_val_score(forest, X_train, self.y_train, cv=3, scoring='accuracy')
@@ -403,6 +487,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best random forest an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -413,6 +498,7 @@ class RandomForestAdaRandSearch(object):
     #try out how well the classifier works to predict from the test set
     #self.y_pred_transform = self.tree_clf_rand_ada_new_transform.predict(self.X_newdata_transform_test)
     self.y_pred_transform = self.tree_clf_rand_ada_new_transform.predict(self.X_newdata_transform_test)
+    registry_test_score(self.tree_clf_rand_ada_new_transform, self.y_test, self.y_pred_transform)
     self.y_pred_proba_transform = self.tree_clf_rand_ada_new_transform.predict_proba(self.X_newdata_transform_test)
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_test in y_pred_transform and probabilities y_pred_proba_transform\n')
@@ -427,6 +513,7 @@ class RandomForestAdaRandSearch(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -460,6 +547,7 @@ class RandomForestAdaRandSearch(object):
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -482,6 +570,7 @@ class RandomForestAdaRandSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -592,9 +681,13 @@ class RandomForestAdaRandSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'decisiontree_ada_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
 
+    @stage
     def prediction_probas(tree, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'decisiontree_ada_randomsearch.txt'), 'a') as text_file:
@@ -714,8 +807,11 @@ class RandomForestAdaRandSearch(object):
 
     prediction_probas(self.tree_clf_rand_ada_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
 
+    bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'decisiontree_ada_randomsearch.txt')
+
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
   ###############################################################################
@@ -724,8 +820,17 @@ def run():
   metrix = load_metrix_data(args.input)
 
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(newdata_minusEP, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
   ###############################################################################
 
-  random_forest_ada_rand_search = RandomForestAdaRandSearch(metrix, newdata_minusEP, bbbb)
-
+  try:
+    random_forest_ada_rand_search = RandomForestAdaRandSearch(metrix, newdata_minusEP, bbbb,
+                                                              args.staged, args.patience)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'decisiontree_ada_randomsearch_topFeatures')
+    close_profiler()
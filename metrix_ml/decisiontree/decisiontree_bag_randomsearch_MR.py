@@ -5,22 +5,18 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 
 import matplotlib
 matplotlib.use("Agg")
 
 import matplotlib.pyplot as plt
-import numpy as np
 import subprocess
 import seaborn as sns
 import scikitplot as skplt
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import cross_val_predict
@@ -28,9 +24,20 @@ from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import randint
 from sklearn.ensemble import BaggingClassifier
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.importance import tree_importances, tree_importance_matrix
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -56,6 +63,52 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -69,8 +122,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
   
 def make_output_folder(outdir):
   output_dir = os.path.join(outdir,'decisiontree_bag_randomsearch')
@@ -109,6 +162,7 @@ class DecisionTreeBagRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframe with columns of interest.
     ******
@@ -143,6 +197,7 @@ class DecisionTreeBagRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -158,7 +213,7 @@ class DecisionTreeBagRandSearch(object):
     y = self.metrix['MR_success']
 
 #stratified split of samples
-    X_metrix_train, X_metrix_test, y_train, y_test = train_test_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
+    X_metrix_train, X_metrix_test, y_train, y_test = registry_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_metrix.columns.all() == X_metrix_train.columns.all()
 
@@ -179,6 +234,7 @@ class DecisionTreeBagRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def rand_search(self):
     '''running a randomized search to find the parameter combination for a
     decision tree with bagging which gives the best accuracy score'''
@@ -223,7 +279,7 @@ class DecisionTreeBagRandSearch(object):
                                      scoring='accuracy',
                                      n_jobs=-1)
 
-    rand_search_fitted = rand_search.fit(self.X_metrix_train, self.y_train)
+    rand_search_fitted = run_search(rand_search, self.X_metrix_train, self.y_train, 'decisiontree_bag_randomsearch_MR')
     with open(os.path.join(self.output_dir,
               'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_fitted.best_params_)+'\n')
@@ -261,6 +317,7 @@ class DecisionTreeBagRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def tree_best_params(self):
     '''create a new decision tree using the best parameter combination found above'''
     print('*' *80)
@@ -286,7 +343,8 @@ class DecisionTreeBagRandSearch(object):
 #       'anomalousmulti', 'RmergediffI', 'totalobservations', 'anomalouscompl',
 #       'cchalf', 'totalunique']
 
-    feature_importances = np.mean([tree.feature_importances_ for tree in self.tree_clf_rand_bag_new.estimators_], axis=0)
+    feature_importances = tree_importance_matrix(self.tree_clf_rand_bag_new,
+                                                 self.X_metrix.shape[1]).mean(axis=0)
     feature_importances_ls = sorted(zip(feature_importances, 
                                         self.X_metrix.columns), reverse=True)
     with open(os.path.join(self.output_dir,
@@ -294,16 +352,13 @@ class DecisionTreeBagRandSearch(object):
       text_file.write('Feature importances: %s \n' %feature_importances_ls)
     
     
+    @stage
     def feature_importances_pandas(clf, X_train, directory):   
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
-      feature_list = []
-      for tree in clf.estimators_:
-        feature_importances_ls = tree.feature_importances_
-        feature_list.append(feature_importances_ls)
-        
-      df = pd.DataFrame(feature_list, columns=X_train.columns)
-      df_mean = df[X_train.columns].mean(axis=0)
-      df_std = df[X_train.columns].std(axis=0)
+      #importances of all trees stacked into one array
+      importances = tree_importances(clf, X_train.columns)
+      df_mean = importances['mean']
+      df_std = importances['std']
       df_mean.plot(kind='bar', color='b', yerr=[df_std], align="center",
                    figsize=(20,10), rot=90)
       plt.title('Histogram of Feature Importances over all BaggingClassifiers')
@@ -317,10 +372,11 @@ class DecisionTreeBagRandSearch(object):
                                self.X_metrix_train, 
                                self.output_dir)
 
+    @stage
     def write_pickle(tree, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(tree, os.path.join(directory,
-                                   'best_tree_rand_bag_new_'+datestring+'.pkl'))
+      registry_dump(tree, os.path.join(directory,
+                                    'best_tree_rand_bag_new_'+datestring+'.pkl'))
       with open(os.path.join(directory,
                 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new decision tree with bagging "tree_clf_rand_bag_new" using best parameters \n')
@@ -329,6 +385,7 @@ class DecisionTreeBagRandSearch(object):
     write_pickle(self.tree_clf_rand_bag_new,
                  self.output_dir)
 
+    @stage
     def visualise_tree(tree_bag, directory, columns):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       trees = tree_bag.estimators_
@@ -364,6 +421,7 @@ class DecisionTreeBagRandSearch(object):
     print('*    Getting basic stats for new tree with bagging')
     print('*' *80)
 
+    @stage
     def basic_stats(tree, X_train, directory):
       #distribution --> accuracy
       accuracy_each_cv = cross_val_score(tree,
@@ -424,6 +482,7 @@ class DecisionTreeBagRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best tree an the test set as well as training
     set with 3 cross-validation folds and doing some initial analysis on the
@@ -434,6 +493,7 @@ class DecisionTreeBagRandSearch(object):
 
     #try out how well the classifier works to predict from the test set
     self.y_pred = self.tree_clf_rand_bag_new.predict(self.X_metrix_test)
+    registry_test_score(self.tree_clf_rand_bag_new, self.y_test, self.y_pred)
     self.y_pred_proba = self.tree_clf_rand_bag_new.predict_proba(self.X_metrix_test)
     with open(os.path.join(self.output_dir,
               'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
@@ -456,6 +516,7 @@ class DecisionTreeBagRandSearch(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -492,6 +553,7 @@ class DecisionTreeBagRandSearch(object):
 #
 ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -514,6 +576,7 @@ class DecisionTreeBagRandSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -633,6 +696,9 @@ class DecisionTreeBagRandSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '3-fold CV': conf_mat_3CV},
+                                directory, 'decisiontree_bag_randomsearch.txt')
         
     conf_mat(self.y_test,
              self.y_train,
@@ -640,6 +706,7 @@ class DecisionTreeBagRandSearch(object):
              self.y_train_CV_pred,
              self.output_dir)
 
+    @stage
     def prediction_probas(tree, X_train, y_train, X_test, y_test, y_pred_proba,
                                               y_train_CV_pred_proba, directory): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
@@ -765,10 +832,13 @@ class DecisionTreeBagRandSearch(object):
                       self.y_pred_proba,
                       self.y_train_CV_pred_proba,
                       self.output_dir)    
+
+    bootstrap_report(self.y_test, self.y_pred, self.y_pred_proba[:, 1], self.output_dir, 'decisiontree_bag_randomsearch.txt')
     
         
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
 ###############################################################################
@@ -777,8 +847,16 @@ def run():
   metrix = load_metrix_data(args.input)
   
   output_dir = make_output_folder(args.outdir)
+  open_profiler(output_dir, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(output_dir, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
 ###############################################################################
 
-  decision_tree_bag_rand_search = DecisionTreeBagRandSearch(metrix, output_dir)
-
+  try:
+    decision_tree_bag_rand_search = DecisionTreeBagRandSearch(metrix, output_dir)
+  finally:
+    close_fit_ledger(output_dir, 'decisiontree_bag_randomsearch_MR')
+    close_profiler()
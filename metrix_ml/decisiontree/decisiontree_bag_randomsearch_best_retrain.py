@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 import matplotlib.pyplot as plt
 import numpy as np
@@ -13,7 +12,6 @@ import subprocess
 import seaborn as sns
 import scikitplot as skplt
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.metrics import mean_squared_error
 from sklearn.externals import joblib
@@ -27,6 +25,15 @@ from datetime import datetime
 from sklearn.externals import joblib
 from scipy.stats import randint
 from sklearn.ensemble import BaggingClassifier
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.importance import tree_importances
+from metrix_ml.utils.incremental import (start_lineage, incremental_split,
+                                         incremental_update, update_scores, describe_lineage)
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
 
 ###############################################################################
 #
@@ -52,6 +59,53 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--previous',
+    type=str,
+    dest='previous',
+    default='',
+    help='Pickle of the previous generation; only appended rows are split and new trees are added to it')
+
+  parser.add_argument(
+    '--new_trees',
+    type=int,
+    dest='new_trees',
+    default=500,
+    help='Trees added in an incremental update')
+
+  parser.add_argument(
+    '--retire',
+    type=int,
+    dest='retire',
+    default=0,
+    help='Oldest trees dropped in an incremental update')
+
+  parser.add_argument(
+    '--max_trees',
+    type=int,
+    dest='max_trees',
+    default=0,
+    help='Trees kept at most after an incremental update, more of the oldest trees are retired; default the size of the first generation, without a cap the ensemble grows by --new_trees every generation')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -65,8 +119,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
   
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -92,7 +146,12 @@ class DecisionTreeBagRandomSearch(object):
      * predict on this new tree with test data and cross-validated training data
      * analyse the predisctions with graphs and stats
   '''
-  def __init__(self, metrix, newdata_minusEP, bbbb):
+  def __init__(self, metrix, newdata_minusEP, bbbb, previous=None, new_trees=500,
+               retire=0, max_trees=0):
+    self.previous = previous
+    self.new_trees = new_trees
+    self.retire = retire
+    self.max_trees = max_trees
     self.metrix=metrix
     self.newdata_minusEP=newdata_minusEP
     #self.prepare_metrix_data()
@@ -108,6 +167,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -125,7 +185,17 @@ class DecisionTreeBagRandomSearch(object):
     y = self.metrix['EP_success']
 
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
+    if self.previous is not None:
+      #rows of the previous generation stay on their side of the split, only
+      #the appended rows are split
+      (X_newdata_transform_train, X_newdata_transform_test, y_train, y_test,
+       self.n_new_train, self.n_new_test) = incremental_split(self.X_metrix, y, self.previous)
+      self.previous_test = self.previous.row_fingerprints_['test']
+      with open(os.path.join(self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
+        text_file.write('Incremental update: %s new training and %s new test rows \n'
+                        %(self.n_new_train, self.n_new_test))
+    else:
+      X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
     
     #assert self.X_newdata_top15.columns.all() == X_newdata_transform_train.columns.all()
 
@@ -145,6 +215,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def tree_best_params(self):
     '''create a new decision tree using the best parameter combination found above'''
     print('*' *80)
@@ -159,18 +230,26 @@ class DecisionTreeBagRandomSearch(object):
                                   min_samples_split=2,
                                   random_state= 0)
     self.tree_clf_rand_bag_new_transform = BaggingClassifier(clf2, n_estimators=6509, n_jobs=-1, bootstrap=True, random_state=100)
-    self.tree_clf_rand_bag_new_transform.fit(self.X_newdata_transform_train, self.y_train)   
+    if self.previous is not None:
+      self.tree_clf_rand_bag_new_transform = incremental_update(
+        self.previous, self.X_newdata_transform_train, self.y_train,
+        self.X_newdata_transform_test, self.y_test, self.new_trees, self.retire,
+        self.n_new_train, self.n_new_test,
+        self.max_trees or self.previous.lineage_[0]['n_estimators'])
+    else:
+      self.tree_clf_rand_bag_new_transform.fit(self.X_newdata_transform_train, self.y_train)
+      start_lineage(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.y_train,
+                    self.X_newdata_transform_test, self.y_test)
+    with open(os.path.join(self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Lineage: \n%s \n' %describe_lineage(self.tree_clf_rand_bag_new_transform))
     
+    @stage
     def feature_importances_pandas(clf, X_train, name, directory):   
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
-      feature_list = []
-      for tree in clf.estimators_:
-        feature_importances_ls = tree.feature_importances_
-        feature_list.append(feature_importances_ls)
-        
-      df = pd.DataFrame(feature_list, columns=X_train.columns)
-      df_mean = df[X_train.columns].mean(axis=0)
-      df_std = df[X_train.columns].std(axis=0)
+      #importances of all trees stacked into one array
+      importances = tree_importances(clf, X_train.columns)
+      df_mean = importances['mean']
+      df_std = importances['std']
       df_mean.plot(kind='bar', color='b', yerr=[df_std], align="center", figsize=(20,10), rot=90)
       plt.title('Histogram of Feature Importances over all BaggingClassifiers using features %s ' %name)
       plt.xlabel('Features')
@@ -180,6 +259,7 @@ class DecisionTreeBagRandomSearch(object):
       
     feature_importances_pandas(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, 'newdata_minusEP', self.newdata_minusEP)
 
+    @stage
     def write_pickle(tree, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       joblib.dump(tree, os.path.join(directory,'best_tree_rand_bag_'+name+datestring+'.pkl'))
@@ -189,6 +269,7 @@ class DecisionTreeBagRandomSearch(object):
     
     write_pickle(self.tree_clf_rand_bag_new_transform, self.newdata_minusEP, 'newdata_minusEP')
 
+    @stage
     def visualise_tree(tree_bag, directory, columns, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       trees = tree_bag.estimators_
@@ -214,6 +295,7 @@ class DecisionTreeBagRandomSearch(object):
     print('*    Getting basic stats for new tree')
     print('*' *80)
 
+    @stage
     def basic_stats(tree, X_train, directory):
       #distribution --> accuracy
       accuracy_each_cv = cross_val_score(tree, X_train, self.y_train, cv=3, scoring='accuracy')
@@ -235,7 +317,15 @@ class DecisionTreeBagRandomSearch(object):
         text_file.write('Precision mean for 3-fold CV: %s \n' %train_precision)
         text_file.write('F1 score mean for 3-fold CV: %s \n' %train_f1)
     
-    basic_stats(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.newdata_minusEP)
+    if self.previous is not None:
+      #cross-validation would refit every tree of the grown ensemble; the
+      #update is scored on the held-out test set and its new rows instead
+      scores = update_scores(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_test, self.y_test,
+                             self.previous_test)
+      with open(os.path.join(self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
+        text_file.write('Scores of the updated ensemble without CV refits: \n%s \n' %scores.to_string())
+    else:
+      basic_stats(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.newdata_minusEP)
 
     ###############################################################################
     #
@@ -243,6 +333,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best tree an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -258,17 +349,20 @@ class DecisionTreeBagRandomSearch(object):
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_test in y_pred_transform and probabilities y_pred_proba_transform\n')
 
-    #alternative way to not have to use the test set
-    self.y_train_CV_pred_transform = cross_val_predict(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.y_train, cv=3)
-    self.y_train_CV_pred_proba_transform = cross_val_predict(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.y_train, cv=3, method='predict_proba')
+    #alternative way to not have to use the test set; not for an incremental
+    #update, where it would refit every tree of the grown ensemble
+    if self.previous is None:
+      self.y_train_CV_pred_transform = cross_val_predict(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.y_train, cv=3)
+      self.y_train_CV_pred_proba_transform = cross_val_predict(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.y_train, cv=3, method='predict_proba')
+      with open(os.path.join(self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
+        text_file.write('Saving predictions and probabilities for X_transform_train with 3-fold CV in y_train_pred_transform \n')
 #    self.y_train_CV_pred_adj = [1 if x >= 0.6807 else 0 for x in self.y_train_CV_pred_proba_transform[:, 1]]
-    with open(os.path.join(self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
-      text_file.write('Saving predictions and probabilities for X_transform_train with 3-fold CV in y_train_pred_transform \n')
 
     print('*' *80)
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -302,6 +396,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -324,6 +419,14 @@ class DecisionTreeBagRandomSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    if self.previous is not None:
+      #an incremental update has no CV predictions, only the test set is analysed
+      write_confusion_intervals({'test': metrics.confusion_matrix(self.y_test, self.y_pred_transform)},
+                                self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt')
+      bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt')
+      return
+
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -434,9 +537,13 @@ class DecisionTreeBagRandomSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'decisiontree_bag_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
 
+    @stage
     def prediction_probas(tree, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
@@ -532,6 +639,8 @@ class DecisionTreeBagRandomSearch(object):
         text_file.write('AUC for CV train set class 1: %s \n' %AUC_train_class1)
         
     prediction_probas(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
+
+    bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt')
         
 def run():
   args = parse_command_line()
@@ -543,8 +652,16 @@ def run():
   metrix = load_metrix_data(args.input)
   
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_fit_ledger()
 
   ###############################################################################
 
-  decision_tree_bag_rand_search = DecisionTreeBagRandomSearch(metrix, newdata_minusEP, bbbb)
-
+  try:
+    previous = joblib.load(args.previous) if args.previous else None
+    decision_tree_bag_rand_search = DecisionTreeBagRandomSearch(metrix, newdata_minusEP, bbbb, previous,
+                                                                args.new_trees, args.retire, args.max_trees)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'decisiontree_bag_randomsearch_best_retrain')
+    close_profiler()
@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 
 import matplotlib
@@ -17,10 +16,8 @@ import subprocess
 import seaborn as sns
 import scikitplot as skplt
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import cross_val_predict
@@ -28,9 +25,20 @@ from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import randint
 from sklearn.ensemble import BaggingClassifier
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.importance import tree_importances
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -56,6 +64,52 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -69,8 +123,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
   
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -115,6 +169,7 @@ class DecisionTreeBagRandomSearch(object):
   #
   ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframes for directly after dataprocessing, after
        adding some protein information and after carrying out some custom solumn
@@ -154,6 +209,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -172,7 +228,7 @@ class DecisionTreeBagRandomSearch(object):
 #    X_transform_train, X_transform_test, y_train, y_test = train_test_split(self.X_transform, y, test_size=0.2, random_state=42)
  
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
+    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_newdata_transform.columns.all() == X_newdata_transform_train.columns.all()
 
@@ -192,6 +248,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def rand_search(self):
     '''running a randomized search to find the parameter combination for a decision tree
      which gives the best accuracy score'''
@@ -224,7 +281,7 @@ class DecisionTreeBagRandomSearch(object):
     rand_search = RandomizedSearchCV(tree_clf_rand_bag, param_rand, random_state=5,
                               cv=3, n_iter=500, scoring='accuracy', n_jobs=-1)
 
-    rand_search_transform = rand_search.fit(self.X_newdata_transform_train, self.y_train)
+    rand_search_transform = run_search(rand_search, self.X_newdata_transform_train, self.y_train, 'decisiontree_bag_randomsearch_topFeatures')
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_transform.best_params_)+'\n')
       text_file.write('Best score: ' +str(rand_search_transform.best_score_)+'\n')
@@ -261,6 +318,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def tree_best_params(self):
     '''create a new decision tree using the best parameter combination found above'''
     print('*' *80)
@@ -273,16 +331,13 @@ class DecisionTreeBagRandomSearch(object):
     
     attr_newdata_transform = ['anomalousCC', 'anomalousslope', 'lowreslimit', 'f', 'diffF']
         
+    @stage
     def feature_importances_pandas(clf, X_train, name, directory):   
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
-      feature_list = []
-      for tree in clf.estimators_:
-        feature_importances_ls = tree.feature_importances_
-        feature_list.append(feature_importances_ls)
-        
-      df = pd.DataFrame(feature_list, columns=X_train.columns)
-      df_mean = df[X_train.columns].mean(axis=0)
-      df_std = df[X_train.columns].std(axis=0)
+      #importances of all trees stacked into one array
+      importances = tree_importances(clf, X_train.columns)
+      df_mean = importances['mean']
+      df_std = importances['std']
       df_mean.plot(kind='bar', color='b', yerr=[df_std], align="center", figsize=(20,10), rot=90)
       plt.title('Histogram of Feature Importances over all BaggingClassifiers using features %s ' %name)
       plt.xlabel('Features')
@@ -292,15 +347,17 @@ class DecisionTreeBagRandomSearch(object):
       
     feature_importances_pandas(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, 'newdata_minusEP', self.newdata_minusEP)
 
+    @stage
     def write_pickle(tree, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(tree, os.path.join(directory,'best_tree_rand_bag_'+name+datestring+'.pkl'))
+      registry_dump(tree, os.path.join(directory,'best_tree_rand_bag_'+name+datestring+'.pkl'))
       with open(os.path.join(directory, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new decision tree "tree_clf_rand_bag_new_%s" using best parameters \n' %name)
         text_file.write('Creating pickle file for best tree as best_tree_rand_bag_%s.pkl \n' %name)
     
     write_pickle(self.tree_clf_rand_bag_new_transform, self.newdata_minusEP, 'newdata_minusEP')
 
+    @stage
     def visualise_tree(tree_bag, directory, columns, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       trees = tree_bag.estimators_
@@ -326,6 +383,7 @@ class DecisionTreeBagRandomSearch(object):
     print('*    Getting basic stats for new tree')
     print('*' *80)
 
+    @stage
     def basic_stats(tree, X_train, directory):
       #distribution --> accuracy
       accuracy_each_cv = cross_val_score(tree, X_train, self.y_train, cv=3, scoring='accuracy')
@@ -355,6 +413,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best tree an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -365,6 +424,7 @@ class DecisionTreeBagRandomSearch(object):
     #try out how well the classifier works to predict from the test set
     #self.y_pred_transform = self.tree_clf_rand_bag_new_transform.predict(self.X_transform_test)
     self.y_pred_transform = self.tree_clf_rand_bag_new_transform.predict(self.X_newdata_transform_test)
+    registry_test_score(self.tree_clf_rand_bag_new_transform, self.y_test, self.y_pred_transform)
     self.y_pred_proba_transform = self.tree_clf_rand_bag_new_transform.predict_proba(self.X_newdata_transform_test)
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_test in y_pred_transform and probabilities y_pred_proba_transform\n')
@@ -379,6 +439,7 @@ class DecisionTreeBagRandomSearch(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -412,6 +473,7 @@ class DecisionTreeBagRandomSearch(object):
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -434,6 +496,7 @@ class DecisionTreeBagRandomSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -544,9 +607,13 @@ class DecisionTreeBagRandomSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'decisiontree_bag_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
 
+    @stage
     def prediction_probas(tree, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'decisiontree_bag_randomsearch.txt'), 'a') as text_file:
@@ -663,10 +730,13 @@ class DecisionTreeBagRandomSearch(object):
       evaluate_threshold(tpr_CV_1, fpr_CV_1, thresholds_CV_1, 0.2, 'train_CV', directory)
     
     prediction_probas(self.tree_clf_rand_bag_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
+
+    bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'decisiontree_bag_randomsearch.txt')
     
         
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
   ###############################################################################
@@ -675,8 +745,16 @@ def run():
   metrix = load_metrix_data(args.input)
   
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(newdata_minusEP, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
   ###############################################################################
 
-  decision_tree_bag_rand_search = DecisionTreeBagRandomSearch(metrix, newdata_minusEP, bbbb)
-
+  try:
+    decision_tree_bag_rand_search = DecisionTreeBagRandomSearch(metrix, newdata_minusEP, bbbb)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'decisiontree_bag_randomsearch_topFeatures')
+    close_profiler()
@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 import matplotlib.pyplot as plt
 import numpy as np
@@ -13,7 +12,6 @@ import subprocess
 import seaborn as sns
 import scikitplot as skplt
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.metrics import mean_squared_error
 from sklearn.externals import joblib
@@ -21,11 +19,25 @@ from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import cross_val_predict
 from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
-from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
 from sklearn.externals import joblib
 from scipy.stats import randint
+from metrix_ml.utils.threshold_optimisation import (threshold_curves,
+                                                   roc_arrays,
+                                                   precision_recall_arrays,
+                                                   roc_auc,
+                                                   evaluate_thresholds,
+                                                   choose_threshold,
+                                                   store_threshold,
+                                                   plot_threshold_curves,
+                                                   CRITERIA)
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
 
 ###############################################################################
 #
@@ -51,6 +63,47 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--criterion',
+    type=str,
+    dest='criterion',
+    default='youden',
+    choices=CRITERIA,
+    help='Criterion for choosing the classification threshold on the train_CV set')
+
+  parser.add_argument(
+    '--beta',
+    type=float,
+    dest='beta',
+    default=1.0,
+    help='Beta of the F-beta score')
+
+  parser.add_argument(
+    '--target',
+    type=float,
+    dest='target',
+    default=None,
+    help='Target rate for the sensitivity and specificity criteria')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -64,8 +117,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
 
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -91,9 +144,13 @@ class DecisionTreeRandomSearchTransform(object):
      * predict on this new tree with test data and cross-validated training data
      * analyse the predisctions with graphs and stats
   '''
-  def __init__(self, metrix, newdata_minusEP, bbbb): 
+  def __init__(self, metrix, newdata_minusEP, bbbb, criterion='youden', beta=1.0,
+               target=None):
     self.metrix=metrix
     self.newdata_minusEP=newdata_minusEP
+    self.criterion = criterion
+    self.beta = beta
+    self.target = target
     self.prepare_metrix_data()
     self.split_data()
     #self.rand_search()
@@ -110,6 +167,7 @@ class DecisionTreeRandomSearchTransform(object):
   #
   ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframes for directly after dataprocessing, after
        adding some protein information and after carrying out some custom solumn
@@ -210,6 +268,7 @@ class DecisionTreeRandomSearchTransform(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -228,7 +287,7 @@ class DecisionTreeRandomSearchTransform(object):
 #    X_transform_train, X_transform_test, y_train, y_test = train_test_split(self.X_transform, y, test_size=0.2, random_state=42)
 
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_newdata_top15, y, test_size=0.2, random_state=42, stratify=y)
+    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_newdata_top15, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_newdata_top15.columns.all() == X_newdata_transform_train.columns.all()
 
@@ -248,6 +307,7 @@ class DecisionTreeRandomSearchTransform(object):
     #
     ###############################################################################
 
+  @stage
   def tree_best_params(self):
     '''create a new decision tree using the best parameter combination found above'''
     print('*' *80)
@@ -265,6 +325,7 @@ class DecisionTreeRandomSearchTransform(object):
                                        class_weight='balanced')#class_weight='balanced'
     self.tree_clf_rand_new_transform.fit(self.X_newdata_transform_train, self.y_train)
 
+    @stage
     def plot_features(clf, attr, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       skplt.estimators.plot_feature_importances(clf, feature_names=attr, x_tick_rotation=60, max_num_features=5, figsize=(25, 25))
@@ -274,6 +335,7 @@ class DecisionTreeRandomSearchTransform(object):
    
     plot_features(self.tree_clf_rand_new_transform, self.X_newdata_transform_train.columns, self.newdata_minusEP)
    
+    @stage
     def write_pickle(tree, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       joblib.dump(tree, os.path.join(directory,'best_tree_rand_'+name+datestring+'.pkl'))
@@ -283,6 +345,7 @@ class DecisionTreeRandomSearchTransform(object):
     
     write_pickle(self.tree_clf_rand_new_transform, self.newdata_minusEP, 'newdata_minusEP')
     
+    @stage
     def visualise_tree(tree, directory, columns, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       dotfile = os.path.join(directory, 'tree_clf_rand_new_'+name+datestring+'.dot')
@@ -304,6 +367,7 @@ class DecisionTreeRandomSearchTransform(object):
     print('*    Getting basic stats for new tree')
     print('*' *80)
 
+    @stage
     def basic_stats(tree, X_train, directory):
       #distribution --> accuracy
       accuracy_each_cv = cross_val_score(tree, X_train, self.y_train, cv=3, scoring='accuracy')
@@ -333,6 +397,7 @@ class DecisionTreeRandomSearchTransform(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best tree an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -344,14 +409,15 @@ class DecisionTreeRandomSearchTransform(object):
     #self.y_pred_class_transform = self.tree_clf_rand_new_transform.predict(self.X_transform_test)
     self.y_pred_transform = self.tree_clf_rand_new_transform.predict(self.X_newdata_transform_test)
     self.y_pred_proba_transform = self.tree_clf_rand_new_transform.predict_proba(self.X_newdata_transform_test)
-    self.y_pred_adj = [1 if x >= 0.6807 else 0 for x in self.y_pred_proba_transform[:, 1]]
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_test in y_pred_transform and probabilities y_pred_proba_transform\n')
 
     #alternative way to not have to use the test set
     self.y_train_CV_pred_transform = cross_val_predict(self.tree_clf_rand_new_transform, self.X_newdata_transform_train, self.y_train, cv=3)
     self.y_train_CV_pred_proba_transform = cross_val_predict(self.tree_clf_rand_new_transform, self.X_newdata_transform_train, self.y_train, cv=3, method='predict_proba')
-    self.y_train_CV_pred_adj = [1 if x >= 0.6807 else 0 for x in self.y_train_CV_pred_proba_transform[:, 1]]
+    self.threshold_optimisation()
+    self.y_pred_adj = [1 if x >= self.threshold else 0 for x in self.y_pred_proba_transform[:, 1]]
+    self.y_train_CV_pred_adj = [1 if x >= self.threshold else 0 for x in self.y_train_CV_pred_proba_transform[:, 1]]
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_train with 3-fold CV in y_train_pred_transform \n')
 
@@ -359,6 +425,7 @@ class DecisionTreeRandomSearchTransform(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -387,12 +454,45 @@ class DecisionTreeRandomSearchTransform(object):
     prediction_stats(self.y_test, self.y_pred_transform, self.newdata_minusEP)
     prediction_stats(self.y_test, self.y_pred_adj, self.newdata_minusEP)
     
+    ###############################################################################
+    #
+    #  choosing the classification threshold
+    #
+    ###############################################################################
+
+  @stage
+  def threshold_optimisation(self):
+    '''choose the classification threshold on the cross-validated training
+    probabilities and store it with the model, so predictions on new data
+    read it instead of a hard-coded value'''
+    print('*' *80)
+    print('*    Choosing classification threshold on train_CV set')
+    print('*' *80)
+
+    self.curves_CV = threshold_curves(self.y_train, self.y_train_CV_pred_proba_transform[:, 1], self.beta)
+    chosen = choose_threshold(self.curves_CV, self.criterion, self.target)
+    self.threshold = chosen['threshold']
+    store_threshold(self.tree_clf_rand_new_transform, chosen)
+
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    self.curves_CV.to_csv(os.path.join(self.newdata_minusEP, 'threshold_curves_train_CV_'+datestring+'.csv'), index=False)
+    plot_threshold_curves(self.curves_CV, chosen, 'Threshold curves for train_CV set',
+                          os.path.join(self.newdata_minusEP, 'threshold_curves_train_CV_'+datestring+'.png'))
+    joblib.dump(self.tree_clf_rand_new_transform, os.path.join(self.newdata_minusEP, 'best_tree_rand_threshold_newdata_minusEP'+datestring+'.pkl'))
+
+    with open(os.path.join(self.newdata_minusEP, 'decisiontree_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Chosen threshold by %s on train_CV set: %s \n' %(self.criterion, self.threshold))
+      text_file.write('Sensitivity: %s, specificity: %s, precision: %s, F-beta: %s \n'
+                      %(chosen['sensitivity'], chosen['specificity'], chosen['precision'], chosen['f_beta']))
+      text_file.write('Creating pickle file for model with stored threshold as best_tree_rand_threshold_newdata_minusEP.pkl \n')
+
     ###############################################################################
     #
     #  detailed analysis and stats
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -415,6 +515,7 @@ class DecisionTreeRandomSearchTransform(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
     
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -525,10 +626,14 @@ class DecisionTreeRandomSearchTransform(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'decisiontree_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
     conf_mat(self.y_test, self.y_train, self.y_pred_adj, self.y_train_CV_pred_adj, self.newdata_minusEP)
 
+    @stage
     def prediction_probas(tree, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'decisiontree_randomsearch.txt'), 'a') as text_file:
@@ -570,10 +675,11 @@ class DecisionTreeRandomSearchTransform(object):
         plt.close()
 
      #plot Precision Recall Threshold curve for test set        
-      precisions, recalls, thresholds_tree = precision_recall_curve(self.y_test, self.y_scores_ones)
+      curves_test = threshold_curves(self.y_test, self.y_scores_ones, self.beta)
+      precisions, recalls, thresholds_tree = precision_recall_arrays(curves_test)
       plot_precision_recall_vs_threshold(precisions, recalls, thresholds_tree, 'test_', '1', directory)
       #plot Precision Recall Threshold curve for CV train set       
-      precisions, recalls, thresholds_tree = precision_recall_curve(self.y_train, self.y_scores_CV_ones)
+      precisions, recalls, thresholds_tree = precision_recall_arrays(self.curves_CV)
       plot_precision_recall_vs_threshold(precisions, recalls, thresholds_tree, 'train_CV_', '1', directory)
            
       with open(os.path.join(directory, 'decisiontree_randomsearch.txt'), 'a') as text_file:
@@ -588,14 +694,6 @@ class DecisionTreeRandomSearchTransform(object):
       #tpr: true positive rate
 
       #plot ROC curves
-      def plot_roc_curve(y_test, y_proba, name, directory):
-        skplt.metrics.plot_roc(y_test, y_proba, title='ROC curve %s' %name)
-        plt.savefig(os.path.join(directory, 'ROC_curve_skplt_tree_rand_'+name+datestring+'.png'))
-        plt.close()
-        
-      plot_roc_curve(self.y_train, y_train_CV_pred_proba, 'train_CV_', directory)  
-      plot_roc_curve(self.y_test, y_pred_proba, 'test_', directory)  
-    
       def plot_roc_curve(fpr, tpr, name, classes, directory):
         plt.plot(fpr, tpr, linewidth=2)
         plt.plot([0, 1], [0, 1], 'k--')
@@ -608,45 +706,35 @@ class DecisionTreeRandomSearchTransform(object):
         plt.close()
         
       #ROC curve for test set      
-      fpr_1, tpr_1, thresholds_1 = roc_curve(self.y_test, self.y_scores_ones)
+      fpr_1, tpr_1, thresholds_1 = roc_arrays(curves_test)
       plot_roc_curve(fpr_1, tpr_1, 'test_', '1', directory)
       #ROC curve for 10-fold CV train set      
-      fpr_CV_1, tpr_CV_1, thresholds_CV_1 = roc_curve(self.y_train, self.y_scores_CV_ones)
+      fpr_CV_1, tpr_CV_1, thresholds_CV_1 = roc_arrays(self.curves_CV)
       plot_roc_curve(fpr_CV_1, tpr_CV_1, 'train_CV_', '1', directory)
       
       #calculate the area under the curve to get the performance for a classifier
       # IMPORTANT: first argument is true values, second argument is predicted probabilities
-      AUC_test_class1 = metrics.roc_auc_score(self.y_test, self.y_scores_ones)
-      AUC_train_class1 = metrics.roc_auc_score(self.y_train, self.y_scores_CV_ones)
+      AUC_test_class1 = roc_auc(curves_test)
+      AUC_train_class1 = roc_auc(self.curves_CV)
 
       with open(os.path.join(directory, 'decisiontree_randomsearch.txt'), 'a') as text_file:
         text_file.write('AUC for test set class 1: %s \n' %AUC_test_class1)
         text_file.write('AUC for CV train set class 1: %s \n' %AUC_train_class1)
         
-      # define a function that accepts a threshold and prints sensitivity and specificity
-      def evaluate_threshold(tpr, fpr, thresholds, threshold, name, directory):
-        sensitivity = tpr[thresholds > threshold][-1]
-        specificity = 1 - fpr[thresholds > threshold][-1]
+      #sensitivity and specificity at fixed thresholds and at the chosen one,
+      #all looked up in the curves
+      thresholds = [0.7, 0.6, 0.5, 0.4, 0.3, 0.2, self.threshold]
+      for name, curves in (('test_', curves_test), ('train_CV', self.curves_CV)):
+        evaluated = evaluate_thresholds(curves, thresholds)
         with open(os.path.join(directory, 'decisiontree_randomsearch.txt'), 'a') as text_file:
-          text_file.write('Sensitivity for %s at threshold %.2f: %s \n' %(name, threshold, sensitivity))
-          text_file.write('Specificity for %s at threshold %.2f: %s \n' %(name, threshold, specificity))
-
-      evaluate_threshold(tpr_1, fpr_1, thresholds_1, 0.7, 'test_', directory)
-      evaluate_threshold(tpr_1, fpr_1, thresholds_1, 0.6, 'test_', directory)    
-      evaluate_threshold(tpr_1, fpr_1, thresholds_1, 0.5, 'test_', directory)
-      evaluate_threshold(tpr_1, fpr_1, thresholds_1, 0.4, 'test_', directory)
-      evaluate_threshold(tpr_1, fpr_1, thresholds_1, 0.3, 'test_', directory)
-      evaluate_threshold(tpr_1, fpr_1, thresholds_1, 0.2, 'test_', directory)
-      evaluate_threshold(tpr_CV_1, fpr_CV_1, thresholds_CV_1, 0.7, 'train_CV', directory)
-      evaluate_threshold(tpr_CV_1, fpr_CV_1, thresholds_CV_1, 0.6, 'train_CV', directory)
-      evaluate_threshold(tpr_CV_1, fpr_CV_1, thresholds_CV_1, 0.5, 'train_CV', directory)
-      evaluate_threshold(tpr_CV_1, fpr_CV_1, thresholds_CV_1, 0.4, 'train_CV', directory)
-      evaluate_threshold(tpr_CV_1, fpr_CV_1, thresholds_CV_1, 0.3, 'train_CV', directory)
-      evaluate_threshold(tpr_CV_1, fpr_CV_1, thresholds_CV_1, 0.2, 'train_CV', directory)
+          for _, row in evaluated.iterrows():
+            text_file.write('Sensitivity for %s at threshold %.2f: %s \n' %(name, row['requested'], row['sensitivity']))
+            text_file.write('Specificity for %s at threshold %.2f: %s \n' %(name, row['requested'], row['specificity']))
         
 
     prediction_probas(self.tree_clf_rand_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')
-    prediction_probas(self.tree_clf_rand_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
+
+    bootstrap_report(self.y_test, self.y_pred_adj, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'decisiontree_randomsearch.txt')
  
 def run():
   args = parse_command_line()
@@ -658,8 +746,15 @@ def run():
   metrix = load_metrix_data(args.input)
 
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_fit_ledger()
 
   ###############################################################################
 
-  decision_tree_random_search_transform = DecisionTreeRandomSearchTransform(metrix, newdata_minusEP, bbbb)
-
+  try:
+    decision_tree_random_search_transform = DecisionTreeRandomSearchTransform(metrix, newdata_minusEP, bbbb, args.criterion,
+                                                                              args.beta, args.target)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'decisiontree_randomsearch_best_threshold')
+    close_profiler()
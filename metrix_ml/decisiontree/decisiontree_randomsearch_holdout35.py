@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 
 import matplotlib
@@ -17,10 +16,8 @@ import subprocess
 import seaborn as sns
 import scikitplot as skplt
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import cross_val_predict
@@ -28,8 +25,18 @@ from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import randint
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -55,6 +62,52 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -68,8 +121,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
 
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -114,6 +167,7 @@ class DecisionTreeRandomSearchTransform(object):
   #
   ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframes for directly after dataprocessing, after
        adding some protein information and after carrying out some custom solumn
@@ -212,6 +266,7 @@ class DecisionTreeRandomSearchTransform(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -230,7 +285,7 @@ class DecisionTreeRandomSearchTransform(object):
 #    X_transform_train, X_transform_test, y_train, y_test = train_test_split(self.X_transform, y, test_size=0.2, random_state=42)
 
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
+    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_newdata_transform.columns.all() == X_newdata_transform_train.columns.all()
 
@@ -250,6 +305,7 @@ class DecisionTreeRandomSearchTransform(object):
     #
     ###############################################################################
 
+  @stage
   def rand_search(self):
     '''running a randomized search to find the parameter combination for a decision tree
      which gives the best accuracy score'''
@@ -279,7 +335,7 @@ class DecisionTreeRandomSearchTransform(object):
     rand_search = RandomizedSearchCV(tree_clf_rand, param_rand, random_state=5, cv=3, n_iter=500,
                               scoring='accuracy', n_jobs=-1)
                               
-    rand_search_transform = rand_search.fit(self.X_newdata_transform_train, self.y_train)
+    rand_search_transform = run_search(rand_search, self.X_newdata_transform_train, self.y_train, 'decisiontree_randomsearch_holdout35')
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_transform.best_params_)+'\n')
       text_file.write('Best score: ' +str(rand_search_transform.best_score_)+'\n')
@@ -296,6 +352,7 @@ class DecisionTreeRandomSearchTransform(object):
     #
     ###############################################################################
 
+  @stage
   def tree_best_params(self):
     '''create a new decision tree using the best parameter combination found above'''
     print('*' *80)
@@ -305,6 +362,7 @@ class DecisionTreeRandomSearchTransform(object):
     self.tree_clf_rand_new_transform = DecisionTreeClassifier(**self.best_params_transform, random_state=100, class_weight='balanced')#class_weight='balanced'
     self.tree_clf_rand_new_transform.fit(self.X_newdata_transform_train, self.y_train)
 
+    @stage
     def plot_features(clf, attr, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       skplt.estimators.plot_feature_importances(clf, feature_names=attr, x_tick_rotation=60, max_num_features=40, figsize=(25, 25))
@@ -314,15 +372,17 @@ class DecisionTreeRandomSearchTransform(object):
    
     plot_features(self.tree_clf_rand_new_transform, self.X_newdata_transform_train.columns, self.newdata_minusEP)
    
+    @stage
     def write_pickle(tree, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(tree, os.path.join(directory,'best_tree_rand_'+name+datestring+'.pkl'))
+      registry_dump(tree, os.path.join(directory,'best_tree_rand_'+name+datestring+'.pkl'))
       with open(os.path.join(directory, 'decisiontree_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new decision tree "tree_clf_rand_new_%s" using best parameters \n' %name)
         text_file.write('Creating pickle file for best tree as best_tree_rand_%s.pkl \n' %name)
     
     write_pickle(self.tree_clf_rand_new_transform, self.newdata_minusEP, 'newdata_minusEP')
     
+    @stage
     def visualise_tree(tree, directory, columns, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       dotfile = os.path.join(directory, 'tree_clf_rand_new_'+name+datestring+'.dot')
@@ -344,6 +404,7 @@ class DecisionTreeRandomSearchTransform(object):
     print('*    Getting basic stats for new tree')
     print('*' *80)
 
+    @stage
     def basic_stats(tree, X_train, directory):
       #distribution --> accuracy
       accuracy_each_cv = cross_val_score(tree, X_train, self.y_train, cv=3, scoring='accuracy')
@@ -373,6 +434,7 @@ class DecisionTreeRandomSearchTransform(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best tree an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -383,6 +445,7 @@ class DecisionTreeRandomSearchTransform(object):
     #try out how well the classifier works to predict from the test set
     #self.y_pred_class_transform = self.tree_clf_rand_new_transform.predict(self.X_transform_test)
     self.y_pred_transform = self.tree_clf_rand_new_transform.predict(self.X_newdata_transform_test)
+    registry_test_score(self.tree_clf_rand_new_transform, self.y_test, self.y_pred_transform)
     self.y_pred_proba_transform = self.tree_clf_rand_new_transform.predict_proba(self.X_newdata_transform_test)
     with open(os.path.join(self.newdata_minusEP, 'decisiontree_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_test in y_pred_transform and probabilities y_pred_proba_transform\n')
@@ -397,6 +460,7 @@ class DecisionTreeRandomSearchTransform(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -430,6 +494,7 @@ class DecisionTreeRandomSearchTransform(object):
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -452,6 +517,7 @@ class DecisionTreeRandomSearchTransform(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
     
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -562,9 +628,13 @@ class DecisionTreeRandomSearchTransform(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'decisiontree_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
 
+    @stage
     def prediction_probas(tree, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'decisiontree_randomsearch.txt'), 'a') as text_file:
@@ -660,9 +730,12 @@ class DecisionTreeRandomSearchTransform(object):
         text_file.write('AUC for CV train set class 1: %s \n' %AUC_train_class1)
 
     prediction_probas(self.tree_clf_rand_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
+
+    bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'decisiontree_randomsearch.txt')
  
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
   ###############################################################################
@@ -671,8 +744,16 @@ def run():
   metrix = load_metrix_data(args.input)
 
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(newdata_minusEP, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
   ###############################################################################
 
-  decision_tree_random_search_transform = DecisionTreeRandomSearchTransform(metrix, newdata_minusEP, bbbb)
-
+  try:
+    decision_tree_random_search_transform = DecisionTreeRandomSearchTransform(metrix, newdata_minusEP, bbbb)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'decisiontree_randomsearch_holdout35')
+    close_profiler()
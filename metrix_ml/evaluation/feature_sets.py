@@ -0,0 +1,283 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Compare one trainer on several named feature sets in a single run; the
+data is loaded and transformed once, all sets use the same train/test split
+and the same inner CV folds, and the per-set searches run concurrently
+within one core budget. Replaces keeping a copy of a trainer per column
+subset (*_topFeatures, *_proc, *_screen, *_tummyfeatures)'''
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn import metrics
+from sklearn.model_selection import (RandomizedSearchCV, StratifiedKFold,
+                                     train_test_split)
+
+from metrix_ml.evaluation.search_spaces import (MODELS, search_space,
+                                                clip_features, positive_scores)
+
+###############################################################################
+#
+#  feature sets of the trainer variants
+#
+###############################################################################
+
+ATTR_NEWDATA_INITIAL = ['IoverSigma', 'cchalf', 'RmergediffI', 'RmergeI', 'RmeasI',
+                        'RmeasdiffI', 'RpimdiffI', 'RpimI', 'totalobservations',
+                        'totalunique', 'multiplicity', 'completeness', 'lowreslimit',
+                        'highreslimit', 'wilsonbfactor', 'anomalousslope',
+                        'anomalousCC', 'anomalousmulti', 'anomalouscompl', 'diffI',
+                        'diffF', 'f', 'wavelength', 'sg_number', 'cell_a', 'cell_b',
+                        'cell_c', 'cell_alpha', 'cell_beta', 'cell_gamma', 'Vcell',
+                        'solvent_content', 'Matth_coeff', 'No_atom_chain', 'No_mol_ASU',
+                        'MW_chain', 'sites_ASU']
+
+FEATURE_SETS = {
+  'newdata_minusEP': ['IoverSigma', 'cchalf', 'RmergediffI', 'RmergeI', 'RmeasI',
+                      'RmeasdiffI', 'RpimdiffI', 'RpimI', 'totalobservations',
+                      'totalunique', 'multiplicity', 'completeness', 'lowreslimit',
+                      'highreslimit', 'wilsonbfactor', 'anomalousslope',
+                      'anomalousCC', 'anomalousmulti', 'anomalouscompl', 'diffI',
+                      'diffF', 'f', 'wavelength', 'wavelength**3', 'wavelength**3/Vcell',
+                      'sg_number', 'cell_a', 'cell_b', 'cell_c', 'cell_alpha',
+                      'cell_beta', 'cell_gamma', 'Vcell', 'solvent_content',
+                      'Vcell/Vm<Ma>', 'Matth_coeff', 'MW_ASU/sites_ASU/solvent_content',
+                      'MW_chain', 'No_atom_chain', 'No_mol_ASU', 'MW_ASU', 'sites_ASU',
+                      'MW_ASU/sites_ASU', 'MW_chain/No_atom_chain', 'wilson', 'bragg',
+                      'volume_wilsonB_highres', 'IoverSigma/MW_ASU'],
+  'proc': ['IoverSigma', 'cchalf', 'RmergediffI', 'RmergeI', 'RmeasI',
+           'RmeasdiffI', 'RpimdiffI', 'RpimI', 'totalobservations',
+           'totalunique', 'multiplicity', 'completeness', 'lowreslimit',
+           'highreslimit', 'wilsonbfactor', 'anomalousslope',
+           'anomalousCC', 'anomalousmulti', 'anomalouscompl', 'diffI',
+           'diffF', 'wavelength', 'sg_number', 'cell_a', 'cell_b', 'cell_c',
+           'cell_alpha', 'cell_beta', 'cell_gamma', 'Vcell', 'wavelength**3',
+           'wavelength**3/Vcell', 'wilson', 'bragg', 'volume_wilsonB_highres'],
+  'screen': ['highreslimit', 'wavelength', 'wavelength**3', 'wavelength**3/Vcell',
+             'sg_number', 'cell_a', 'cell_b', 'cell_c', 'cell_alpha',
+             'cell_beta', 'cell_gamma', 'Vcell', 'solvent_content',
+             'Vcell/Vm<Ma>', 'Matth_coeff', 'MW_ASU/sites_ASU/solvent_content',
+             'MW_chain', 'No_atom_chain', 'No_mol_ASU', 'MW_ASU', 'sites_ASU',
+             'MW_ASU/sites_ASU', 'MW_chain/No_atom_chain', 'bragg'],
+  'tummyfeatures': ['diffI', 'anomalousCC', 'MW_ASU/sites_ASU', 'lowreslimit',
+                    'anomalousslope', 'diffF', 'MW_ASU/sites_ASU/solvent_content',
+                    'Matth_coeff', 'sg_number', 'cchalf', 'anomalouscompl',
+                    'solvent_content'],
+  'topFeatures': ['anomalousCC'],
+  'topFeatures5': ['anomalousCC', 'anomalousslope', 'lowreslimit', 'f', 'diffF']}
+
+def newdata_transform(metrix):
+  '''The column transformations of the newdata_minusEP trainers, done once
+  for all feature sets; missing values become 0 as in the trainers'''
+  transform = metrix[ATTR_NEWDATA_INITIAL].copy()
+  transform['MW_ASU'] = transform['MW_chain'] * transform['No_mol_ASU']
+  transform['MW_ASU/sites_ASU'] = transform['MW_ASU'] / transform['sites_ASU']
+  transform['IoverSigma/MW_ASU'] = transform['IoverSigma'] / transform['MW_ASU']
+  transform['MW_chain/No_atom_chain'] = transform['MW_chain'] / transform['No_atom_chain']
+  transform['MW_ASU/sites_ASU/solvent_content'] = transform['MW_ASU/sites_ASU'] / transform['solvent_content']
+  transform['wavelength**3'] = transform['wavelength'] ** 3
+  transform['wavelength**3/Vcell'] = transform['wavelength**3'] / transform['Vcell']
+  transform['Vcell/Vm<Ma>'] = transform['Vcell'] / (transform['Matth_coeff'] * transform['MW_chain/No_atom_chain'])
+  transform['wilson'] = -2 * transform['wilsonbfactor']
+  transform['bragg'] = (1 / transform['highreslimit'])**2
+  transform['volume_wilsonB_highres'] = transform['Vcell/Vm<Ma>'] * np.exp(transform['wilson'] * transform['bragg'])
+  return transform.replace([np.inf, -np.inf], np.nan).fillna(0)
+
+def load_feature_sets(path):
+  '''Feature sets from a JSON file of {name: [columns]}'''
+  with open(path) as json_file:
+    return json.load(json_file)
+
+###############################################################################
+#
+#  define command line arguments
+#
+###############################################################################
+
+def parse_command_line():
+  '''defining the command line input to make it runable'''
+  parser = argparse.ArgumentParser(description='Compare feature sets for one trainer')
+
+  parser.add_argument(
+    '--input',
+    type=str,
+    dest='input',
+    default='',
+    help='The input CSV file')
+
+  parser.add_argument(
+    '--outdir',
+    type=str,
+    dest='outdir',
+    default='',
+    help='Specify output directory')
+
+  parser.add_argument(
+    '--model',
+    type=str,
+    dest='model',
+    default='randomforest',
+    choices=MODELS,
+    help='Trainer whose randomised search is run on every feature set')
+
+  parser.add_argument(
+    '--sets',
+    type=str,
+    dest='sets',
+    default='',
+    help='Comma separated names of feature sets to compare; default all')
+
+  parser.add_argument(
+    '--feature_sets',
+    type=str,
+    dest='feature_sets',
+    default='',
+    help='JSON file with further named feature sets {name: [columns]}')
+
+  parser.add_argument(
+    '--label',
+    type=str,
+    dest='label',
+    default='EP_success',
+    help='Column with the class labels')
+
+  parser.add_argument(
+    '--n_iter',
+    type=int,
+    dest='n_iter',
+    default=500,
+    help='Number of parameter combinations tried per feature set')
+
+  parser.add_argument(
+    '--n_cores',
+    type=int,
+    dest='n_cores',
+    default=-1,
+    help='Cores shared by all searches; -1 uses all')
+
+  args = parser.parse_args()
+  if args.input == '':
+    parser.print_help()
+    exit(0)
+  return args
+
+###############################################################################
+#
+#  load the data from CSV file and creating output directory
+#
+###############################################################################
+
+def load_metrix_data(csv_path):
+  '''load the raw data as stored in CSV file'''
+  return pd.read_csv(csv_path)
+
+def make_output_folder(outdir, model):
+  name = os.path.join(outdir, 'feature_set_comparison', model)
+  os.makedirs(name, exist_ok=True)
+  return name
+
+###############################################################################
+#
+#  comparison
+#
+###############################################################################
+
+def share_cores(n_sets, n_cores=-1):
+  '''Number of searches run at once and cores given to each search'''
+  if n_cores < 1:
+    n_cores = os.cpu_count() or 1
+  concurrent = max(1, min(n_sets, n_cores))
+  return concurrent, max(1, n_cores // concurrent)
+
+def fit_feature_set(name, X, y, train, test, folds, model, n_iter, n_jobs):
+  '''Randomised search on the training rows of one feature set and scores of
+  the best estimator on the test rows; top level function so it can run in
+  a worker process'''
+  estimator, space = search_space(model)
+  space = clip_features(space, X.shape[1])
+  search = RandomizedSearchCV(estimator, space, cv=folds, scoring='accuracy',
+                              n_iter=n_iter, random_state=5, n_jobs=n_jobs)
+  start = time.time()
+  search.fit(X[train], y[train])
+  fit_time = time.time() - start
+
+  y_pred = search.best_estimator_.predict(X[test])
+  y_score = positive_scores(search.best_estimator_, X[test])
+  return {'feature_set': name,
+          'n_features': X.shape[1],
+          'cv_accuracy': search.best_score_,
+          'cv_std': search.cv_results_['std_test_score'][search.best_index_],
+          'test_accuracy': metrics.accuracy_score(y[test], y_pred),
+          'test_roc_auc': metrics.roc_auc_score(y[test], y_score),
+          'test_precision': metrics.precision_score(y[test], y_pred),
+          'test_recall': metrics.recall_score(y[test], y_pred),
+          'test_f1': metrics.f1_score(y[test], y_pred),
+          'fit_time': fit_time,
+          'best_params': str(search.best_params_)}
+
+def compare_feature_sets(data, y, feature_sets, model, n_iter=500, n_cores=-1,
+                         test_size=0.2, random_state=42):
+  '''Run the randomised search of a trainer on every feature set.
+  ******
+  Input: transformed dataframe, labels, dict of name to columns, one of
+         MODELS, search iterations, core budget, test fraction, seed of the
+         split
+  Output: comparison dataframe with one row per feature set, best CV
+          accuracy first
+  '''
+  y = np.asarray(y)
+  #one split and one set of inner folds for every feature set
+  train, test = train_test_split(np.arange(len(y)), test_size=test_size,
+                                 random_state=random_state, stratify=y)
+  folds = list(StratifiedKFold(n_splits=3).split(train, y[train]))
+  concurrent, per_search = share_cores(len(feature_sets), n_cores)
+
+  rows = Parallel(n_jobs=concurrent)(
+    delayed(fit_feature_set)(name, data[columns].values.astype(np.float64), y,
+                             train, test, folds, model, n_iter, per_search)
+    for name, columns in feature_sets.items())
+  table = pd.DataFrame(rows)
+  return table.sort_values('cv_accuracy', ascending=False).reset_index(drop=True)
+
+def run():
+  args = parse_command_line()
+
+  feature_sets = dict(FEATURE_SETS)
+  if args.feature_sets:
+    feature_sets.update(load_feature_sets(args.feature_sets))
+  if args.sets:
+    names = [name.strip() for name in args.sets.split(',') if name.strip()]
+    unknown = [name for name in names if name not in feature_sets]
+    if unknown:
+      raise ValueError('unknown feature sets %s, known are %s'
+                       %(', '.join(unknown), ', '.join(feature_sets)))
+    feature_sets = {name: feature_sets[name] for name in names}
+
+  metrix = load_metrix_data(args.input)
+  output_dir = make_output_folder(args.outdir, args.model)
+  data = newdata_transform(metrix)
+  concurrent, per_search = share_cores(len(feature_sets), args.n_cores)
+
+  with open(os.path.join(output_dir, 'feature_set_comparison.txt'), 'a') as text_file:
+    text_file.write('Comparing feature sets %s for %s \n' %(list(feature_sets), args.model))
+    text_file.write('%s searches at once with %s cores each, n_iter=%s, cv=3, scoring=accuracy \n'
+                    %(concurrent, per_search, args.n_iter))
+
+  table = compare_feature_sets(data, metrix[args.label], feature_sets, args.model,
+                               args.n_iter, args.n_cores)
+
+  datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+  table.to_csv(os.path.join(output_dir, 'feature_set_comparison_'+datestring+'.csv'), index=False)
+  with open(os.path.join(output_dir, 'feature_set_comparison.txt'), 'a') as text_file:
+    text_file.write('Comparison of feature sets: \n%s \n'
+                    %table.drop('best_params', axis=1).to_string(index=False))
+    for _, row in table.iterrows():
+      text_file.write('Best parameters %s: %s \n' %(row['feature_set'], row['best_params']))
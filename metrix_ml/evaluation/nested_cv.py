@@ -0,0 +1,266 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Nested cross-validation; an outer repeated stratified split with the full
+randomised search of a trainer inside every outer training fold. The outer
+folds run in parallel worker processes which all read the same
+memory-mapped copy of the data'''
+import argparse
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, dump, load
+from sklearn import metrics
+from sklearn.model_selection import (RandomizedSearchCV, RepeatedStratifiedKFold,
+                                     StratifiedKFold)
+
+from metrix_ml.evaluation.search_spaces import (MODELS, search_space,
+                                                clip_features, positive_scores)
+
+###############################################################################
+#
+#  define command line arguments
+#
+###############################################################################
+
+def parse_command_line():
+  '''defining the command line input to make it runable'''
+  parser = argparse.ArgumentParser(description='Nested cross-validation of a randomised search')
+
+  parser.add_argument(
+    '--input',
+    type=str,
+    dest='input',
+    default='',
+    help='The input CSV file')
+
+  parser.add_argument(
+    '--outdir',
+    type=str,
+    dest='outdir',
+    default='',
+    help='Specify output directory')
+
+  parser.add_argument(
+    '--model',
+    type=str,
+    dest='model',
+    default='decisiontree',
+    choices=MODELS,
+    help='Trainer whose randomised search is evaluated')
+
+  parser.add_argument(
+    '--label',
+    type=str,
+    dest='label',
+    default='EP_success',
+    help='Column with the class labels')
+
+  parser.add_argument(
+    '--features',
+    type=str,
+    dest='features',
+    default='',
+    help='Comma separated feature columns; default all numeric columns except *_success')
+
+  parser.add_argument(
+    '--n_splits',
+    type=int,
+    dest='n_splits',
+    default=5,
+    help='Number of outer folds')
+
+  parser.add_argument(
+    '--n_repeats',
+    type=int,
+    dest='n_repeats',
+    default=2,
+    help='Number of repeats of the outer split')
+
+  parser.add_argument(
+    '--inner_cv',
+    type=int,
+    dest='inner_cv',
+    default=3,
+    help='Number of inner folds of the randomised search')
+
+  parser.add_argument(
+    '--n_iter',
+    type=int,
+    dest='n_iter',
+    default=500,
+    help='Number of parameter combinations tried in each outer fold')
+
+  parser.add_argument(
+    '--n_jobs',
+    type=int,
+    dest='n_jobs',
+    default=-1,
+    help='Number of outer folds run in parallel')
+
+  parser.add_argument(
+    '--random_state',
+    type=int,
+    dest='random_state',
+    default=42,
+    help='Seed of the outer split')
+
+  args = parser.parse_args()
+  if args.input == '':
+    parser.print_help()
+    exit(0)
+  return args
+
+###############################################################################
+#
+#  load the data from CSV file and creating output directory
+#
+###############################################################################
+
+def load_metrix_data(csv_path):
+  '''load the raw data as stored in CSV file'''
+  return pd.read_csv(csv_path)
+
+def make_output_folder(outdir, model):
+  name = os.path.join(outdir, 'nested_cv', model)
+  os.makedirs(name, exist_ok=True)
+  return name
+
+def select_features(metrix, label, features=None):
+  '''Feature matrix and labels; without a feature list every numeric column
+  except the *_success label columns is used; missing values become 0 as in
+  the trainers'''
+  if not features:
+    numeric = metrix.select_dtypes(include=[np.number]).columns
+    features = [column for column in numeric if not column.endswith('_success')]
+  return metrix[features].fillna(0), metrix[label].values
+
+###############################################################################
+#
+#  one outer fold
+#
+###############################################################################
+
+def outer_fold(data_file, model, fold, train, test, inner_cv, n_iter):
+  '''Run the randomised search on the outer training fold and score the best
+  estimator on the outer test fold; top level function so it can run in a
+  worker process.
+  ******
+  Input: joblib file with X and y, model name, (repeat, fold) numbers, outer
+         train and test indices, number of inner folds, search iterations
+  Output: dict with the outer scores, the inner best score and the chosen
+          parameters
+  '''
+  X, y = load(data_file, mmap_mode='r')
+  estimator, space = search_space(model)
+  space = clip_features(space, X.shape[1])
+  search = RandomizedSearchCV(estimator, space, cv=StratifiedKFold(n_splits=inner_cv),
+                              scoring='accuracy', n_iter=n_iter, random_state=5,
+                              n_jobs=1)
+  search.fit(X[train], y[train])
+
+  y_pred = search.best_estimator_.predict(X[test])
+  y_score = positive_scores(search.best_estimator_, X[test])
+  return {'repeat': fold[0],
+          'fold': fold[1],
+          'n_train': len(train),
+          'n_test': len(test),
+          'inner_best_score': search.best_score_,
+          'accuracy': metrics.accuracy_score(y[test], y_pred),
+          'roc_auc': metrics.roc_auc_score(y[test], y_score),
+          'precision': metrics.precision_score(y[test], y_pred),
+          'recall': metrics.recall_score(y[test], y_pred),
+          'f1': metrics.f1_score(y[test], y_pred),
+          'best_params': search.best_params_}
+
+###############################################################################
+#
+#  nested cross-validation
+#
+###############################################################################
+
+def nested_cv(X, y, model, n_splits=5, n_repeats=2, inner_cv=3, n_iter=500,
+              n_jobs=-1, random_state=42):
+  '''Nested cross-validation of the randomised search of a trainer.
+  ******
+  Input: feature matrix, labels, one of MODELS, outer folds, outer repeats,
+         inner folds, search iterations per outer fold, parallel outer folds,
+         seed of the outer split
+  Output: dataframe with one row per outer fold
+  '''
+  X = np.asarray(X, dtype=np.float64)
+  y = np.asarray(y)
+  outer = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats,
+                                  random_state=random_state)
+  temp_dir = tempfile.mkdtemp(prefix='nested_cv_')
+  try:
+    data_file = os.path.join(temp_dir, 'data.joblib')
+    dump((X, y), data_file)
+    rows = Parallel(n_jobs=n_jobs)(
+      delayed(outer_fold)(data_file, model, divmod(k, n_splits), train, test,
+                          inner_cv, n_iter)
+      for k, (train, test) in enumerate(outer.split(X, y)))
+  finally:
+    shutil.rmtree(temp_dir, ignore_errors=True)
+  return pd.DataFrame(rows)
+
+def summarise_scores(folds):
+  '''Mean, standard deviation, minimum and maximum of the outer scores'''
+  scores = folds[['accuracy', 'roc_auc', 'precision', 'recall', 'f1', 'inner_best_score']]
+  return scores.agg(['mean', 'std', 'min', 'max']).T
+
+def summarise_params(folds):
+  '''How the chosen hyperparameters vary across outer folds; numeric
+  parameters get mean, std, min and max, others the count of each value'''
+  #read the values from the dicts; a dataframe would turn a class_weight of
+  #None into NaN
+  chosen = list(folds['best_params'])
+  names = sorted(set(name for params in chosen for name in params))
+  rows = []
+  for name in names:
+    values = [params.get(name) for params in chosen]
+    numeric = all(isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+                  for value in values)
+    if numeric:
+      values = np.asarray(values, dtype=np.float64)
+      rows.append({'parameter': name, 'mean': values.mean(), 'std': values.std(ddof=1),
+                   'min': values.min(), 'max': values.max()})
+    else:
+      counts = pd.Series([str(value) for value in values]).value_counts()
+      rows.append({'parameter': name,
+                   'counts': ', '.join('%s: %s' %item for item in counts.items())})
+  return pd.DataFrame(rows, columns=['parameter', 'mean', 'std', 'min', 'max', 'counts'])
+
+def run():
+  args = parse_command_line()
+
+  metrix = load_metrix_data(args.input)
+  output_dir = make_output_folder(args.outdir, args.model)
+  features = [name.strip() for name in args.features.split(',') if name.strip()]
+  X, y = select_features(metrix, args.label, features)
+
+  with open(os.path.join(output_dir, 'nested_cv.txt'), 'a') as text_file:
+    text_file.write('Nested CV of %s on %s samples and features %s \n'
+                    %(args.model, len(y), list(X.columns)))
+    text_file.write('outer: %s x %s-fold stratified, inner: %s-fold randomised search with %s iterations \n'
+                    %(args.n_repeats, args.n_splits, args.inner_cv, args.n_iter))
+
+  folds = nested_cv(X, y, args.model, args.n_splits, args.n_repeats, args.inner_cv,
+                    args.n_iter, args.n_jobs, args.random_state)
+  scores = summarise_scores(folds)
+  params = summarise_params(folds)
+
+  datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+  folds.to_csv(os.path.join(output_dir, 'nested_cv_folds_'+datestring+'.csv'), index=False)
+  scores.to_csv(os.path.join(output_dir, 'nested_cv_scores_'+datestring+'.csv'))
+  params.to_csv(os.path.join(output_dir, 'nested_cv_params_'+datestring+'.csv'), index=False)
+
+  with open(os.path.join(output_dir, 'nested_cv.txt'), 'a') as text_file:
+    text_file.write('Outer fold scores: \n%s \n' %scores.to_string())
+    text_file.write('Chosen parameters across outer folds: \n%s \n' %params.to_string())
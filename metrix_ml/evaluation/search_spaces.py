@@ -0,0 +1,119 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Estimators and randomised search spaces of the newdata_minusEP trainers in
+one place, so evaluation runners search exactly what the trainers search;
+the SVMs are wrapped in a pipeline so standardisation is fitted inside
+every fold'''
+import numpy as np
+from scipy.stats import expon, randint, uniform
+from sklearn.ensemble import (AdaBoostClassifier, BaggingClassifier,
+                              ExtraTreesClassifier, RandomForestClassifier)
+from sklearn.naive_bayes import GaussianNB
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+from sklearn.tree import DecisionTreeClassifier
+
+MODELS = ('decisiontree', 'decisiontree_ada', 'decisiontree_bag', 'randomforest',
+          'extreme_randomforest', 'svm_rbf', 'svm_linear', 'kneighbors',
+          'naive_bayes')
+
+def search_space(model):
+  '''Unfitted estimator and parameter distributions of a trainer.
+  ******
+  Input: one of MODELS
+  Output: estimator, dict of parameter distributions for RandomizedSearchCV
+  '''
+  if model == 'decisiontree':
+    return (DecisionTreeClassifier(random_state=100, class_weight='balanced'),
+            {"criterion": ["gini", "entropy"],
+             'max_features': randint(2, 48),
+             "min_samples_split": randint(2, 20),
+             "max_depth": randint(3, 10),
+             "min_samples_leaf": randint(1, 20),
+             "max_leaf_nodes": randint(10, 20)})
+  if model == 'decisiontree_ada':
+    clf1 = DecisionTreeClassifier(random_state=0, class_weight='balanced')
+    return (AdaBoostClassifier(base_estimator=clf1, algorithm="SAMME.R", random_state=100),
+            {"base_estimator__criterion": ["gini", "entropy"],
+             'base_estimator__class_weight': ['balanced', None],
+             'base_estimator__max_features': randint(2, 6),
+             'n_estimators': randint(100, 10000),
+             'learning_rate': uniform(0.0001, 1.0),
+             "base_estimator__min_samples_split": randint(2, 20),
+             "base_estimator__max_depth": randint(1, 10),
+             "base_estimator__min_samples_leaf": randint(1, 20),
+             "base_estimator__max_leaf_nodes": randint(10, 20)})
+  if model == 'decisiontree_bag':
+    clf1 = DecisionTreeClassifier(random_state=0, class_weight='balanced')
+    return (BaggingClassifier(base_estimator=clf1, bootstrap=True, random_state=100),
+            {"base_estimator__criterion": ["gini", "entropy"],
+             'base_estimator__class_weight': ['balanced', None],
+             'n_estimators': randint(100, 10000),
+             'base_estimator__max_features': randint(2, 48),
+             "base_estimator__min_samples_split": randint(2, 20),
+             "base_estimator__max_depth": randint(5, 10),
+             "base_estimator__min_samples_leaf": randint(1, 20),
+             "base_estimator__max_leaf_nodes": randint(10, 20)})
+  if model == 'randomforest':
+    return (RandomForestClassifier(random_state=0, class_weight='balanced'),
+            {"criterion": ["gini", "entropy"],
+             'class_weight': ['balanced', None],
+             'n_estimators': randint(100, 10000),
+             'max_features': randint(2, 48),
+             "min_samples_split": randint(2, 20),
+             "max_depth": randint(5, 10),
+             "min_samples_leaf": randint(1, 20),
+             "max_leaf_nodes": randint(10, 20)})
+  if model == 'extreme_randomforest':
+    return (ExtraTreesClassifier(random_state=100, max_depth=1),
+            {"criterion": ["gini", "entropy"],
+             'class_weight': ['balanced', None],
+             'n_estimators': randint(100, 10000),
+             'max_features': randint(2, 48),
+             "min_samples_split": randint(2, 20),
+             "min_samples_leaf": randint(1, 20),
+             "max_leaf_nodes": randint(10, 20)})
+  if model in ('svm_rbf', 'svm_linear'):
+    kernel = model.split('_')[1]
+    space = {'svc__class_weight': ['balanced', None],
+             'svc__C': expon(scale=100)}
+    if kernel == 'rbf':
+      space['svc__gamma'] = expon(scale=.1)
+    return (Pipeline([('scaler', StandardScaler()),
+                      ('svc', SVC(kernel=kernel, probability=False, random_state=100))]),
+            space)
+  if model == 'kneighbors':
+    return (KNeighborsClassifier(),
+            {'n_neighbors': randint(2, 10),
+             'weights': ['uniform', 'distance'],
+             'algorithm': ['auto', 'ball_tree', 'kd_tree', 'brute'],
+             'leaf_size': randint(2, 50)})
+  if model == 'naive_bayes':
+    return (GaussianNB(priors=None, var_smoothing=1e-09),
+            {'var_smoothing': uniform(0.000000000001, 10.0)})
+  raise ValueError('unknown model %s, use one of %s' %(model, ', '.join(MODELS)))
+
+def clip_features(space, n_features):
+  '''Limit max_features distributions to the number of columns present, for
+  feature sets smaller than the 48 columns the spaces were written for'''
+  clipped = dict(space)
+  for name, dist in space.items():
+    if name.endswith('max_features') and hasattr(dist, 'support'):
+      low, high = dist.support()
+      clipped[name] = randint(min(low, n_features), min(high, n_features) + 1)
+  return clipped
+
+def positive_scores(model, X):
+  '''Scores for class 1: probabilities where the model has them, else the
+  decision function'''
+  if hasattr(model, 'predict_proba'):
+    try:
+      return model.predict_proba(X)[:, 1]
+    except AttributeError:
+      pass
+  return np.asarray(model.decision_function(X))
@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 import matplotlib.pyplot as plt
 import numpy as np
@@ -16,10 +15,8 @@ from sklearn import metrics
 from mlxtend.plotting import plot_decision_regions
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import cross_val_predict
@@ -27,10 +24,21 @@ from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import expon
 from scipy.stats import randint
 from scipy.stats import uniform
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.importance import permutation_report
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -56,6 +64,52 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -69,8 +123,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
 
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -115,6 +169,7 @@ class Kneighbors(object):
   #
   ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframes for directly after dataprocessing, after
        adding some protein information and after carrying out some custom solumn
@@ -216,6 +271,7 @@ class Kneighbors(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -234,7 +290,7 @@ class Kneighbors(object):
 #    X_transform_train, X_transform_test, y_train, y_test = train_test_split(self.X_transform, y, test_size=0.2, random_state=42)
 
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_newdata_tummy, y, test_size=0.2, random_state=42, stratify=y)
+    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_newdata_tummy, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_newdata_tummy.columns.all() == X_newdata_transform_train.columns.all()
     
@@ -259,6 +315,7 @@ class Kneighbors(object):
     #
     ###############################################################################
 
+  @stage
   def grid_search(self):
     '''running a randomized search to find the parameter combination for a SVM
      which gives the best accuracy score'''
@@ -286,7 +343,7 @@ class Kneighbors(object):
     #building and running the grid search
     rand_search = RandomizedSearchCV(knc, param_rand, cv=3, scoring='accuracy', random_state=5, n_iter=500)
 
-    rand_search_transform = rand_search.fit(self.X_newdata_transform_train, self.y_train)
+    rand_search_transform = run_search(rand_search, self.X_newdata_transform_train, self.y_train, 'kneighbors_randomsearch_newdata_minusEP_tummyfeatures')
     with open(os.path.join(self.newdata_minusEP, 'kneighbors_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_transform.best_params_)+'\n')
       text_file.write('Best score: ' +str(rand_search_transform.best_score_)+'\n')
@@ -299,6 +356,7 @@ class Kneighbors(object):
     #
     ###############################################################################
 
+  @stage
   def knc_best_params(self):
     '''create a new SVM using the best parameter combination found above'''
     print('*' *80)
@@ -351,6 +409,7 @@ class Kneighbors(object):
         text_file.write(str(feature)+'\n')
       text_file.close()
 
+    @stage
     def feature_importances_best_estimator(feature_list, name, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       feature_list.sort(key=lambda x: x[1], reverse=True)
@@ -369,9 +428,10 @@ class Kneighbors(object):
     feature_importances_best_estimator(feature_importance2, 'newdata_minusEP', self.newdata_minusEP)
 
       
+    @stage
     def write_pickle(knc, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(knc, os.path.join(directory,'best_knc_'+name+datestring+'.pkl'))
+      registry_dump(knc, os.path.join(directory,'best_knc_'+name+datestring+'.pkl'))
       with open(os.path.join(directory, 'kneighbors_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new KNC "%s" using best parameters \n' %name)
         text_file.write('Creating pickle file for best KNC as best_knc_%s.pkl \n' %name)
@@ -385,6 +445,7 @@ class Kneighbors(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best SVM an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -395,6 +456,7 @@ class Kneighbors(object):
     #try out how well the classifier works to predict from the test set
     #self.y_pred_transform = self.svc_clf_grid_new_transform.predict(self.X_newdata_transform_test)
     self.y_pred_transform = self.knc_best.predict(self.X_newdata_transform_test)
+    registry_test_score(self.knc_best, self.y_test, self.y_pred_transform)
     self.y_pred_proba_transform = self.knc_best.predict_proba(self.X_newdata_transform_test)
     #print(self.y_pred_transform)
     #print(self.y_pred_proba_transform)
@@ -412,6 +474,7 @@ class Kneighbors(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -445,6 +508,7 @@ class Kneighbors(object):
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -467,6 +531,7 @@ class Kneighbors(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -577,9 +642,13 @@ class Kneighbors(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'kneighbors_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
    
+    @stage
     def prediction_probas(svm, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'kneighbors_randomsearch.txt'), 'a') as text_file:
@@ -675,9 +744,18 @@ class Kneighbors(object):
         text_file.write('AUC for CV train set class 1: %s \n' %AUC_train_class1)
 
     prediction_probas(self.knc_best, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
+
+    #permutation importances on the test set; the model has no importances
+    #of its own
+    permutation_report(self.knc_best, self.X_newdata_transform_test, self.y_test,
+                       'newdata_minusEP', self.newdata_minusEP, 'kneighbors_randomsearch.txt',
+                       self.X_newdata_tummy.columns)
+
+    bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'kneighbors_randomsearch.txt')
     
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
   ###############################################################################
@@ -686,8 +764,16 @@ def run():
   metrix = load_metrix_data(args.input)
   
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(newdata_minusEP, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
   ###############################################################################
 
-  svm_grid_search = Kneighbors(metrix, newdata_minusEP, bbbb)
-
+  try:
+    svm_grid_search = Kneighbors(metrix, newdata_minusEP, bbbb)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'kneighbors_randomsearch_newdata_minusEP_tummyfeatures')
+    close_profiler()
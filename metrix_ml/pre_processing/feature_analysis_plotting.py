@@ -7,17 +7,12 @@
 import argparse
 import os
 
-import matplotlib
-matplotlib.use("Agg")
-
-import matplotlib.pyplot as plt
 import csv
 import pathlib
-import numpy as np
 import pandas as pd
-import seaborn as sns
 from datetime import datetime
 from sklearn.model_selection import train_test_split
+from metrix_ml.pre_processing.feature_profiling import feature_stats, plot_features
 
 ###############################################################################
 #
@@ -43,6 +38,20 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--dpi',
+    type=int,
+    dest='dpi',
+    default=150,
+    help='Resolution of the saved plots')
+
+  parser.add_argument(
+    '--n_jobs',
+    type=int,
+    dest='n_jobs',
+    default=-1,
+    help='Number of processes used to render the plots')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -79,15 +88,16 @@ class FeatureAnalysisPlotting(object):
   any strings or NaN values; also remove any columns with 
   categorical data or transform them first; remove any text except column labels'''
 
-  def __init__(self, data, feature_analysis_plotting):
+  def __init__(self, data, feature_analysis_plotting, dpi=150, n_jobs=-1):
     self.data = data
     self.feature_analysis_plotting = feature_analysis_plotting
+    self.dpi = dpi
+    self.n_jobs = n_jobs
     self.prepare_metrix_data()
     self.split_data()
     self.create_itter()
-    self.plot_hist()
-    self.plot_ecdf()
-    self.plot_density()
+    self.profile_features()
+    self.plot_features()
    
   ###############################################################################
   #
@@ -250,116 +260,48 @@ class FeatureAnalysisPlotting(object):
 
 ################################################################################
 #
-#  plotting histogram for each feature
+#  calculating the basic stats for all features in one pass
 #
 ################################################################################
 
-  def plot_hist(self):
-    '''Plot a histogram for each feature.'''
+  def profile_features(self):
+    '''Calculate mean, median, std and percentiles for all features at once
+    and write them as one table.'''
     print('*' *80)
-    print('*    Plotting histogram for each feature')
-    print('*' *80)
-    
-    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-    for name in self.itter:
-      print(name)
-      hist = plt.hist(self.X_data_transform_train[name], bins=365)#20
-      hist = plt.xlabel(name)
-      hist = plt.ylabel('number of counts')
-      plt.savefig(os.path.join(self.feature_analysis_plotting, 'histogram_feature_'+name+'_'+datestring+'.png'), dpi=600)
-      plt.close()
-      with open(os.path.join(self.feature_analysis_plotting, 'feature_analysis_plotting.txt'), 'a') as text_file:
-        text_file.write('Drawing histogram for feature %s \n' %name)
-      
-################################################################################
-#
-#  plotting empirical cumulative distribution function for each feature
-#
-################################################################################
-      
-  def plot_ecdf(self):
-    '''Plot empirical cumulative distribution function (ECDF) for each feature.'''
-    print('*' *80)
-    print('*    Plotting ECDF for each feature')
+    print('*    Calculating basic stats for each feature')
     print('*' *80)
 
     datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-    
-    for name in self.itter:
-      print(name)
-      '''Compute ECDF for a one-dimensional array of measurements'''
-      with open(os.path.join(self.feature_analysis_plotting, 'feature_analysis_plotting.txt'), 'a') as text_file:
-        text_file.write('Drawing ECDF for feature %s \n' %name)
-      #Number of data points:n
-      n = len(self.X_data_transform[name])
-      #x-data for the ECDF:x
-      x = np.sort(self.X_data_transform[name])
-      #y-data for the ECDF;y
-      y = np.arange(1, n+1)/n
-      mean = np.mean(self.X_data_transform[name])
-      median = np.median(self.X_data_transform[name])
-      std = np.std(self.X_data_transform[name])
-      percentile = np.percentile(self.X_data_transform[name], [25, 50, 75])
-      info = self.X_data_transform[name].describe()
-      samples = np.random.normal(mean, std, size=10000)
-      n_theor = len(samples)
-      x_theor = np.sort(samples)
-      y_theor = np.arange(1, n_theor+1)/n_theor
-
-     
-      with open(os.path.join(self.feature_analysis_plotting, 'feature_analysis_plotting.txt'), 'a') as text_file:
-        text_file.write('The basic stats for feature %s are: \n' %name)
-        text_file.write('mean: '+str(info[1])+'\n')
-        text_file.write('median: '+str(median)+'\n')
-        text_file.write('std: '+str(info[2])+'\n')
-        text_file.write('min: '+str(info[3])+'\n')
-        text_file.write('25%: '+str(info[4])+'\n')
-        text_file.write('50%: '+str(info[5])+'\n')
-        text_file.write('75%: '+str(info[6])+'\n')
-        text_file.write('max: '+str(info[7])+'\n')
-      plt.plot(x, y, marker='.', linestyle='none', label='observed CDF')
-      plt.plot(x_theor, y_theor, label='theoretical CDF')
-      plt.axvline(mean, label='Mean', color='r', linestyle='--')
-      plt.axvline(median, label='Median', color='g', linestyle='--')
-      plt.text(mean, 0.9, 'Mean: %.2f' %mean)
-      plt.text(median, 0.8, 'Median: %.2f' %median)
-      plt.xlabel(name)
-      plt.ylabel('(E)CDF')
-      plt.margins(0.02)
-      plt.legend(loc='best')
-      plt.savefig(os.path.join(self.feature_analysis_plotting, 'ECDF_feature_'+name+'_'+datestring+'.png'), dpi=600)
-      plt.close()
+
+    self.stats = feature_stats(self.X_data_transform_train)
+    self.stats.to_csv(os.path.join(self.feature_analysis_plotting, 'feature_stats_'+datestring+'.csv'), index=False)
+
+    with open(os.path.join(self.feature_analysis_plotting, 'feature_analysis_plotting.txt'), 'a') as text_file:
+      text_file.write('The basic stats for all features are: \n')
+      text_file.write(self.stats.to_string(index=False)+'\n')
 
 ################################################################################
 #
-#  plotting probability density function for each feature to evaluate continous
-#  data and its cumulative distribution function
+#  plotting histogram, empirical cumulative distribution function and
+#  probability density function for each feature
 #
 ################################################################################
 
-  def plot_density(self):
-    '''Plot probability density function (PDF) for each feature.'''
+  def plot_features(self):
+    '''Plot histogram, ECDF and density curve for each feature using a pool
+    of worker processes.'''
     print('*' *80)
-    print('*    Plotting density curve for each feature')
+    print('*    Plotting histogram, ECDF and density curve for each feature')
     print('*' *80)
 
     datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-    
-    for name in self.itter:
-      '''Compute ECDF for a one-dimensional array of measurements'''
-      with open(os.path.join(self.feature_analysis_plotting, 'feature_analysis_plotting.txt'), 'a') as text_file:
-        text_file.write('Drawing ECDF for feature %s and its calculated theoretical curve\n' %name)
-      mean = np.mean(self.X_data_transform[name])
-      median = np.median(self.X_data_transform[name])      
-      sns.distplot(self.X_data_transform[name], hist = False, kde = True,
-                 kde_kws = {'linewidth': 3})  
-      plt.axvline(mean, label='Mean', color='r', linestyle='--')  
-      plt.axvline(median, label='Median', color='g', linestyle='--')        
-      plt.legend(loc='best')
-      plt.xlabel(name)
-      plt.ylabel('Density')
-      plt.savefig(os.path.join(self.feature_analysis_plotting, 'Density_feature_'+name+'_'+datestring+'.png'), dpi=600)
-      plt.close()
+
+    plotted = plot_features(self.X_data_transform_train[self.itter], self.stats, self.feature_analysis_plotting,
+                            datestring, dpi=self.dpi, bins=365, n_jobs=self.n_jobs)
+
+    with open(os.path.join(self.feature_analysis_plotting, 'feature_analysis_plotting.txt'), 'a') as text_file:
+      for name in plotted:
+        text_file.write('Drawing histogram, ECDF and density for feature %s \n' %name)
 
 def run():
   args = parse_command_line()
@@ -374,5 +316,5 @@ def run():
 
   ###############################################################################
 
-  feature_analysis_plotting = FeatureAnalysisPlotting(data, feature_analysis_plotting)
+  feature_analysis_plotting = FeatureAnalysisPlotting(data, feature_analysis_plotting, args.dpi, args.n_jobs)
 
@@ -15,6 +15,7 @@ import seaborn as sns
 from datetime import datetime
 from scipy.stats import pearsonr#, betai
 from sklearn.model_selection import train_test_split
+from metrix_ml.pre_processing.pair_density import plot_pair_density, stratified_subsample
 
 ###############################################################################
 #
@@ -40,6 +41,48 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--features',
+    type=str,
+    nargs='+',
+    dest='features',
+    default=None,
+    help='Subset of features to plot; default all')
+
+  parser.add_argument(
+    '--binned',
+    dest='binned',
+    action='store_true',
+    help='Plot binned 2D histograms per panel instead of every sample')
+
+  parser.add_argument(
+    '--n_per_class',
+    type=int,
+    dest='n_per_class',
+    default=None,
+    help='Stratified subsampling; maximum number of samples per class')
+
+  parser.add_argument(
+    '--bins',
+    type=int,
+    dest='bins',
+    default=50,
+    help='Number of bins per feature for the binned pair plot')
+
+  parser.add_argument(
+    '--tile_size',
+    type=int,
+    dest='tile_size',
+    default=8,
+    help='Number of panels per tile side for the binned pair plot')
+
+  parser.add_argument(
+    '--n_jobs',
+    type=int,
+    dest='n_jobs',
+    default=-1,
+    help='Number of processes used to render the tiles')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -76,12 +119,22 @@ class FeaturePairPlot(object):
   any strings or NaN values; also remove any columns with 
   categorical data or transform them first; remove any text except column labels'''
 
-  def __init__(self, metrix, output_dir):
+  def __init__(self, metrix, output_dir, features=None, binned=False,
+               n_per_class=None, bins=50, tile_size=8, n_jobs=-1):
     self.metrix = metrix
     self.output_dir = output_dir
+    self.features = features
+    self.n_per_class = n_per_class
+    self.bins = bins
+    self.tile_size = tile_size
+    self.n_jobs = n_jobs
     self.prepare_metrix_data()
     self.split_data()
-    self.plot_pair()
+    self.select_features()
+    if binned:
+      self.plot_pair_binned()
+    else:
+      self.plot_pair()
    
 ###############################################################################
 #
@@ -141,6 +194,30 @@ class FeaturePairPlot(object):
     self.y_train = y_train
     self.y_test = y_test
 
+################################################################################
+#
+#  selecting feature subset and subsampling per class
+#
+################################################################################
+
+  def select_features(self):
+    '''Restrict the training set to the requested features and, if asked for,
+    to at most n_per_class samples of each class.'''
+    if self.features is not None:
+      missing = [f for f in self.features if f not in self.X_metrix_train.columns]
+      if missing:
+        raise ValueError('Unknown features requested: %s' %missing)
+      self.X_metrix_train = self.X_metrix_train[self.features + ['MR_success']]
+
+    if self.n_per_class is not None:
+      keep = stratified_subsample(self.y_train, self.n_per_class)
+      self.X_metrix_train = self.X_metrix_train.iloc[keep]
+      self.y_train = self.y_train.iloc[keep]
+
+    with open(os.path.join(self.output_dir, 'feature_pair_plot.txt'), 'a') as text_file:
+      text_file.write('Plotting %s samples with features %s \n'
+                       %(len(self.X_metrix_train), list(self.X_metrix_train.columns)))
+
 ################################################################################
 #
 #  plotting feature pairs
@@ -173,7 +250,22 @@ class FeaturePairPlot(object):
     plt.tight_layout()
     plt.savefig(os.path.join(self.output_dir, 'pairplot_'+datestring+'.png'))
     plt.close()
-    
+
+  def plot_pair_binned(self):
+    '''Plot every feature pair as a binned 2D histogram; the grid is split
+    into tiles which are rendered in parallel.'''
+    print('*' *80)
+    print('*    Plotting binned feature pairs')
+    print('*' *80)
+
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    tiles = plot_pair_density(self.X_metrix_train.drop('MR_success', axis=1), self.y_train,
+                              self.output_dir, datestring, bins=self.bins,
+                              tile_size=self.tile_size, n_jobs=self.n_jobs)
+
+    with open(os.path.join(self.output_dir, 'feature_pair_plot.txt'), 'a') as text_file:
+      text_file.write('Created binned pair plot tiles %s \n' %tiles)
+
 def run():
   args = parse_command_line()
   
@@ -187,5 +279,7 @@ def run():
 
   ###############################################################################
 
-  feature_pair_plot = FeaturePairPlot(metrix, output_dir)
+  feature_pair_plot = FeaturePairPlot(metrix, output_dir, args.features, args.binned,
+                                      args.n_per_class, args.bins, args.tile_size,
+                                      args.n_jobs)
 
@@ -0,0 +1,122 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Per-feature statistics and plots shared by the feature analysis scripts;
+all statistics come from one vectorised pass over the feature matrix and the
+plots for each feature are rendered in a separate process'''
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import seaborn as sns
+from joblib import Parallel, delayed
+from scipy.stats import norm
+
+###############################################################################
+#
+#  statistics for all features in one pass
+#
+###############################################################################
+
+def feature_stats(X):
+  '''Calculate the basic stats for every column of a dataframe at once.
+  ******
+  Input: dataframe with one feature per column
+  Output: tidy dataframe with one row per feature and the columns count, mean,
+          std, min, 25%, 50%, 75%, max, median
+  '''
+  values = X.values.astype(np.float64)
+  count = np.count_nonzero(~np.isnan(values), axis=0)
+  mean = np.nanmean(values, axis=0)
+  #ddof=1 to match pandas describe()
+  std = np.nanstd(values, axis=0, ddof=1)
+  quantiles = np.nanpercentile(values, [0, 25, 50, 75, 100], axis=0)
+
+  stats = pd.DataFrame({'feature': X.columns,
+                        'count': count,
+                        'mean': mean,
+                        'std': std,
+                        'min': quantiles[0],
+                        '25%': quantiles[1],
+                        '50%': quantiles[2],
+                        '75%': quantiles[3],
+                        'max': quantiles[4],
+                        'median': quantiles[2]})
+  return stats
+
+###############################################################################
+#
+#  plotting histogram, ECDF and density for a single feature
+#
+###############################################################################
+
+def plot_feature(name, values, stats, output_dir, datestring, dpi=150, bins=20):
+  '''Draw histogram, ECDF with the analytic normal CDF and density curve for
+  one feature; top level function so it can be sent to a worker process
+  ******
+  Input: feature name, 1D array of values, dict of that feature's stats,
+         output directory, datestring for file names, resolution, histogram bins
+  Output: three PNG files in output_dir
+  '''
+  mean = stats['mean']
+  median = stats['median']
+  std = stats['std']
+  #file names must not contain path separators
+  file_name = name.replace('/', '_')
+
+  plt.hist(values, bins=bins)
+  plt.xlabel(name)
+  plt.ylabel('number of counts')
+  plt.savefig(os.path.join(output_dir, 'histogram_feature_'+file_name+'_'+datestring+'.png'), dpi=dpi)
+  plt.close()
+
+  n = len(values)
+  x = np.sort(values)
+  y = np.arange(1, n+1)/n
+  #theoretical CDF evaluated analytically at the observed points instead of
+  #sampling from a normal distribution
+  y_theor = norm.cdf(x, loc=mean, scale=std) if std > 0 else (x >= mean).astype(float)
+
+  plt.plot(x, y, marker='.', linestyle='none', label='observed CDF')
+  plt.plot(x, y_theor, label='theoretical CDF')
+  plt.axvline(mean, label='Mean', color='r', linestyle='--')
+  plt.axvline(median, label='Median', color='g', linestyle='--')
+  plt.text(mean, 0.9, 'Mean: %.2f' %mean)
+  plt.text(median, 0.8, 'Median: %.2f' %median)
+  plt.xlabel(name)
+  plt.ylabel('(E)CDF')
+  plt.margins(0.02)
+  plt.legend(loc='best')
+  plt.savefig(os.path.join(output_dir, 'ECDF_feature_'+file_name+'_'+datestring+'.png'), dpi=dpi)
+  plt.close()
+
+  sns.distplot(values, hist = False, kde = True,
+               kde_kws = {'linewidth': 3})
+  plt.axvline(mean, label='Mean', color='r', linestyle='--')
+  plt.axvline(median, label='Median', color='g', linestyle='--')
+  plt.legend(loc='best')
+  plt.xlabel(name)
+  plt.ylabel('Density')
+  plt.savefig(os.path.join(output_dir, 'Density_feature_'+file_name+'_'+datestring+'.png'), dpi=dpi)
+  plt.close()
+  return name
+
+def plot_features(X, stats, output_dir, datestring, dpi=150, bins=20, n_jobs=-1):
+  '''Render the plots for all features through a process pool.
+  ******
+  Input: dataframe with one feature per column, output of feature_stats,
+         output directory, datestring, resolution, histogram bins, number of
+         worker processes
+  Output: list of feature names that were plotted
+  '''
+  stats = stats.set_index('feature')
+  return Parallel(n_jobs=n_jobs)(
+           delayed(plot_feature)(name, X[name].values, stats.loc[name].to_dict(),
+                                 output_dir, datestring, dpi, bins)
+           for name in X.columns)
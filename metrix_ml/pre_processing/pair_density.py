@@ -0,0 +1,157 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Aggregated pair plots for large feature sets; instead of drawing every
+sample in every panel the samples are binned once per feature and each panel
+shows a 2D histogram; panels are grouped into tiles which are rendered in
+separate processes'''
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+from joblib import Parallel, delayed
+
+###############################################################################
+#
+#  sampling and binning
+#
+###############################################################################
+
+def stratified_subsample(y, n_per_class, random_state=42):
+  '''Select at most n_per_class samples of every class.
+  ******
+  Input: 1D array of class labels, maximum number of samples per class, seed
+  Output: sorted array of row positions
+  '''
+  y = np.asarray(y)
+  rng = np.random.RandomState(random_state)
+  keep = []
+  for label in np.unique(y):
+    rows = np.flatnonzero(y == label)
+    if len(rows) > n_per_class:
+      rows = rng.choice(rows, n_per_class, replace=False)
+    keep.append(rows)
+  return np.sort(np.concatenate(keep))
+
+def bin_features(values, bins=50):
+  '''Assign every value to one of the equally spaced bins of its column.
+  ******
+  Input: 2D array samples x features, number of bins
+  Output: 2D int array of bin indices, 2D array of bin edges features x bins+1
+  '''
+  values = np.asarray(values, dtype=np.float64)
+  low = np.nanmin(values, axis=0)
+  high = np.nanmax(values, axis=0)
+  width = np.where(high > low, high - low, 1.0)
+  index = np.floor((values - low) / width * bins)
+  index = np.nan_to_num(index).clip(0, bins - 1).astype(np.intp)
+  edges = low[:, None] + width[:, None] * np.linspace(0, 1, bins + 1)[None, :]
+  return index, edges
+
+def pair_counts(index, y, bins=50):
+  '''Count the samples per bin for every feature pair and per bin and class
+  for every single feature; each count is a single bincount over the
+  combined bin index of the pair.
+  ******
+  Input: output of bin_features, class labels, number of bins
+  Output: dict with 'pairs' (features x features x bins x bins, lower triangle
+          filled), 'diag' (classes x features x bins) and 'classes'
+  '''
+  y = np.asarray(y)
+  n_features = index.shape[1]
+  pairs = np.zeros((n_features, n_features, bins, bins), dtype=np.int32)
+  for i in range(1, n_features):
+    #all pairs (i, j < i) in one bincount by offsetting every pair
+    combined = index[:, i, None] * bins + index[:, :i]
+    combined += np.arange(i) * bins * bins
+    counts = np.bincount(combined.ravel(), minlength=i * bins * bins)
+    pairs[i, :i] = counts.reshape(i, bins, bins)
+
+  classes = np.unique(y)
+  diag = np.zeros((len(classes), n_features, bins), dtype=np.int32)
+  offset = np.arange(n_features) * bins
+  for k, label in enumerate(classes):
+    rows = index[y == label] + offset
+    diag[k] = np.bincount(rows.ravel(), minlength=n_features * bins).reshape(n_features, bins)
+  return {'pairs': pairs, 'diag': diag, 'classes': classes}
+
+###############################################################################
+#
+#  rendering
+#
+###############################################################################
+
+def plot_tile(rows, cols, names, pairs, diag, classes, edges, corr, output_dir,
+              name, dpi=150):
+  '''Render one tile of the pair plot grid; top level function so it can be
+  sent to a worker process; only the counts of this tile are passed in
+  ******
+  Input: feature positions for the tile rows and columns, all feature names,
+         pair counts rows x cols x bins x bins, diagonal counts classes x rows x
+         bins, class labels, bin edges, Pearson correlation matrix, output
+         directory, file name, resolution
+  Output: PNG file in output_dir
+  '''
+  fig, axes = plt.subplots(len(rows), len(cols), squeeze=False,
+                           figsize=(2 * len(cols), 2 * len(rows)))
+  for r, i in enumerate(rows):
+    for c, j in enumerate(cols):
+      ax = axes[r, c]
+      if j > i:
+        ax.axis('off')
+        continue
+      if i == j:
+        centres = 0.5 * (edges[i, 1:] + edges[i, :-1])
+        for k, label in enumerate(classes):
+          ax.step(centres, diag[k, r], where='mid', label=str(label))
+      else:
+        ax.imshow(np.log1p(pairs[r, c]), origin='lower', aspect='auto',
+                  cmap='Greys', extent=(edges[j, 0], edges[j, -1], edges[i, 0], edges[i, -1]))
+        ax.annotate('r = {:.2f}'.format(corr[i, j]), xy=(.05, .9),
+                    xycoords='axes fraction', fontsize=6)
+      ax.tick_params(labelsize=5)
+      if c == 0:
+        ax.set_ylabel(names[i], fontsize=6)
+      if r == len(rows) - 1:
+        ax.set_xlabel(names[j], fontsize=6)
+  handles, labels = axes[-1, -1].get_legend_handles_labels()
+  if handles:
+    fig.legend(handles=handles, labels=labels, loc='upper center', ncol=len(labels))
+  fig.tight_layout()
+  fig.savefig(os.path.join(output_dir, name), dpi=dpi)
+  plt.close(fig)
+  return name
+
+def plot_pair_density(X, y, output_dir, datestring, bins=50, tile_size=8,
+                      dpi=150, n_jobs=-1):
+  '''Bin the features once, count every pair and render the lower triangle
+  of the pair plot grid as tiles in parallel.
+  ******
+  Input: dataframe with one feature per column, class labels, output directory,
+         datestring, number of bins, panels per tile side, resolution, number
+         of worker processes
+  Output: list of tile file names
+  '''
+  names = list(X.columns)
+  values = X.values.astype(np.float64)
+  index, edges = bin_features(values, bins)
+  counts = pair_counts(index, y, bins)
+  #all Pearson coefficients in one call instead of one pearsonr per panel
+  with np.errstate(invalid='ignore', divide='ignore'):
+    corr = np.corrcoef(values, rowvar=False)
+
+  blocks = [list(range(start, min(start + tile_size, len(names))))
+            for start in range(0, len(names), tile_size)]
+  tiles = [(rows, cols) for t, rows in enumerate(blocks) for cols in blocks[:t+1]]
+  return Parallel(n_jobs=n_jobs)(
+           delayed(plot_tile)(rows, cols, names, counts['pairs'][np.ix_(rows, cols)],
+                              counts['diag'][:, rows], counts['classes'], edges, corr,
+                              output_dir,
+                              'pairplot_binned_%s_%s_%s.png' %(rows[0], cols[0], datestring),
+                              dpi)
+           for rows, cols in tiles)
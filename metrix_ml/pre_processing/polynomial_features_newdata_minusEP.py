@@ -18,6 +18,7 @@ from sklearn.linear_model import LinearRegression
 from sklearn.linear_model import LassoCV
 from sklearn.pipeline import make_pipeline
 from sklearn.model_selection import learning_curve
+from metrix_ml.utils.importance import tree_importances, tree_importance_matrix
 
 ###############################################################################
 #
@@ -293,8 +294,7 @@ class CreatePolynomialFeatures(object):
       def feature_importances_pandas(clf, X_train, feature_names, directory):   
         datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
         importances = clf.feature_importances_
-        std = np.std([tree.feature_importances_ for tree in clf.estimators_],
-             axis=0)
+        std = tree_importance_matrix(clf).std(axis=0)
         indices = np.argsort(importances)[::-1]
 
         # Plot the feature importances of the forest
@@ -312,14 +312,10 @@ class CreatePolynomialFeatures(object):
     
       def feature_importances_pandas2(clf, X_train, columns, directory):   
         datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
-        feature_list = []
-        for tree in clf.estimators_:
-          feature_importances_ls = tree.feature_importances_
-          feature_list.append(feature_importances_ls)
-        
-        df = pd.DataFrame(feature_list, columns=columns)
-        df_mean = df[columns].mean(axis=0)
-        df_std = df[columns].std(axis=0)
+        #importances of all trees stacked into one array
+        importances = tree_importances(clf, columns)
+        df_mean = importances['mean']
+        df_std = importances['std']
         #df_mean.plot(kind='bar', color='b', yerr=[df_std], align="center", figsize=(20,10), title="Feature importances", rot=60)
         df_mean.plot(kind='bar', color='b', yerr=[df_std], align="center", figsize=(20,10), rot=90, fontsize=4)
         plt.title('Histogram of Feature Importances over all RandomForest using features')
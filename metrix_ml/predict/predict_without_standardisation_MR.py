@@ -7,6 +7,14 @@ import numpy as np
 from pandas import read_csv
 from sklearn.externals import joblib
 from sklearn.preprocessing import StandardScaler
+from metrix_ml.utils.threshold_optimisation import load_threshold
+from metrix_ml.predict.streaming import stream_predict
+
+#columns the model was trained on, in training order
+FEATURES = ['eLLG', 'seq_ident', 'MW_chain']
+
+#class 1 threshold for pickles that do not store their own
+THRESHOLD = 0.9317
 
 ###############################################################################
 #
@@ -39,6 +47,26 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--stream',
+    dest='stream',
+    action='store_true',
+    help='Score the input in chunks and append to results_predict.csv; --input - reads CSV lines from stdin')
+
+  parser.add_argument(
+    '--chunk_size',
+    type=int,
+    dest='chunk_size',
+    default=10000,
+    help='Rows per chunk in streaming mode')
+
+  parser.add_argument(
+    '--keep_columns',
+    type=str,
+    dest='keep_columns',
+    default='',
+    help='Comma separated input columns copied to the streamed results, e.g. dataset names')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -81,6 +109,9 @@ class PredictUnknown(object):
     self.data=data
     self.output_dir=output_dir
     self.model=model   
+    #threshold chosen when the model was trained; older pickles without it
+    #fall back to the value used so far
+    self.threshold=load_threshold(model, THRESHOLD)
     self.prepare_data()
     self.predict()
 
@@ -99,9 +130,7 @@ class PredictUnknown(object):
     print('*' *80)
 
     #database plus manually added data
-    data_initial = ['eLLG', 'seq_ident', 'MW_chain']
-
-    data_initial = self.data[data_initial]  
+    data_initial = self.data[FEATURES]  
     X_data_initial = data_initial.fillna(0)
     self.X_data_initial = X_data_initial
     
@@ -128,14 +157,14 @@ class PredictUnknown(object):
       y_pred_proba = self.model.predict_proba(line.reshape(1, -1))
       fail_prob = round(y_pred_proba[0][0], 4) * 100
       succ_prob = round(y_pred_proba[0][1], 4) * 100
-      y_pred_adj = [1 if x >= 0.9317 else 0 for x in y_pred_proba[:, 1]]
+      y_pred_adj = [1 if x >= self.threshold else 0 for x in y_pred_proba[:, 1]]
 
       with open(os.path.join(self.output_dir, 'results_predict.txt'), 'a') as text_file:
         #text_file.write('Experimental phasing outcome: %s \n' %y_pred)
         text_file.write('Probability for experimental phasing outcome: \n')
         text_file.write('Failure: %.2f \n' %fail_prob)
         text_file.write('Success: %.2f \n' %succ_prob)
-        #text_file.write('Predicted class after applying threshold 93.17%% for class 1: %s \n' %str(y_pred_adj))
+        #text_file.write('Predicted class after applying threshold %.2f%% for class 1: %s \n' %(self.threshold * 100, str(y_pred_adj)))
         text_file.write('*' * 80)
         text_file.write('\n')
       
@@ -143,7 +172,7 @@ class PredictUnknown(object):
       print('Probability for experimental phasing outcome:')
       print('Failure: %s' %fail_prob)
       print('Success: %s' %succ_prob)
-      #print('Predicted class after applying threshold 93.17%% for class 1: %s \n' %str(y_pred_adj))
+      #print('Predicted class after applying threshold %.2f%% for class 1: %s \n' %(self.threshold * 100, str(y_pred_adj)))
       print('*' * 80)
 
   
@@ -171,6 +200,16 @@ class PredictUnknown(object):
   
 def run():
   args = parse_command_line()
+
+  if args.stream:
+    #chunked scoring; the input is never held in memory as a whole
+    model = load_pickle(args.model)
+    predict = make_output_folder(args.outdir)
+    keep_columns = [name.strip() for name in args.keep_columns.split(',') if name.strip()]
+    stream_predict(model, args.input, FEATURES, os.path.join(predict, 'results_predict.csv'),
+                   args.chunk_size, load_threshold(model, THRESHOLD), keep_columns,
+                   standardise=False)
+    return
   
   
   ###############################################################################
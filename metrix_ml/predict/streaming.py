@@ -0,0 +1,71 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Streaming prediction for inputs too large to hold in memory; the input is
+read in chunks of rows, either from a CSV file or as CSV lines from stdin,
+only the model's columns are parsed, every chunk is scored in one call and
+its results are appended to the output before the next chunk is read'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+def read_chunks(source, columns, chunk_size=10000):
+  '''Chunks of rows with only the given columns.
+  ******
+  Input: CSV file name or '-' for stdin, columns to parse, rows per chunk
+  Output: iterator of dataframes
+  '''
+  handle = sys.stdin if source == '-' else source
+  return pd.read_csv(handle, usecols=columns, chunksize=chunk_size)
+
+def fit_scaler(source, features, chunk_size=10000):
+  '''Standardisation of the whole input from running statistics over the
+  chunks, so chunked and in-memory prediction scale the same way; needs a
+  second pass and therefore a file'''
+  if source == '-':
+    raise ValueError('standardised streaming needs an input file, stdin can only be read once')
+  scaler = StandardScaler()
+  for chunk in read_chunks(source, features, chunk_size):
+    scaler.partial_fit(chunk[features].fillna(0).values)
+  return scaler
+
+def score_chunk(model, chunk, features, threshold, keep_columns=(), scaler=None):
+  '''Probabilities and classes of one chunk as a dataframe'''
+  X = chunk[features].fillna(0).values
+  if scaler is not None:
+    X = scaler.transform(X)
+  proba = model.predict_proba(X)
+  result = chunk[list(keep_columns)].copy()
+  result['failure'] = proba[:, 0]
+  result['success'] = proba[:, 1]
+  result['predicted'] = model.classes_[np.argmax(proba, axis=1)]
+  result['predicted_threshold'] = (proba[:, 1] >= threshold).astype(int)
+  return result
+
+def stream_predict(model, source, features, output, chunk_size=10000, threshold=0.5,
+                   keep_columns=(), standardise=False):
+  '''Score an input of any size chunk by chunk; memory is bounded by the
+  chunk size.
+  ******
+  Input: fitted model with predict_proba, CSV file name or '-' for stdin,
+         model features in training order, output CSV, rows per chunk,
+         threshold for class 1, input columns copied to the output,
+         standardise the features with statistics of the whole input
+  Output: number of rows scored; the output CSV is appended to per chunk
+  '''
+  scaler = fit_scaler(source, features, chunk_size) if standardise else None
+  columns = list(features) + [column for column in keep_columns if column not in features]
+  write_header = not os.path.exists(output)
+  n_rows = 0
+  for chunk in read_chunks(source, columns, chunk_size):
+    result = score_chunk(model, chunk, features, threshold, keep_columns, scaler)
+    result.to_csv(output, mode='a', header=write_header, index=False)
+    write_header = False
+    n_rows += len(result)
+    print('*    Scored %s rows' %n_rows)
+  return n_rows
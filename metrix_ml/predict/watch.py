@@ -0,0 +1,241 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Watch mode for prediction; polls a directory for new per-dataset CSV
+files, collects the files arriving within a short window into one batch,
+scores the batch with a model loaded once and appends the results to a
+single output table. A ledger of processed files lets a restarted watcher
+skip everything it has already scored'''
+import argparse
+import csv
+import glob
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from metrix_ml.predict.predict_without_standardisation_MR import (FEATURES, THRESHOLD,
+                                                                  load_pickle,
+                                                                  make_output_folder)
+from metrix_ml.predict.streaming import score_chunk
+from metrix_ml.utils.threshold_optimisation import load_threshold
+
+LEDGER_COLUMNS = ['path', 'size', 'mtime_ns', 'rows', 'status', 'scored']
+
+###############################################################################
+#
+#  define command line arguments
+#
+###############################################################################
+
+def parse_command_line():
+  '''defining the command line input to make it runable'''
+  parser = argparse.ArgumentParser(description='Score new CSV files arriving in a directory')
+
+  parser.add_argument(
+    '--input',
+    type=str,
+    dest='input',
+    default='',
+    help='The directory to watch')
+
+  parser.add_argument(
+    '--model',
+    type=str,
+    dest='model',
+    default='',
+    help='The trained classifier model')
+
+  parser.add_argument(
+    '--outdir',
+    type=str,
+    dest='outdir',
+    default='',
+    help='Specify output directory')
+
+  parser.add_argument(
+    '--pattern',
+    type=str,
+    dest='pattern',
+    default='*.csv',
+    help='File name pattern of the statistics files')
+
+  parser.add_argument(
+    '--interval',
+    type=float,
+    dest='interval',
+    default=5.0,
+    help='Seconds between two looks at the directory')
+
+  parser.add_argument(
+    '--window',
+    type=float,
+    dest='window',
+    default=30.0,
+    help='Seconds new files are collected before the batch is scored')
+
+  parser.add_argument(
+    '--keep_columns',
+    type=str,
+    dest='keep_columns',
+    default='',
+    help='Comma separated input columns copied to the results, e.g. dataset names')
+
+  parser.add_argument(
+    '--once',
+    dest='once',
+    action='store_true',
+    help='Score all files not in the ledger and exit')
+
+  args = parser.parse_args()
+  if args.input == '':
+    parser.print_help()
+    exit(0)
+  return args
+
+###############################################################################
+#
+#  ledger of processed files
+#
+###############################################################################
+
+def file_key(path):
+  '''A file counts as processed for its path, size and modification time,
+  so a file that is rewritten is scored again'''
+  stat = os.stat(path)
+  return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+class Ledger(object):
+  '''CSV file with one row per processed file'''
+
+  def __init__(self, path):
+    self.path = path
+    self.keys = set()
+    if os.path.exists(path):
+      with open(path, newline='') as ledger_file:
+        for row in csv.DictReader(ledger_file):
+          self.keys.add((row['path'], int(row['size']), int(row['mtime_ns'])))
+
+  def __contains__(self, key):
+    return key in self.keys
+
+  def add(self, entries):
+    '''Record (key, rows, status) entries'''
+    write_header = not os.path.exists(self.path)
+    scored = datetime.now().isoformat(timespec='seconds')
+    with open(self.path, 'a', newline='') as ledger_file:
+      writer = csv.writer(ledger_file)
+      if write_header:
+        writer.writerow(LEDGER_COLUMNS)
+      for key, rows, status in entries:
+        writer.writerow(list(key) + [rows, status, scored])
+        self.keys.add(key)
+
+###############################################################################
+#
+#  scoring batches of files
+#
+###############################################################################
+
+def unprocessed_files(directory, pattern, ledger):
+  '''Keys of the matching files that are not in the ledger'''
+  keys = []
+  for path in sorted(glob.glob(os.path.join(directory, pattern))):
+    try:
+      key = file_key(path)
+    except FileNotFoundError:
+      continue
+    if key not in ledger:
+      keys.append(key)
+  return keys
+
+def score_files(model, keys, features, threshold, keep_columns=()):
+  '''Read the files of a batch and score all their rows in one call.
+  ******
+  Input: fitted model, file keys, model features, class 1 threshold, input
+         columns copied to the results
+  Output: dataframe of results with a source_file column (None if no file
+          could be read), list of (key, rows, status) ledger entries
+  '''
+  frames = []
+  entries = []
+  for key in keys:
+    try:
+      frame = pd.read_csv(key[0])
+      missing = [column for column in features if column not in frame.columns]
+      if missing:
+        raise KeyError('missing columns %s' %missing)
+    except (OSError, ValueError, KeyError) as error:
+      print('*    Skipping %s: %s' %(key[0], error))
+      entries.append((key, 0, 'error: %s' %error))
+      continue
+    frame = frame.reindex(columns=list(features) + [column for column in keep_columns
+                                                    if column not in features])
+    frame['source_file'] = key[0]
+    frames.append(frame)
+    entries.append((key, len(frame), 'scored'))
+  if not frames:
+    return None, entries
+  batch = pd.concat(frames, ignore_index=True)
+  results = score_chunk(model, batch, features, threshold, ['source_file'] + list(keep_columns))
+  return results, entries
+
+def watch(model, directory, output, ledger, features, threshold, pattern='*.csv',
+          interval=5.0, window=30.0, keep_columns=(), once=False):
+  '''Poll the directory and score new files in batches.
+  ******
+  Input: fitted model, directory to watch, output CSV, Ledger, model
+         features, class 1 threshold, file name pattern, seconds between
+         polls, seconds a batch collects files, input columns copied to the
+         results, score what is there and return if True
+  Output: number of files processed; runs until interrupted unless once
+  '''
+  processed = 0
+  last_seen = {}
+  batch = {}
+  batch_start = None
+  while True:
+    keys = unprocessed_files(directory, pattern, ledger)
+    #a file joins the batch once its size and modification time did not
+    #change between two polls, so files still being written are not read
+    for key in keys:
+      if once or last_seen.get(key[0]) == key:
+        batch[key[0]] = key
+        if batch_start is None:
+          batch_start = time.time()
+    last_seen = {key[0]: key for key in keys}
+
+    if batch and (once or time.time() - batch_start >= window):
+      results, entries = score_files(model, list(batch.values()), features, threshold,
+                                     keep_columns)
+      if results is not None:
+        results.to_csv(output, mode='a', header=not os.path.exists(output), index=False)
+      #the ledger is written after the results, so an interrupted batch is
+      #scored again rather than lost
+      ledger.add(entries)
+      processed += len(entries)
+      print('*    Scored %s files, %s rows' %(len(entries), 0 if results is None else len(results)))
+      batch = {}
+      batch_start = None
+
+    if once:
+      return processed
+    time.sleep(interval)
+
+def run():
+  args = parse_command_line()
+
+  model = load_pickle(args.model)
+  output_dir = make_output_folder(args.outdir)
+  keep_columns = [name.strip() for name in args.keep_columns.split(',') if name.strip()]
+  ledger = Ledger(os.path.join(output_dir, 'watch_ledger.csv'))
+
+  try:
+    watch(model, args.input, os.path.join(output_dir, 'results_watch.csv'), ledger,
+          FEATURES, load_threshold(model, THRESHOLD), args.pattern, args.interval,
+          args.window, keep_columns, args.once)
+  except KeyboardInterrupt:
+    print('*    Stopped watching %s' %args.input)
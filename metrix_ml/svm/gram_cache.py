@@ -0,0 +1,116 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Grid search for RBF SVMs on cached kernel matrices; gamma is restricted to
+a grid so the Gram matrix of the training set can be computed once per gamma
+and every C, class_weight and CV fold is fitted on slices of it with
+SVC(kernel='precomputed')'''
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.stats import expon
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import StratifiedKFold
+from sklearn.svm import SVC
+
+###############################################################################
+#
+#  parameter grids
+#
+###############################################################################
+
+def expon_grid(scale, n_values, low=0.02, high=0.98):
+  '''Discretise expon(scale=scale) into n_values quantiles; keeps the grid
+  where the randomized search would have drawn its samples'''
+  return expon(scale=scale).ppf(np.linspace(low, high, n_values))
+
+###############################################################################
+#
+#  cache of Gram matrices
+#
+###############################################################################
+
+class GramCache(object):
+  '''RBF Gram matrices of one training set for different gamma values; the
+  squared distances are computed once and kept, every Gram matrix is a
+  single float32 exp over them. The search reads each Gram matrix once, so
+  only the distances are cached; about two n x n float32 arrays are
+  resident at a time'''
+
+  def __init__(self, X):
+    X = np.asarray(X, dtype=np.float64)
+    sq_norm = np.einsum('ij,ij->i', X, X)
+    sq_dist = sq_norm[:, None] + sq_norm[None, :] - 2 * np.dot(X, X.T)
+    self.sq_dist = np.maximum(sq_dist, 0).astype(np.float32)
+
+  def get(self, gamma):
+    '''Gram matrix for gamma'''
+    return np.exp(-np.float32(gamma) * self.sq_dist)
+
+###############################################################################
+#
+#  search
+#
+###############################################################################
+
+def fit_fold(gram, y, train, test, Cs, class_weight, scoring, random_state):
+  '''Fit one SVM per C on the training slice of a Gram matrix and score it
+  on the test slice; top level function so it can run in a worker process
+  which receives the Gram matrix as a shared memory map'''
+  scorer = get_scorer(scoring)
+  #slice once per fold; libsvm works in float64
+  gram_train = np.asarray(gram[np.ix_(train, train)], dtype=np.float64)
+  gram_test = np.asarray(gram[np.ix_(test, train)], dtype=np.float64)
+  scores = []
+  for C in Cs:
+    svc = SVC(kernel='precomputed', C=C, class_weight=class_weight,
+              random_state=random_state)
+    svc.fit(gram_train, y[train])
+    scores.append(scorer(svc, gram_test, y[test]))
+  return scores
+
+def gram_search(X, y, gammas, Cs, class_weights=('balanced', None), cv=3,
+                scoring='accuracy', n_jobs=-1, random_state=100):
+  '''Search C, gamma and class_weight for an RBF SVM using cached Gram
+  matrices.
+  ******
+  Input: training data and labels, gamma grid, C grid, class weights, number
+         of stratified folds, scoring name, number of worker processes, SVC
+         random_state
+  Output: dict of best parameters, best mean CV score, dataframe with the
+          scores of all combinations
+  '''
+  y = np.asarray(y)
+  folds = list(StratifiedKFold(n_splits=cv).split(np.zeros(len(y)), y))
+  cache = GramCache(X)
+
+  #parameters are kept outside the dataframe where pandas would turn a
+  #class_weight of None into NaN
+  rows = []
+  params = []
+  for gamma in gammas:
+    gram = cache.get(gamma)
+    tasks = [(class_weight, train, test) for class_weight in class_weights
+             for train, test in folds]
+    #joblib hands the Gram matrix to the workers as a read-only memory map
+    scores = Parallel(n_jobs=n_jobs)(
+               delayed(fit_fold)(gram, y, train, test, Cs, class_weight, scoring,
+                                 random_state)
+               for class_weight, train, test in tasks)
+    for k, class_weight in enumerate(class_weights):
+      fold_scores = np.array(scores[k * cv:(k + 1) * cv])
+      for i, C in enumerate(Cs):
+        row = {'gamma': gamma, 'C': C, 'class_weight': class_weight,
+               'mean_test_score': fold_scores[:, i].mean(),
+               'std_test_score': fold_scores[:, i].std()}
+        for f in range(cv):
+          row['split%s_test_score' %f] = fold_scores[f, i]
+        rows.append(row)
+        params.append({'C': float(C), 'gamma': float(gamma),
+                       'class_weight': class_weight})
+
+  results = pd.DataFrame(rows)
+  best = int(np.argmax(results['mean_test_score'].values))
+  return params[best], results.loc[best, 'mean_test_score'], results
@@ -0,0 +1,146 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Regularisation path for linear SVMs solved in the primal; with only a few
+dozen features the squared hinge objective is minimised directly over
+(coef, intercept) and each C on a sorted grid starts from the solution of
+the previous C, so the whole path costs about as much as a few single fits'''
+import matplotlib
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from sklearn.model_selection import StratifiedKFold
+from sklearn.utils.class_weight import compute_sample_weight
+
+###############################################################################
+#
+#  primal solver
+#
+###############################################################################
+
+def squared_hinge_path(X, y, Cs, sample_weight=None, tol=1e-6):
+  '''Minimise 0.5*|w|^2 + C * sum(s_i * max(0, 1 - y_i*(w.x_i + b))^2) for
+  every C, warm starting from the previous solution; same objective as
+  LinearSVC(loss='squared_hinge', dual=False) apart from the intercept not
+  being penalised.
+  ******
+  Input: data, labels in {0, 1}, increasing C values, per sample weights,
+         solver tolerance
+  Output: coefficients len(Cs) x features, intercepts len(Cs)
+  '''
+  X = np.asarray(X, dtype=np.float64)
+  sign = np.where(np.asarray(y) == 1, 1.0, -1.0)
+  if sample_weight is None:
+    sample_weight = np.ones(len(sign))
+  n_features = X.shape[1]
+
+  def objective(params, C):
+    w, b = params[:-1], params[-1]
+    margin = 1 - sign * (np.dot(X, w) + b)
+    active = margin > 0
+    loss = sample_weight[active] * margin[active]
+    value = 0.5 * np.dot(w, w) + C * np.dot(loss, margin[active])
+    grad_margin = -2 * C * loss * sign[active]
+    grad = np.empty_like(params)
+    grad[:-1] = w + np.dot(grad_margin, X[active])
+    grad[-1] = grad_margin.sum()
+    return value, grad
+
+  coefs = np.zeros((len(Cs), n_features))
+  intercepts = np.zeros(len(Cs))
+  params = np.zeros(n_features + 1)
+  for k, C in enumerate(Cs):
+    result = minimize(objective, params, args=(C,), jac=True, method='L-BFGS-B',
+                      options={'gtol': tol})
+    params = result.x
+    coefs[k] = params[:-1]
+    intercepts[k] = params[-1]
+  return coefs, intercepts
+
+###############################################################################
+#
+#  cross-validated path search
+#
+###############################################################################
+
+def linear_path_search(X, y, Cs, class_weights=('balanced', None), cv=3):
+  '''Cross-validate the whole regularisation path for every class weight;
+  all C values of a fold are scored at once from the path coefficients.
+  ******
+  Input: training data, labels, C grid, class weights, number of folds
+  Output: dict of best parameters, best mean CV accuracy, dataframe with
+          the scores of all combinations
+  '''
+  X = np.asarray(X, dtype=np.float64)
+  y = np.asarray(y)
+  Cs = np.sort(Cs)
+  folds = list(StratifiedKFold(n_splits=cv).split(X, y))
+
+  #parameters are kept outside the dataframe where pandas would turn a
+  #class_weight of None into NaN
+  rows = []
+  params = []
+  for class_weight in class_weights:
+    fold_scores = np.zeros((cv, len(Cs)))
+    for f, (train, test) in enumerate(folds):
+      weight = compute_sample_weight(class_weight, y[train])
+      coefs, intercepts = squared_hinge_path(X[train], y[train], Cs, weight)
+      decision = np.dot(X[test], coefs.T) + intercepts
+      fold_scores[f] = ((decision > 0) == (y[test, None] == 1)).mean(axis=0)
+    for i, C in enumerate(Cs):
+      row = {'C': C, 'class_weight': class_weight,
+             'mean_test_score': fold_scores[:, i].mean(),
+             'std_test_score': fold_scores[:, i].std()}
+      for f in range(cv):
+        row['split%s_test_score' %f] = fold_scores[f, i]
+      rows.append(row)
+      params.append({'C': float(C), 'class_weight': class_weight})
+
+  results = pd.DataFrame(rows)
+  best = int(np.argmax(results['mean_test_score'].values))
+  return params[best], results.loc[best, 'mean_test_score'], results
+
+def coefficient_path(X, y, Cs, feature_names, class_weight=None):
+  '''Coefficients along the regularisation path on the full training set.
+  ******
+  Input: training data, labels, C grid, feature names, class weight
+  Output: dataframe with one row per C and one column per feature plus
+          the intercept
+  '''
+  Cs = np.sort(Cs)
+  weight = compute_sample_weight(class_weight, np.asarray(y))
+  coefs, intercepts = squared_hinge_path(X, y, Cs, weight)
+  path = pd.DataFrame(coefs, columns=feature_names, index=pd.Index(Cs, name='C'))
+  path['intercept'] = intercepts
+  return path
+
+def rank_features(path, C):
+  '''Rank features by absolute coefficient at the chosen C and by their
+  mean absolute coefficient along the whole path (data must be
+  standardised for the coefficients to be comparable)'''
+  coefs = path.drop('intercept', axis=1)
+  at_C = coefs.iloc[np.argmin(np.abs(coefs.index.values - C))]
+  ranking = pd.DataFrame({'coef_at_best_C': at_C,
+                          'abs_coef_at_best_C': at_C.abs(),
+                          'mean_abs_coef_path': coefs.abs().mean()})
+  return ranking.sort_values('abs_coef_at_best_C', ascending=False)
+
+def plot_coefficient_path(path, C, file_name):
+  '''Draw every coefficient against log C and mark the chosen C'''
+  coefs = path.drop('intercept', axis=1)
+  plt.figure(figsize=(10, 6))
+  for name in coefs.columns:
+    plt.plot(coefs.index, coefs[name], label=name)
+  plt.axvline(C, color='k', linestyle='--', label='best C')
+  plt.xscale('log')
+  plt.xlabel('C')
+  plt.ylabel('coefficient')
+  plt.legend(loc='center left', bbox_to_anchor=(1, 0.5), fontsize=6)
+  plt.tight_layout()
+  plt.savefig(file_name)
+  plt.close()
@@ -0,0 +1,71 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Platt scaling for SVMs trained without probability=True; the sigmoid is
+fitted once on cross-validated decision values of the final model instead of
+libsvm running its internal 5-fold calibration for every search candidate'''
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import cross_val_predict
+
+###############################################################################
+#
+#  calibrated SVM
+#
+###############################################################################
+
+class PlattScaledSVC(BaseEstimator, ClassifierMixin):
+  '''A fitted SVM together with a sigmoid mapping its decision function to
+  the probability of class 1; behaves like SVC(probability=True) for
+  predict, decision_function and predict_proba so it can be pickled and
+  loaded by the predict scripts in place of the plain SVM'''
+
+  def __init__(self, svm, slope=1.0, intercept=0.0):
+    self.svm = svm
+    self.slope = slope
+    self.intercept = intercept
+
+  @property
+  def classes_(self):
+    return self.svm.classes_
+
+  def decision_function(self, X):
+    return self.svm.decision_function(X)
+
+  def predict(self, X):
+    return self.svm.predict(X)
+
+  def predict_proba(self, X):
+    return self.proba_from_decision(self.decision_function(X))
+
+  def label_from_decision(self, decision):
+    '''class labels for precomputed decision values'''
+    return self.classes_[(np.asarray(decision) > 0).astype(int)]
+
+  def proba_from_decision(self, decision):
+    '''class probabilities for precomputed decision values'''
+    ones = 1.0 / (1.0 + np.exp(-(self.slope * np.asarray(decision) + self.intercept)))
+    return np.column_stack([1.0 - ones, ones])
+
+def calibrate_svm(svm, X_train, y_train, cv=3):
+  '''Fit Platt scaling once for an already fitted SVM.
+  ******
+  Input: fitted SVM with probability=False, training data and labels,
+         number of CV folds
+  Output: PlattScaledSVC wrapping the fitted SVM, cross-validated decision
+          values for the training data
+  '''
+  #out-of-fold decision values so the sigmoid is not fitted on the margins
+  #the SVM was trained on
+  decision = cross_val_predict(clone(svm), X_train, y_train, cv=cv,
+                               method='decision_function')
+  #a practically unregularised logistic regression on the 1D decision is
+  #Platt's sigmoid
+  sigmoid = LogisticRegression(C=1e10, solver='lbfgs')
+  sigmoid.fit(decision.reshape(-1, 1), np.asarray(y_train) == svm.classes_[1])
+  calibrated = PlattScaledSVC(svm, slope=sigmoid.coef_[0, 0],
+                              intercept=sigmoid.intercept_[0])
+  return calibrated, decision
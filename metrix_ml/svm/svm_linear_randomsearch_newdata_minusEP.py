@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 
 import matplotlib
@@ -20,20 +19,31 @@ from sklearn import metrics
 from mlxtend.plotting import plot_decision_regions
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
 from sklearn.svm import LinearSVC
 from sklearn.svm import SVC
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
-from sklearn.model_selection import cross_val_predict
 from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import expon
+from metrix_ml.svm.platt_scaling import calibrate_svm
+from metrix_ml.svm.gram_cache import expon_grid
+from metrix_ml.svm.linear_path import (linear_path_search, coefficient_path,
+                                       rank_features, plot_coefficient_path)
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -59,6 +69,65 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--reg_path',
+    dest='reg_path',
+    action='store_true',
+    help='Search C along a warm-started regularisation path in the primal')
+
+  parser.add_argument(
+    '--n_C',
+    type=int,
+    dest='n_C',
+    default=50,
+    help='Number of C values on the path for --reg_path')
+
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -72,8 +141,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
 
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -99,12 +168,17 @@ class SVMGridSearch(object):
      * predict on this new SVM with test data and cross-validated training data
      * analyse the predisctions with graphs and stats
   '''
-  def __init__(self, metrix, newdata_minusEP, bbbb):
+  def __init__(self, metrix, newdata_minusEP, bbbb, reg_path=False, n_C=50):
     self.metrix=metrix
     self.newdata_minusEP=newdata_minusEP
+    self.reg_path = reg_path
+    self.n_C = n_C
     self.prepare_metrix_data()
     self.split_data()
-    self.grid_search()
+    if reg_path:
+      self.path_search()
+    else:
+      self.grid_search()
     self.svm_best_params()
     self.predict()
     self.analysis()
@@ -118,6 +192,7 @@ class SVMGridSearch(object):
   #
   ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframes for directly after dataprocessing, after
        adding some protein information and after carrying out some custom solumn
@@ -245,6 +320,7 @@ class SVMGridSearch(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -263,7 +339,7 @@ class SVMGridSearch(object):
 #    X_transform_train, X_transform_test, y_train, y_test = train_test_split(self.X_transform, y, test_size=0.2, random_state=42)
 
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
+    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_newdata_transform.columns.all() == X_newdata_transform_train.columns.all()
     
@@ -290,6 +366,7 @@ class SVMGridSearch(object):
     #
     ###############################################################################
 
+  @stage
   def grid_search(self):
     '''running a randomized search to find the parameter combination for a SVM
      which gives the best accuracy score'''
@@ -299,7 +376,7 @@ class SVMGridSearch(object):
 
     #create the SVM; kernel type (rbf and sigmoid won't give feature importances)
     #svm_clf_grid = LinearSVC(loss = 'hinge', random_state=42, dual=True)
-    svc_clf_rand = SVC(kernel='linear', probability=True, random_state=100)
+    svc_clf_rand = SVC(kernel='linear', probability=False, random_state=100)
 
     with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Created SVM: svc_clf_grid \n')
@@ -317,19 +394,68 @@ class SVMGridSearch(object):
     #building and running the grid search
     rand_search = RandomizedSearchCV(svc_clf_rand, param_rand, cv=3, scoring='accuracy', random_state=5, n_iter=500, n_jobs=-1)
 
-    rand_search_transform = rand_search.fit(self.X_newdata_transform_train, self.y_train)
+    rand_search_transform = run_search(rand_search, self.X_newdata_transform_train, self.y_train, 'svm_linear_randomsearch_newdata_minusEP')
     with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_transform.best_params_)+'\n')
       text_file.write('Best score: ' +str(rand_search_transform.best_score_)+'\n')
     
     self.best_params_transform = rand_search_transform.best_params_
        
+    ###############################################################################
+    #
+    #  search along the regularisation path
+    #
+    ###############################################################################
+
+  @stage
+  def path_search(self):
+    '''search C and class_weight along a sorted C grid; every C is solved in
+    the primal starting from the solution of the previous C; the coefficients
+    along the path of the best class weight rank the features'''
+    print('*' *80)
+    print('*    Running regularisation path search for SVM')
+    print('*' *80)
+
+    Cs = expon_grid(100, self.n_C)
+
+    with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Running regularisation path search for C: %s \n' %Cs)
+      text_file.write('use cv=3, scoring=accuracy, squared hinge loss \n')
+
+    best_params, best_score, results = linear_path_search(self.X_newdata_transform_train,
+                                                          self.y_train,
+                                                          Cs)
+
+    with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Best parameters: ' +str(best_params)+'\n')
+      text_file.write('Best score: ' +str(best_score)+'\n')
+
+    self.best_params_transform = best_params
+
+    path = coefficient_path(self.X_newdata_transform_train,
+                            self.y_train,
+                            Cs,
+                            self.X_newdata_transform.columns,
+                            best_params['class_weight'])
+    ranking = rank_features(path, best_params['C'])
+
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    path.to_csv(os.path.join(self.newdata_minusEP, 'coefficient_path_'+datestring+'.csv'))
+    ranking.to_csv(os.path.join(self.newdata_minusEP, 'feature_ranking_path_'+datestring+'.csv'))
+    plot_coefficient_path(path, best_params['C'],
+                          os.path.join(self.newdata_minusEP, 'coefficient_path_'+datestring+'.png'))
+
+    with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Saved coefficients along the path as coefficient_path_.csv/.png \n')
+      text_file.write('Feature ranking at best C: %s \n' %list(ranking.index))
+
     ###############################################################################
     #
     #  creating new SVM with best parameter combination
     #
     ###############################################################################
 
+  @stage
   def svm_best_params(self):
     '''create a new SVM using the best parameter combination found above'''
     print('*' *80)
@@ -337,9 +463,19 @@ class SVMGridSearch(object):
     print('*' *80)
 
     #self.svm_clf_grid_new_transform = LinearSVC(**self.best_params_transform, loss = 'hinge', random_state=42, dual=True)
-    self.svc_clf_grid_new_transform = SVC(**self.best_params_transform, kernel='linear', random_state=100, probability=True)
+    if self.reg_path:
+      #same squared hinge objective the path was searched on, solved by
+      #liblinear in the primal
+      self.svc_clf_grid_new_transform = LinearSVC(**self.best_params_transform, dual=False, random_state=100)
+    else:
+      self.svc_clf_grid_new_transform = SVC(**self.best_params_transform, kernel='linear', random_state=100, probability=False)
 
     self.svc_clf_grid_new_transform.fit(self.X_newdata_transform_train, self.y_train)
+
+    #probabilities are not needed for the search or the fit; Platt scaling is
+    #fitted once here on cross-validated decision values of the best SVM
+    self.svc_clf_grid_calibrated_transform, self.y_train_CV_decision = calibrate_svm(
+      self.svc_clf_grid_new_transform, self.X_newdata_transform_train, self.y_train)
     
     coef = self.svc_clf_grid_new_transform.coef_
     coef_ravel = coef.ravel()
@@ -351,19 +487,27 @@ class SVMGridSearch(object):
 
     intercept = self.svc_clf_grid_new_transform.intercept_
 
+    @stage
     def write_pickle(svm, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(svm, os.path.join(directory,'best_svm_grid_'+name+datestring+'.pkl'))
+      registry_dump(svm, os.path.join(directory,'best_svm_grid_'+name+datestring+'.pkl'))
       with open(os.path.join(directory, 'svm_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new SVM "extra_clf_grid_new_%s" using best parameters \n' %name)
         text_file.write('Creating pickle file for best svm as best_svm_grid_%s.pkl \n' %name)
     
     write_pickle(self.svc_clf_grid_new_transform, self.newdata_minusEP, 'newdata_minusEP')
 
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    registry_dump(self.svc_clf_grid_calibrated_transform, os.path.join(self.newdata_minusEP, 'best_svm_grid_calibrated_newdata_minusEP'+datestring+'.pkl'))
+    with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Fitted Platt scaling on 3-fold CV decision values of the best SVM \n')
+      text_file.write('Creating pickle file for calibrated svm as best_svm_grid_calibrated_newdata_minusEP.pkl \n')
+
     print('*' *80)
     print('*    Getting basic stats for new SVM')
     print('*' *80)
 
+    @stage
     def basic_stats(svm, X_train, directory):
       accuracy_mean_cv = cross_val_score(svm, X_train, self.y_train, scoring='accuracy', cv=3).mean()
       f1_mean_cv = cross_val_score(svm, X_train, self.y_train, scoring='f1', cv=3).mean()
@@ -401,6 +545,7 @@ class SVMGridSearch(object):
     #print(feature_names)
     #print(len(feature_names))
 
+    @stage
     def plot_coefficients(coef, feature_names, top_features=43):
       '''Once a linear SVM is fit to data (e.g., svm.fit(features, labels)), the coefficients can be accessed with svm.coef_. Recall that a linear SVM creates a hyperplane that uses support vectors to maximise the distance between the two classes. The weights obtained from svm.coef_ represent the vector coordinates which are orthogonal to the hyperplane and their direction indicates the predicted class. The absolute size of the coefficients in relation to each other can then be used to determine feature importance for the data separation task.'''
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
@@ -431,6 +576,7 @@ class SVMGridSearch(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best SVM an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -441,13 +587,15 @@ class SVMGridSearch(object):
     #try out how well the classifier works to predict from the test set
     #self.y_pred_transform = self.svc_clf_grid_new_transform.predict(self.X_newdata_transform_test)
     self.y_pred_transform = self.svc_clf_grid_new_transform.predict(self.X_newdata_transform_test)
-    self.y_pred_proba_transform = self.svc_clf_grid_new_transform.predict_proba(self.X_newdata_transform_test)
+    registry_test_score(self.svc_clf_grid_new_transform, self.y_test, self.y_pred_transform)
+    self.y_pred_proba_transform = self.svc_clf_grid_calibrated_transform.predict_proba(self.X_newdata_transform_test)
     with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_test in y_pred_transform \n')
 
     #alternative way to not have to use the test set
-    self.y_train_CV_pred_transform = cross_val_predict(self.svc_clf_grid_new_transform, self.X_newdata_transform_train, self.y_train, cv=3)
-    self.y_train_CV_pred_proba_transform = cross_val_predict(self.svc_clf_grid_new_transform, self.X_newdata_transform_train, self.y_train, cv=3, method='predict_proba')
+    #reuse the decision values from the calibration instead of two more CV runs
+    self.y_train_CV_pred_transform = self.svc_clf_grid_calibrated_transform.label_from_decision(self.y_train_CV_decision)
+    self.y_train_CV_pred_proba_transform = self.svc_clf_grid_calibrated_transform.proba_from_decision(self.y_train_CV_decision)
     with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_train with 3-fold CV in y_train_CV_pred_transform \n')
 
@@ -456,6 +604,7 @@ class SVMGridSearch(object):
     confidence_test = self.svc_clf_grid_new_transform.decision_function(self.X_newdata_transform_test)
 
     #plot histograms of probabilities  
+    @stage
     def plot_hist_pred_proba(y_pred_proba, name, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       plt.hist(y_pred_proba, bins=20)
@@ -472,6 +621,7 @@ class SVMGridSearch(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -505,6 +655,7 @@ class SVMGridSearch(object):
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -527,6 +678,7 @@ class SVMGridSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -637,9 +789,13 @@ class SVMGridSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'svm_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
    
+    @stage
     def prediction_probas(svm, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'svm_randomsearch.txt'), 'a') as text_file:
@@ -735,9 +891,12 @@ class SVMGridSearch(object):
         text_file.write('AUC for CV train set class 1: %s \n' %AUC_train_class1)
 
     prediction_probas(self.svc_clf_grid_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
+
+    bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'svm_randomsearch.txt')
     
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
   ###############################################################################
@@ -746,8 +905,16 @@ def run():
   metrix = load_metrix_data(args.input)
   
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(newdata_minusEP, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
   ###############################################################################
 
-  svm_grid_search = SVMGridSearch(metrix, newdata_minusEP, bbbb)
-
+  try:
+    svm_grid_search = SVMGridSearch(metrix, newdata_minusEP, bbbb, args.reg_path, args.n_C)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'svm_linear_randomsearch_newdata_minusEP')
+    close_profiler()
@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 
 import matplotlib
@@ -20,20 +19,31 @@ from sklearn import metrics
 from mlxtend.plotting import plot_decision_regions
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
 from sklearn.svm import LinearSVC
 from sklearn.svm import SVC
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
-from sklearn.model_selection import cross_val_predict
 from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import expon
+from metrix_ml.svm.platt_scaling import calibrate_svm
+from metrix_ml.svm.gram_cache import expon_grid
+from metrix_ml.svm.linear_path import (linear_path_search, coefficient_path,
+                                       rank_features, plot_coefficient_path)
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -59,6 +69,65 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--reg_path',
+    dest='reg_path',
+    action='store_true',
+    help='Search C along a warm-started regularisation path in the primal')
+
+  parser.add_argument(
+    '--n_C',
+    type=int,
+    dest='n_C',
+    default=50,
+    help='Number of C values on the path for --reg_path')
+
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -72,8 +141,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
 
 def make_output_folder(outdir):
   output_dir = os.path.join(outdir, 'svm_linear_randomsearch')
@@ -95,12 +164,17 @@ class SVMGridSearch(object):
      * predict on this new SVM with test data and cross-validated training data
      * analyse the predisctions with graphs and stats
   '''
-  def __init__(self, metrix, output_dir):
+  def __init__(self, metrix, output_dir, reg_path=False, n_C=50):
     self.metrix = metrix
     self.output_dir = output_dir
+    self.reg_path = reg_path
+    self.n_C = n_C
     self.prepare_metrix_data()
     self.split_data()
-    self.grid_search()
+    if reg_path:
+      self.path_search()
+    else:
+      self.grid_search()
     self.svm_best_params()
     self.predict()
     self.analysis()
@@ -111,6 +185,7 @@ class SVMGridSearch(object):
 #
 ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframe with columns of interest.
     ******
@@ -138,6 +213,7 @@ class SVMGridSearch(object):
 #
 ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -153,7 +229,7 @@ class SVMGridSearch(object):
     y = self.metrix['MR_success']
 
 #stratified split of samples
-    X_metrix_train, X_metrix_test, y_train, y_test = train_test_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
+    X_metrix_train, X_metrix_test, y_train, y_test = registry_split(self.X_metrix, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_metrix.columns.all() == X_metrix_train.columns.all()
 
@@ -185,6 +261,7 @@ class SVMGridSearch(object):
 #
 ###############################################################################
 
+  @stage
   def grid_search(self):
     '''running a randomized search to find the parameter combination for a SVM
      which gives the best accuracy score'''
@@ -194,7 +271,7 @@ class SVMGridSearch(object):
 
     #create the SVM; kernel type (rbf and sigmoid won't give feature importances)
     svc_clf_rand = SVC(kernel='linear',
-                       probability=True,
+                       probability=False,
                        random_state=100)
 
     with open(os.path.join(self.output_dir,
@@ -220,7 +297,7 @@ class SVMGridSearch(object):
                                      n_iter=500,
                                      n_jobs=-1)
 
-    rand_search_fitted = rand_search.fit(self.X_metrix_train_std, self.y_train)
+    rand_search_fitted = run_search(rand_search, self.X_metrix_train_std, self.y_train, 'svm_linear_randomsearch_topfeatures_MR')
     with open(os.path.join(self.output_dir,
               'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_fitted.best_params_)+'\n')
@@ -228,33 +305,95 @@ class SVMGridSearch(object):
     
     self.best_params_fitted = rand_search_fitted.best_params_
        
+###############################################################################
+#
+#  search along the regularisation path
+#
+###############################################################################
+
+  @stage
+  def path_search(self):
+    '''search C and class_weight along a sorted C grid; every C is solved in
+    the primal starting from the solution of the previous C; the coefficients
+    along the path of the best class weight rank the features'''
+    print('*' *80)
+    print('*    Running regularisation path search for SVM')
+    print('*' *80)
+
+    Cs = expon_grid(100, self.n_C)
+
+    with open(os.path.join(self.output_dir, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Running regularisation path search for C: %s \n' %Cs)
+      text_file.write('use cv=3, scoring=accuracy, squared hinge loss \n')
+
+    best_params, best_score, results = linear_path_search(self.X_metrix_train_std,
+                                                          self.y_train,
+                                                          Cs)
+
+    with open(os.path.join(self.output_dir, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Best parameters: ' +str(best_params)+'\n')
+      text_file.write('Best score: ' +str(best_score)+'\n')
+
+    self.best_params_fitted = best_params
+
+    path = coefficient_path(self.X_metrix_train_std,
+                            self.y_train,
+                            Cs,
+                            self.X_metrix.columns,
+                            best_params['class_weight'])
+    ranking = rank_features(path, best_params['C'])
+
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    path.to_csv(os.path.join(self.output_dir, 'coefficient_path_'+datestring+'.csv'))
+    ranking.to_csv(os.path.join(self.output_dir, 'feature_ranking_path_'+datestring+'.csv'))
+    plot_coefficient_path(path, best_params['C'],
+                          os.path.join(self.output_dir, 'coefficient_path_'+datestring+'.png'))
+
+    with open(os.path.join(self.output_dir, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Saved coefficients along the path as coefficient_path_.csv/.png \n')
+      text_file.write('Feature ranking at best C: %s \n' %list(ranking.index))
+
 ###############################################################################
 #
 #  creating new SVM with best parameter combination
 #
 ###############################################################################
 
+  @stage
   def svm_best_params(self):
     '''create a new SVM using the best parameter combination found above'''
     print('*' *80)
     print('*    Building new SVM based on best parameter combination and save as pickle')
     print('*' *80)
 
-    self.svc_clf_rand_new = SVC(**self.best_params_fitted,
-                                          kernel='linear',
-                                          random_state=100,
-                                          probability=True)
+    if self.reg_path:
+      #same squared hinge objective the path was searched on, solved by
+      #liblinear in the primal
+      self.svc_clf_rand_new = LinearSVC(**self.best_params_fitted,
+                                        dual=False,
+                                        random_state=100)
+    else:
+      self.svc_clf_rand_new = SVC(**self.best_params_fitted,
+                                  kernel='linear',
+                                  random_state=100,
+                                  probability=False)
 
     self.svc_clf_rand_new.fit(self.X_metrix_train_std, self.y_train)
+
+    #probabilities are not needed for the search or the fit; Platt scaling is
+    #fitted once here on cross-validated decision values of the best SVM
+    self.svc_clf_rand_calibrated, self.y_train_CV_decision = calibrate_svm(
+      self.svc_clf_rand_new, self.X_metrix_train_std, self.y_train)
     
     coef = self.svc_clf_rand_new.coef_
     coef_ravel = coef.ravel()
     intercept = self.svc_clf_rand_new.intercept_
 
+    @stage
     def write_pickle(svm, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(svm, os.path.join(directory,
-                                    'best_svm_rand_'+datestring+'.pkl'))
+      registry_dump(svm, os.path.join(directory,
+                                     'best_svm_rand_'+datestring+'.pkl'))
       with open(os.path.join(directory,
                 'svm_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new SVM "svm_clf_rand_new" using best parameters \n')
@@ -263,10 +402,17 @@ class SVMGridSearch(object):
     write_pickle(self.svc_clf_rand_new,
                  self.output_dir)
 
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    registry_dump(self.svc_clf_rand_calibrated, os.path.join(self.output_dir, 'best_svm_rand_calibrated_'+datestring+'.pkl'))
+    with open(os.path.join(self.output_dir, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Fitted Platt scaling on 3-fold CV decision values of the best SVM \n')
+      text_file.write('Creating pickle file for calibrated svm as best_svm_rand_calibrated_.pkl \n')
+
     print('*' *80)
     print('*    Getting basic stats for new SVM')
     print('*' *80)
 
+    @stage
     def basic_stats(svm, X_train, directory):
       accuracy_mean_cv = cross_val_score(svm,
                                          X_train,
@@ -317,6 +463,7 @@ class SVMGridSearch(object):
     #print(feature_names)
     #print(len(feature_names))
 
+    @stage
     def plot_coefficients(coef, feature_names, top_features=35):
       '''Once a linear SVM is fit to data (e.g., svm.fit(features, labels)),
       the coefficients can be accessed with svm.coef_. Recall that a linear
@@ -363,6 +510,7 @@ class SVMGridSearch(object):
 #
 ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best SVM an the test set as well as training
     set with 3 cross-validation folds and doing some initial analysis on the
@@ -373,21 +521,16 @@ class SVMGridSearch(object):
 
     #try out how well the classifier works to predict from the test set
     self.y_pred = self.svc_clf_rand_new.predict(self.X_metrix_test_std)
-    self.y_pred_proba = self.svc_clf_rand_new.predict_proba(self.X_metrix_test_std)
+    registry_test_score(self.svc_clf_rand_new, self.y_test, self.y_pred)
+    self.y_pred_proba = self.svc_clf_rand_calibrated.predict_proba(self.X_metrix_test_std)
     with open(os.path.join(self.output_dir,
               'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_metrix_test in y_pred and y_pred_proba \n')
 
     #alternative way to not have to use the test set
-    self.y_train_CV_pred = cross_val_predict(self.svc_clf_rand_new,
-                                             self.X_metrix_train_std,
-                                             self.y_train,
-                                             cv=3)
-    self.y_train_CV_pred_proba = cross_val_predict(self.svc_clf_rand_new,
-                                                   self.X_metrix_train_std,
-                                                   self.y_train,
-                                                   cv=3,
-                                                   method='predict_proba')
+    #reuse the decision values from the calibration instead of two more CV runs
+    self.y_train_CV_pred = self.svc_clf_rand_calibrated.label_from_decision(self.y_train_CV_decision)
+    self.y_train_CV_pred_proba = self.svc_clf_rand_calibrated.proba_from_decision(self.y_train_CV_decision)
     with open(os.path.join(self.output_dir,
               'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_metrix_train with 3-fold CV in y_train_CV_pred \n')
@@ -397,6 +540,7 @@ class SVMGridSearch(object):
     confidence_test = self.svc_clf_rand_new.decision_function(self.X_metrix_test_std)
 
     #plot histograms of probabilities  
+    @stage
     def plot_hist_pred_proba(y_pred_proba, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       plt.hist(y_pred_proba, bins=20)
@@ -415,6 +559,7 @@ class SVMGridSearch(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -451,6 +596,7 @@ class SVMGridSearch(object):
 #
 ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -473,6 +619,7 @@ class SVMGridSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -592,6 +739,9 @@ class SVMGridSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '3-fold CV': conf_mat_3CV},
+                                directory, 'svm_randomsearch.txt')
         
     conf_mat(self.y_test,
              self.y_train,
@@ -599,6 +749,7 @@ class SVMGridSearch(object):
              self.y_train_CV_pred,
              self.output_dir)
    
+    @stage
     def prediction_probas(svm, X_train, y_train, X_test, y_test, y_pred_proba,
                                         y_train_CV_pred_proba, directory): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
@@ -721,9 +872,12 @@ class SVMGridSearch(object):
                       self.y_pred_proba,
                       self.y_train_CV_pred_proba,
                       self.output_dir)    
+
+    bootstrap_report(self.y_test, self.y_pred, self.y_pred_proba[:, 1], self.output_dir, 'svm_randomsearch.txt')
     
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
 ###############################################################################
@@ -732,8 +886,16 @@ def run():
   metrix = load_metrix_data(args.input)
   
   output_dir = make_output_folder(args.outdir)
+  open_profiler(output_dir, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(output_dir, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
 ###############################################################################
 
-  svm_grid_search = SVMGridSearch(metrix, output_dir)
-
+  try:
+    svm_grid_search = SVMGridSearch(metrix, output_dir, args.reg_path, args.n_C)
+  finally:
+    close_fit_ledger(output_dir, 'svm_linear_randomsearch_topfeatures_MR')
+    close_profiler()
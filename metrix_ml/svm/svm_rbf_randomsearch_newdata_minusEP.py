@@ -5,7 +5,6 @@
 ###############################################################################
 '''Defining the environment for this class'''
 import argparse
-import pandas as pd
 import os
 
 import matplotlib
@@ -20,20 +19,30 @@ from sklearn import metrics
 from mlxtend.plotting import plot_decision_regions
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
 from sklearn.svm import LinearSVC
 from sklearn.svm import SVC
 from sklearn.metrics import mean_squared_error
-from sklearn.externals import joblib
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import cross_val_score
-from sklearn.model_selection import cross_val_predict
 from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
 from sklearn.metrics import precision_recall_curve, roc_curve
 from sklearn.tree import export_graphviz
 from datetime import datetime
-from sklearn.externals import joblib
 from scipy.stats import expon
+from metrix_ml.svm.platt_scaling import calibrate_svm
+from metrix_ml.svm.gram_cache import gram_search, expon_grid
+from metrix_ml.utils.bootstrapping import bootstrap_report
+from metrix_ml.utils.confidence_interval import write_confusion_intervals
+from metrix_ml.utils.model_registry import (open_registry, registry_dump,
+                                            registry_test_score)
+from metrix_ml.utils.importance import permutation_report
+from metrix_ml.utils.profiling import open_profiler, close_profiler, stage
+from metrix_ml.utils.fit_ledger import open_fit_ledger, close_fit_ledger
+from metrix_ml.utils.search_results import open_results
+from metrix_ml.utils.tpe_search import open_tpe
+from metrix_ml.utils.split_registry import open_splits, registry_split
+from metrix_ml.utils.typed_loading import load_metrix_table
+from metrix_ml.utils.searching import run_search
 
 ###############################################################################
 #
@@ -59,6 +68,72 @@ def parse_command_line():
     default='',
     help='Specify output directory')
 
+  parser.add_argument(
+    '--gram_cache',
+    dest='gram_cache',
+    action='store_true',
+    help='Search C and gamma on a grid using cached Gram matrices')
+
+  parser.add_argument(
+    '--n_gamma',
+    type=int,
+    dest='n_gamma',
+    default=20,
+    help='Number of gamma values in the grid for --gram_cache')
+
+  parser.add_argument(
+    '--n_C',
+    type=int,
+    dest='n_C',
+    default=25,
+    help='Number of C values in the grid for --gram_cache')
+
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='SQLite model registry; an identical earlier search is loaded instead of refitted')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='SQLite store of the cv_results_ of every search; default search_results.sqlite in the output folder')
+
+  parser.add_argument(
+    '--tpe',
+    type=int,
+    dest='tpe',
+    default=0,
+    help='Candidates of a model-based (TPE) search replacing the randomised search; 0 keeps it')
+
+  parser.add_argument(
+    '--tpe_seed',
+    dest='tpe_seed',
+    action='store_true',
+    help='Seed the TPE search with stored candidates of earlier searches on the same data')
+
+  parser.add_argument(
+    '--profile',
+    dest='profile',
+    action='store_true',
+    help='Write cProfile statistics of every stage into the output directory')
+
+  parser.add_argument(
+    '--tracemalloc',
+    dest='tracemalloc',
+    action='store_true',
+    help='With --profile also write a tracemalloc snapshot after every outermost stage')
+
+  parser.add_argument(
+    '--splits',
+    type=str,
+    dest='splits',
+    default='',
+    help='Directory of the shared split indices; default splits in the output directory')
+
   args = parser.parse_args()
   if args.input == '':
     parser.print_help()
@@ -72,8 +147,8 @@ def parse_command_line():
 ###############################################################################
 
 def load_metrix_data(csv_path):
-  '''load the raw data as stored in CSV file'''
-  return pd.read_csv(csv_path)
+  '''load the raw data as stored in CSV file with the typed EP/MR schema'''
+  return load_metrix_table(csv_path)
 
 def make_output_folder(outdir):
   names = ['newdata_minusEP', 'bbbb']
@@ -99,12 +174,18 @@ class SVMRBFGridSearch(object):
      * predict on this new SVM with test data and cross-validated training data
      * analyse the predisctions with graphs and stats
   '''
-  def __init__(self, metrix, newdata_minusEP, bbbb):
+  def __init__(self, metrix, newdata_minusEP, bbbb, gram_cache=False, n_gamma=20,
+               n_C=25):
     self.metrix=metrix
     self.newdata_minusEP=newdata_minusEP
+    self.n_gamma = n_gamma
+    self.n_C = n_C
     self.prepare_metrix_data()
     self.split_data()
-    self.grid_search()
+    if gram_cache:
+      self.gram_search()
+    else:
+      self.grid_search()
     self.svm_best_params()
     self.predict()
     self.analysis()
@@ -118,6 +199,7 @@ class SVMRBFGridSearch(object):
   #
   ###############################################################################
 
+  @stage
   def prepare_metrix_data(self):
     '''Function to create smaller dataframes for directly after dataprocessing, after
        adding some protein information and after carrying out some custom solumn
@@ -241,6 +323,7 @@ class SVMRBFGridSearch(object):
     #
     ###############################################################################
 
+  @stage
   def split_data(self):
     '''Function which splits the input data into training set and test set.
     ******
@@ -259,7 +342,7 @@ class SVMRBFGridSearch(object):
 #    X_transform_train, X_transform_test, y_train, y_test = train_test_split(self.X_transform, y, test_size=0.2, random_state=42)
 
 #stratified split of samples
-    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = train_test_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
+    X_newdata_transform_train, X_newdata_transform_test, y_train, y_test = registry_split(self.X_newdata_transform, y, test_size=0.2, random_state=42, stratify=y)
     
     assert self.X_newdata_transform.columns.all() == X_newdata_transform_train.columns.all()
     
@@ -285,6 +368,7 @@ class SVMRBFGridSearch(object):
     #
     ###############################################################################
 
+  @stage
   def grid_search(self):
     '''running a randomized search to find the parameter combination for a SVM
      which gives the best accuracy score'''
@@ -294,7 +378,7 @@ class SVMRBFGridSearch(object):
 
     #create the SVM; kernel type (rbf and sigmoid won't give feature importances)
     #svm_clf_grid = LinearSVC(loss = 'hinge', random_state=42, dual=True)
-    svc_clf_rand = SVC(kernel='rbf', probability=True, random_state=100)
+    svc_clf_rand = SVC(kernel='rbf', probability=False, random_state=100)
 
     with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Created SVM: svc_clf_rand \n')
@@ -314,19 +398,54 @@ class SVMRBFGridSearch(object):
     #building and running the grid search
     rand_search = RandomizedSearchCV(svc_clf_rand, param_rand, cv=3, scoring='accuracy', random_state=5, n_iter=500, n_jobs=-1)
 
-    rand_search_transform = rand_search.fit(self.X_newdata_transform_train, self.y_train)
+    rand_search_transform = run_search(rand_search, self.X_newdata_transform_train, self.y_train, 'svm_rbf_randomsearch_newdata_minusEP')
     with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Best parameters: ' +str(rand_search_transform.best_params_)+'\n')
       text_file.write('Best score: ' +str(rand_search_transform.best_score_)+'\n')
     
     self.best_params_transform = rand_search_transform.best_params_
        
+    ###############################################################################
+    #
+    #  grid search on cached Gram matrices
+    #
+    ###############################################################################
+
+  @stage
+  def gram_search(self):
+    '''search C, gamma and class_weight on a grid; the Gram matrix of the
+    training set is computed once per gamma and shared by all C values,
+    class weights and CV folds'''
+    print('*' *80)
+    print('*    Running GridSearch on cached Gram matrices for SVM')
+    print('*' *80)
+
+    gammas = expon_grid(.1, self.n_gamma)
+    Cs = expon_grid(100, self.n_C)
+
+    with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Running grid search on cached Gram matrices for gamma: %s \n' %gammas)
+      text_file.write('and C: %s \n' %Cs)
+      text_file.write('use cv=3, scoring=accuracy \n')
+
+    best_params, best_score, results = gram_search(self.X_newdata_transform_train,
+                                                   self.y_train,
+                                                   gammas,
+                                                   Cs)
+
+    with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Best parameters: ' +str(best_params)+'\n')
+      text_file.write('Best score: ' +str(best_score)+'\n')
+
+    self.best_params_transform = best_params
+
     ###############################################################################
     #
     #  creating new SVM with best parameter combination
     #
     ###############################################################################
 
+  @stage
   def svm_best_params(self):
     '''create a new SVM using the best parameter combination found above'''
     print('*' *80)
@@ -334,9 +453,14 @@ class SVMRBFGridSearch(object):
     print('*' *80)
 
     #self.svm_clf_grid_new_transform = LinearSVC(**self.best_params_transform, loss = 'hinge', random_state=42, dual=True)
-    self.svc_clf_grid_new_transform = SVC(**self.best_params_transform, kernel='rbf', random_state=100, probability=True)
+    self.svc_clf_grid_new_transform = SVC(**self.best_params_transform, kernel='rbf', random_state=100, probability=False)
 
     self.svc_clf_grid_new_transform.fit(self.X_newdata_transform_train, self.y_train)
+
+    #probabilities are not needed for the search or the fit; Platt scaling is
+    #fitted once here on cross-validated decision values of the best SVM
+    self.svc_clf_grid_calibrated_transform, self.y_train_CV_decision = calibrate_svm(
+      self.svc_clf_grid_new_transform, self.X_newdata_transform_train, self.y_train)
     
     #coef = self.svc_clf_grid_new_transform.coef_
     
@@ -351,19 +475,27 @@ class SVMRBFGridSearch(object):
       text_file.write(str(sv)+'\n')
       text_file.write('Intercept: %s \n' %intercept)
 
+    @stage
     def write_pickle(svm, directory, name):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
-      joblib.dump(svm, os.path.join(directory,'best_svm_grid_'+name+datestring+'.pkl'))
+      registry_dump(svm, os.path.join(directory,'best_svm_grid_'+name+datestring+'.pkl'))
       with open(os.path.join(directory, 'svm_randomsearch.txt'), 'a') as text_file:
         text_file.write('Created new SVM "extra_clf_grid_new_%s" using best parameters \n' %name)
         text_file.write('Creating pickle file for best svm as best_svm_grid_%s.pkl \n' %name)
     
     write_pickle(self.svc_clf_grid_new_transform, self.newdata_minusEP, 'newdata_minusEP')
 
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    registry_dump(self.svc_clf_grid_calibrated_transform, os.path.join(self.newdata_minusEP, 'best_svm_grid_calibrated_newdata_minusEP'+datestring+'.pkl'))
+    with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
+      text_file.write('Fitted Platt scaling on 3-fold CV decision values of the best SVM \n')
+      text_file.write('Creating pickle file for calibrated svm as best_svm_grid_calibrated_newdata_minusEP.pkl \n')
+
     print('*' *80)
     print('*    Getting basic stats for new SVM')
     print('*' *80)
 
+    @stage
     def basic_stats(svm, X_train, directory):
       accuracy_mean_cv = cross_val_score(svm, X_train, self.y_train, scoring='accuracy', cv=3).mean()
       f1_mean_cv = cross_val_score(svm, X_train, self.y_train, scoring='f1', cv=3).mean()
@@ -387,6 +519,7 @@ class SVMRBFGridSearch(object):
     #
     ###############################################################################
 
+  @stage
   def predict(self):
     '''do predictions using the best SVM an the test set as well as training set with
        10 cross-validation folds and doing some initial analysis on the output'''
@@ -397,13 +530,15 @@ class SVMRBFGridSearch(object):
     #try out how well the classifier works to predict from the test set
     #self.y_pred_transform = self.svc_clf_grid_new_transform.predict(self.X_newdata_transform_test)
     self.y_pred_transform = self.svc_clf_grid_new_transform.predict(self.X_newdata_transform_test)
-    self.y_pred_proba_transform = self.svc_clf_grid_new_transform.predict_proba(self.X_newdata_transform_test)
+    registry_test_score(self.svc_clf_grid_new_transform, self.y_test, self.y_pred_transform)
+    self.y_pred_proba_transform = self.svc_clf_grid_calibrated_transform.predict_proba(self.X_newdata_transform_test)
     with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_test in y_pred_transform \n')
 
     #alternative way to not have to use the test set
-    self.y_train_CV_pred_transform = cross_val_predict(self.svc_clf_grid_new_transform, self.X_newdata_transform_train, self.y_train, cv=3)
-    self.y_train_CV_pred_proba_transform = cross_val_predict(self.svc_clf_grid_new_transform, self.X_newdata_transform_train, self.y_train, cv=3, method='predict_proba')
+    #reuse the decision values from the calibration instead of two more CV runs
+    self.y_train_CV_pred_transform = self.svc_clf_grid_calibrated_transform.label_from_decision(self.y_train_CV_decision)
+    self.y_train_CV_pred_proba_transform = self.svc_clf_grid_calibrated_transform.proba_from_decision(self.y_train_CV_decision)
     with open(os.path.join(self.newdata_minusEP, 'svm_randomsearch.txt'), 'a') as text_file:
       text_file.write('Saving predictions and probabilities for X_transform_train with 3-fold CV in y_train_CV_pred_transform \n')
 
@@ -412,6 +547,7 @@ class SVMRBFGridSearch(object):
     confidence_test = self.svc_clf_grid_new_transform.decision_function(self.X_newdata_transform_test)
 
     #plot histograms of probabilities  
+    @stage
     def plot_hist_pred_proba(y_pred_proba, name, directory):
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
       plt.hist(y_pred_proba, bins=20)
@@ -428,6 +564,7 @@ class SVMRBFGridSearch(object):
     print('*    Calculate prediction stats')
     print('*' *80)
 
+    @stage
     def prediction_stats(y_test, y_pred, directory):
       # calculate accuracy
       y_accuracy = metrics.accuracy_score(self.y_test, y_pred)
@@ -461,6 +598,7 @@ class SVMRBFGridSearch(object):
     #
     ###############################################################################
 
+  @stage
   def analysis(self):
     '''detailed analysis of the output:
        * create a confusion matrix
@@ -483,6 +621,7 @@ class SVMRBFGridSearch(object):
     print('*    Detailed analysis and plotting')
     print('*' *80)
 
+    @stage
     def conf_mat(y_test, y_train, y_pred, y_train_pred, directory):
       # IMPORTANT: first argument is true values, second argument is predicted values
       # this produces a 2x2 numpy array (matrix)
@@ -593,9 +732,13 @@ class SVMRBFGridSearch(object):
         text_file.write('F1 score: \n')
         text_file.write('F1 score sklearn test: %s \n' %f1_score_sklearn_test)
         text_file.write('F1 score sklearn CV: %s \n' %f1_score_sklearn_CV)
+
+      write_confusion_intervals({'test': conf_mat_test, '10-fold CV': conf_mat_10CV},
+                                directory, 'svm_randomsearch.txt')
         
     conf_mat(self.y_test, self.y_train, self.y_pred_transform, self.y_train_CV_pred_transform, self.newdata_minusEP)
    
+    @stage
     def prediction_probas(svm, X_train, y_train, X_test, y_test, y_pred_proba, y_train_CV_pred_proba, directory, kind): 
       datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')      
       with open(os.path.join(directory, 'svm_randomsearch.txt'), 'a') as text_file:
@@ -691,9 +834,18 @@ class SVMRBFGridSearch(object):
         text_file.write('AUC for CV train set class 1: %s \n' %AUC_train_class1)
 
     prediction_probas(self.svc_clf_grid_new_transform, self.X_newdata_transform_train, self.y_train, self.X_newdata_transform_test, self.y_test, self.y_pred_proba_transform, self.y_train_CV_pred_proba_transform, self.newdata_minusEP, 'newdata_minusEP')    
+
+    #permutation importances on the test set; the model has no importances
+    #of its own
+    permutation_report(self.svc_clf_grid_new_transform, self.X_newdata_transform_test, self.y_test,
+                       'newdata_minusEP', self.newdata_minusEP, 'svm_randomsearch.txt',
+                       self.X_newdata_transform.columns)
+
+    bootstrap_report(self.y_test, self.y_pred_transform, self.y_pred_proba_transform[:, 1], self.newdata_minusEP, 'svm_randomsearch.txt')
     
 def run():
   args = parse_command_line()
+  open_registry(args.registry)
   
   
   ###############################################################################
@@ -702,8 +854,17 @@ def run():
   metrix = load_metrix_data(args.input)
   
   newdata_minusEP, bbbb= make_output_folder(args.outdir)
+  open_profiler(newdata_minusEP, args.profile, args.tracemalloc)
+  open_splits(args.splits or os.path.join(args.outdir, 'splits'))
+  open_results(args.results or os.path.join(newdata_minusEP, 'search_results.sqlite'))
+  open_tpe(args.tpe, args.tpe_seed)
+  open_fit_ledger()
 
   ###############################################################################
 
-  svm_rbf_grid_search = SVMRBFGridSearch(metrix, newdata_minusEP, bbbb)
-
+  try:
+    svm_rbf_grid_search = SVMRBFGridSearch(metrix, newdata_minusEP, bbbb, args.gram_cache,
+                                           args.n_gamma, args.n_C)
+  finally:
+    close_fit_ledger(newdata_minusEP, 'svm_rbf_randomsearch_newdata_minusEP')
+    close_profiler()
@@ -1,125 +1,166 @@
-# Nonparametric confidence interval using bootstrapping
-# works for predictions of any type of model: regression, cNN, decision tree
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Nonparametric bootstrap confidence intervals for binary classifiers; works
+for predictions of any type of model.
+  * without refitting the stored predictions are resampled with an index
+    matrix and the metrics of all resamples are computed at once
+  * with refitting every resample is fitted in a worker process and scored
+    on its out-of-bag samples, which are found from the index counts;
+    bootstrap_refit is for use from Python only, the trainers report the
+    intervals without refitting'''
+import os
+from datetime import datetime
 
-# bootstrap confidence intervals
-from numpy.random import seed
-from numpy.random import rand
-from numpy.random import randint
-from numpy import mean
-from numpy import median
-from numpy import percentile
-# seed the random number generator
-seed(1)
-# generate dataset
-dataset = 0.5 + rand(1000) * 0.5
-# bootstrap
-scores = list()
-for _ in range(100):
-	# bootstrap sample
-	indices = randint(0, 1000, 1000)
-	sample = dataset[indices]
-	# calculate and store statistic
-	statistic = mean(sample)
-	scores.append(statistic)
-print('50th percentile (median) = %.3f' % median(scores))
-# calculate 95% confidence intervals (100 - alpha)
-alpha = 5.0
-# calculate lower percentile (e.g. 2.5)
-lower_p = alpha / 2.0
-# retrieve observation at lower percentile
-lower = max(0.0, percentile(scores, lower_p))
-print('%.1fth percentile = %.3f' % (lower_p, lower))
-# calculate upper percentile (e.g. 97.5)
-upper_p = (100 - alpha) + (alpha / 2.0)
-# retrieve observation at upper percentile
-upper = min(1.0, percentile(scores, upper_p))
-print('%.1fth percentile = %.3f' % (upper_p, upper))
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
+from sklearn.base import clone
 
-# more general bootstrap example
-# run bootstrap
-stats = list()
-for i in range(n_iterations):
-	# prepare train and test sets
-	train = resample(values, n_samples=n_size)
-	test = numpy.array([x for x in values if x.tolist() not in train.tolist()])
-	# fit model
-	model = DecisionTreeClassifier()
-	model.fit(train[:,:-1], train[:,-1])
-	# evaluate model
-	predictions = model.predict(test[:,:-1])
-	score = accuracy_score(test[:,-1], predictions)
-	
+METRICS = ('accuracy', 'roc_auc', 'precision', 'recall')
 
-import numpy
-from pandas import read_csv
-from sklearn.utils import resample
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.metrics import accuracy_score
-from matplotlib import pyplot
-# load dataset
-data = read_csv('pima-indians-diabetes.data.csv', header=None)
-values = data.values
-# configure bootstrap
-n_iterations = 1000
-n_size = int(len(data) * 0.50)
-# run bootstrap
-stats = list()
-for i in range(n_iterations):
-	# prepare train and test sets
-	train = resample(values, n_samples=n_size)
-	test = numpy.array([x for x in values if x.tolist() not in train.tolist()])
-	# fit model
-	model = DecisionTreeClassifier()
-	model.fit(train[:,:-1], train[:,-1])
-	# evaluate model
-	predictions = model.predict(test[:,:-1])
-	score = accuracy_score(test[:,-1], predictions)
-	print(score)
-	stats.append(score)
-# plot scores
-pyplot.hist(stats)
-pyplot.show()
-# confidence intervals
-alpha = 0.95
-p = ((1.0-alpha)/2.0) * 100
-lower = max(0.0, numpy.percentile(stats, p))
-p = (alpha+((1.0-alpha)/2.0)) * 100
-upper = min(1.0, numpy.percentile(stats, p))
-print('%.1f confidence interval %.1f%% and %.1f%%' % (alpha*100, lower*100, upper*100))
+###############################################################################
+#
+#  metrics for many resamples at once
+#
+###############################################################################
 
-import numpy
-from pandas import read_csv
-from sklearn.utils import resample
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.metrics import accuracy_score
-from matplotlib import pyplot
-# load dataset
-data = read_csv('pima-indians-diabetes.data.csv', header=None)
-values = data.values
-# configure bootstrap
-n_iterations = 1000
-n_size = int(len(data) * 0.50)
-# run bootstrap
-stats = list()
-for i in range(n_iterations):
-	# prepare train and test sets
-	train = resample(values, n_samples=n_size)
-	test = numpy.array([x for x in values if x.tolist() not in train.tolist()])
-	# fit model
-	model = DecisionTreeClassifier()
-	model.fit(train[:,:-1], train[:,-1])
-	# evaluate model
-	predictions = model.predict(test[:,:-1])
-	score = accuracy_score(test[:,-1], predictions)
-	print(score)
-	stats.append(score)
-# plot scores
-pyplot.hist(stats)
-pyplot.show()
-# confidence intervals
-alpha = 0.95
-p = ((1.0-alpha)/2.0) * 100
-lower = max(0.0, numpy.percentile(stats, p))
-p = (alpha+((1.0-alpha)/2.0)) * 100
-upper = min(1.0, numpy.percentile(stats, p))
-print('%.1f confidence interval %.1f%% and %.1f%%' % (alpha*100, lower*100, upper*100))	
+def bootstrap_indices(n_samples, n_resamples, random_state=42):
+  '''Index matrix n_resamples x n_samples of samples drawn with replacement'''
+  rng = np.random.RandomState(random_state)
+  return rng.randint(0, n_samples, size=(n_resamples, n_samples)).astype(np.int32)
+
+def resampled_metrics(y_true, y_pred, y_score, index):
+  '''Accuracy, ROC AUC, precision and recall of class 1 for every row of an
+  index matrix.
+  ******
+  Input: 1D arrays of true labels, predicted labels and scores for class 1
+         (scores may be None), 2D index matrix resamples x samples
+  Output: dict of 1D arrays with one value per resample; NaN where a metric
+          is undefined for a resample
+  '''
+  truth = np.asarray(y_true)[index] == 1
+  pred = np.asarray(y_pred)[index] == 1
+  tp = np.count_nonzero(truth & pred, axis=1)
+  fp = np.count_nonzero(~truth & pred, axis=1)
+  fn = np.count_nonzero(truth & ~pred, axis=1)
+  n_pos = np.count_nonzero(truth, axis=1)
+  n_neg = index.shape[1] - n_pos
+
+  with np.errstate(invalid='ignore', divide='ignore'):
+    results = {'accuracy': np.count_nonzero(truth == pred, axis=1) / index.shape[1],
+               'precision': np.where(tp + fp > 0, tp / (tp + fp), np.nan),
+               'recall': np.where(n_pos > 0, tp / n_pos, np.nan)}
+    if y_score is not None:
+      #Mann-Whitney U from the ranks of the scores within each resample
+      ranks = rankdata(np.asarray(y_score, dtype=np.float64)[index], axis=1)
+      u = (ranks * truth).sum(axis=1) - n_pos * (n_pos + 1) / 2.0
+      results['roc_auc'] = np.where(n_pos * n_neg > 0, u / (n_pos * n_neg), np.nan)
+  return results
+
+def summarise(estimates, resampled, alpha=0.95):
+  '''Percentile intervals for every metric.
+  ******
+  Input: dict of point estimates, dict of arrays of resampled values,
+         confidence level
+  Output: dataframe with one row per metric and the columns estimate, mean,
+          std, lower, upper
+  '''
+  low = (1 - alpha) / 2 * 100
+  rows = []
+  for metric in METRICS:
+    if metric not in resampled:
+      continue
+    values = resampled[metric]
+    rows.append({'metric': metric,
+                 'estimate': estimates[metric],
+                 'mean': np.nanmean(values),
+                 'std': np.nanstd(values),
+                 'lower': max(0.0, np.nanpercentile(values, low)),
+                 'upper': min(1.0, np.nanpercentile(values, 100 - low))})
+  return pd.DataFrame(rows)
+
+###############################################################################
+#
+#  bootstrap without refitting
+#
+###############################################################################
+
+def bootstrap_metrics(y_true, y_pred, y_score=None, n_resamples=1000,
+                      alpha=0.95, random_state=42, chunk_size=2**24):
+  '''Confidence intervals from resampling stored predictions.
+  ******
+  Input: true labels, predicted labels, scores for class 1 or None, number of
+         resamples, confidence level, seed, maximum number of elements of an
+         index matrix held in memory at once
+  Output: dataframe as returned by summarise
+  '''
+  n_samples = len(y_true)
+  full = resampled_metrics(y_true, y_pred, y_score, np.arange(n_samples)[None, :])
+  estimates = {metric: values[0] for metric, values in full.items()}
+
+  index = bootstrap_indices(n_samples, n_resamples, random_state)
+  step = max(1, chunk_size // n_samples)
+  chunks = [resampled_metrics(y_true, y_pred, y_score, index[start:start + step])
+            for start in range(0, n_resamples, step)]
+  resampled = {metric: np.concatenate([chunk[metric] for chunk in chunks])
+               for metric in chunks[0]}
+  return summarise(estimates, resampled, alpha)
+
+def bootstrap_report(y_true, y_pred, y_score, directory, log_name,
+                     n_resamples=1000, alpha=0.95):
+  '''Bootstrap the stored test set predictions of a trainer, save the table
+  as CSV and append it to the trainer's log'''
+  intervals = bootstrap_metrics(y_true, y_pred, y_score, n_resamples, alpha)
+  datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+  intervals.to_csv(os.path.join(directory, 'bootstrap_ci_'+datestring+'.csv'), index=False)
+  with open(os.path.join(directory, log_name), 'a') as text_file:
+    text_file.write('%.0f%% bootstrap confidence intervals from %s resamples of the test set: \n'
+                    %(alpha * 100, n_resamples))
+    for _, row in intervals.iterrows():
+      text_file.write('%s: %.4f [%.4f, %.4f] \n'
+                      %(row['metric'], row['estimate'], row['lower'], row['upper']))
+  return intervals
+
+###############################################################################
+#
+#  bootstrap with refitting
+#
+###############################################################################
+
+def refit_resample(estimator, X, y, index):
+  '''Fit a clone on one resample and score it on the out-of-bag samples;
+  top level function so it can run in a worker process'''
+  oob = np.bincount(index, minlength=len(y)) == 0
+  if not oob.any():
+    return {metric: np.nan for metric in METRICS}
+  model = clone(estimator).fit(X[index], y[index])
+  y_pred = model.predict(X[oob])
+  if hasattr(model, 'predict_proba'):
+    y_score = model.predict_proba(X[oob])[:, 1]
+  else:
+    y_score = model.decision_function(X[oob])
+  scores = resampled_metrics(y[oob], y_pred, y_score, np.arange(oob.sum())[None, :])
+  return {metric: values[0] for metric, values in scores.items()}
+
+def bootstrap_refit(estimator, X, y, n_resamples=200, alpha=0.95, n_jobs=-1,
+                    random_state=42):
+  '''Confidence intervals from refitting the estimator on resamples of the
+  training data and scoring it out-of-bag.
+  ******
+  Input: unfitted estimator, data, labels, number of resamples, confidence
+         level, number of worker processes, seed
+  Output: dataframe as returned by summarise; the estimate column is the
+          mean out-of-bag value
+  '''
+  X = np.asarray(X)
+  y = np.asarray(y)
+  index = bootstrap_indices(len(y), n_resamples, random_state)
+  rows = Parallel(n_jobs=n_jobs)(delayed(refit_resample)(estimator, X, y, row)
+                                 for row in index)
+  resampled = {metric: np.array([row[metric] for row in rows]) for metric in METRICS}
+  estimates = {metric: np.nanmean(values) for metric, values in resampled.items()}
+  return summarise(estimates, resampled, alpha)
@@ -1,24 +1,106 @@
-# Interval for classification accuracy
-
-#common confidence intervals
-#    1.64 (90%)
-#    1.96 (95%)
-#    2.33 (98%)
-#    2.58 (99%)
-
-
-# for 50 samples
-# binomial confidence interval
-from math import sqrt
-interval = 1.96 * sqrt( (0.2 * (1 - 0.2)) / 50)
-print('%.3f' % interval)
-
-# for 100 samples
-# binomial confidence interval
-interval = 1.96 * sqrt( (0.2 * (1 - 0.2)) / 100)
-print('%.3f' % interval)
-
-# for a dataset of 100 samples; 95% confidence interval with a significance of 0.05
-from statsmodels.stats.proportion import proportion_confint
-lower, upper = proportion_confint(88, 100, 0.05)
-print('lower=%.3f, upper=%.3f' % (lower, upper))
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Closed-form binomial confidence intervals for classification metrics;
+every function takes arrays of counts so the intervals of many metrics and
+data sets come out of one call
+  * wilson: Wilson score interval, the default; good coverage also for small
+    counts and rates close to 0 or 1
+  * clopper_pearson: exact interval from beta quantiles, conservative
+  * normal: normal approximation, z * sqrt(p * (1 - p) / n)'''
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.stats import beta, norm
+
+METHODS = ('wilson', 'clopper_pearson', 'normal')
+
+###############################################################################
+#
+#  binomial proportion intervals
+#
+###############################################################################
+
+def proportion_interval(successes, totals, alpha=0.95, method='wilson'):
+  '''Confidence interval of a binomial proportion for arrays of counts.
+  ******
+  Input: numbers of successes, numbers of trials (any broadcastable shapes),
+         confidence level, one of METHODS
+  Output: arrays of proportion, lower bound, upper bound; NaN where there
+          are no trials
+  '''
+  if method not in METHODS:
+    raise ValueError('unknown interval method %s, use one of %s'
+                     %(method, ', '.join(METHODS)))
+  successes = np.asarray(successes, dtype=np.float64)
+  totals = np.asarray(totals, dtype=np.float64)
+  z = norm.ppf(1 - (1 - alpha) / 2)
+
+  with np.errstate(invalid='ignore', divide='ignore'):
+    p = successes / totals
+    if method == 'wilson':
+      denominator = 1 + z ** 2 / totals
+      centre = (p + z ** 2 / (2 * totals)) / denominator
+      half = z * np.sqrt(p * (1 - p) / totals + z ** 2 / (4 * totals ** 2)) / denominator
+      lower, upper = centre - half, centre + half
+    elif method == 'clopper_pearson':
+      tail = (1 - alpha) / 2
+      lower = np.where(successes > 0,
+                       beta.ppf(tail, successes, totals - successes + 1), 0.0)
+      upper = np.where(successes < totals,
+                       beta.ppf(1 - tail, successes + 1, totals - successes), 1.0)
+    else:
+      half = z * np.sqrt(p * (1 - p) / totals)
+      lower, upper = p - half, p + half
+
+  empty = totals == 0
+  lower = np.where(empty, np.nan, np.clip(lower, 0, 1))
+  upper = np.where(empty, np.nan, np.clip(upper, 0, 1))
+  return p, lower, upper
+
+###############################################################################
+#
+#  metrics of confusion matrices
+#
+###############################################################################
+
+def confusion_intervals(matrices, alpha=0.95, method='wilson'):
+  '''Accuracy, sensitivity, specificity and precision with intervals for a
+  set of 2x2 confusion matrices in sklearn layout [[TN, FP], [FN, TP]].
+  ******
+  Input: dict of name to confusion matrix, confidence level, one of METHODS
+  Output: dataframe with one row per matrix and metric and the columns
+          data, metric, successes, total, value, lower, upper
+  '''
+  names = list(matrices)
+  counts = np.stack([np.asarray(matrices[name]).reshape(2, 2) for name in names])
+  tn, fp, fn, tp = counts[:, 0, 0], counts[:, 0, 1], counts[:, 1, 0], counts[:, 1, 1]
+
+  metrics = ['accuracy', 'sensitivity', 'specificity', 'precision']
+  successes = np.stack([tp + tn, tp, tn, tp])
+  totals = np.stack([tp + tn + fp + fn, tp + fn, tn + fp, tp + fp])
+  value, lower, upper = proportion_interval(successes, totals, alpha, method)
+
+  return pd.DataFrame({'data': np.tile(names, len(metrics)),
+                       'metric': np.repeat(metrics, len(names)),
+                       'successes': successes.ravel(),
+                       'total': totals.ravel(),
+                       'value': value.ravel(),
+                       'lower': lower.ravel(),
+                       'upper': upper.ravel()})
+
+def write_confusion_intervals(matrices, directory, log_name, alpha=0.95,
+                              method='wilson'):
+  '''Append the metrics of the confusion matrices with their intervals to
+  the log of a trainer'''
+  intervals = confusion_intervals(matrices, alpha, method)
+  with open(os.path.join(directory, log_name), 'a') as text_file:
+    text_file.write('%.0f%% %s confidence intervals: \n' %(alpha * 100, method))
+    for _, row in intervals.iterrows():
+      text_file.write('%s %s: %.4f [%.4f, %.4f] (%d/%d) \n'
+                      %(row['metric'], row['data'], row['value'], row['lower'],
+                        row['upper'], row['successes'], row['total']))
+  return intervals
@@ -0,0 +1,303 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Pruning of large tree ensembles (random forests, extra trees, bagging and
+AdaBoost) on a validation set. The contribution of every member to the
+ensemble score is computed once; members are then ordered either greedily,
+adding the member that raises the validation AUC of the subset most, or
+by their mean margin on the validation set. The AUC and accuracy of the
+first k members give the trade-off curve, and the smallest subset within a
+tolerance of both the AUC and the accuracy of the full ensemble is written
+as a pruned model. Members
+are ordered on one half of the validation set and the curve is computed on
+the other, as a greedy ordering scored on its own rows is optimistic'''
+import argparse
+import copy
+import os
+from datetime import datetime
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from joblib import dump, load
+from scipy.stats import rankdata
+from sklearn.model_selection import train_test_split
+
+from metrix_ml.utils.typed_loading import load_metrix_table
+
+###############################################################################
+#
+#  member contributions
+#
+###############################################################################
+
+def member_scores(model, X):
+  '''Contribution of every member to the ensemble score of class 1.
+  ******
+  Input: fitted ensemble, validation features
+  Output: array (members, samples) of contributions, array of member
+          weights, threshold of the summed contributions over the summed
+          weights for class 1
+  '''
+  X = np.asarray(X)
+  members = model.estimators_
+  if hasattr(model, 'estimator_weights_'):
+    weights = np.asarray(model.estimator_weights_[:len(members)], dtype=float)
+    if getattr(model, 'algorithm', 'SAMME') == 'SAMME.R':
+      #half the log odds of every member, as AdaBoost sums them
+      proba = np.clip(np.array([member.predict_proba(X)[:, 1] for member in members]),
+                      1e-10, 1 - 1e-10)
+      return 0.5 * np.log(proba / (1 - proba)), np.ones(len(members)), 0.
+    votes = np.array([member.predict(X) == model.classes_[1] for member in members])
+    return weights[:, None] * (2. * votes - 1), weights, 0.
+  features = getattr(model, 'estimators_features_', [slice(None)] * len(members))
+  proba = np.array([member.predict_proba(X[:, columns])[:, 1]
+                    for member, columns in zip(members, features)])
+  return proba, np.ones(len(members)), 0.5
+
+def subset_auc(sums, y):
+  '''AUC of every row of summed contributions; ties count one half'''
+  sums = np.atleast_2d(sums)
+  positive = np.asarray(y) == 1
+  n_pos = positive.sum()
+  n_neg = len(positive) - n_pos
+  ranks = rankdata(sums, axis=1)
+  return (ranks[:, positive].sum(axis=1) - n_pos * (n_pos + 1) / 2.) / (n_pos * n_neg)
+
+###############################################################################
+#
+#  ordering members
+#
+###############################################################################
+
+def greedy_order(scores, y, threshold, max_size=None):
+  '''Forward selection; each step adds the member that gives the subset the
+  highest validation AUC, ties go to the member with the larger mean margin.
+  ******
+  Input: member contributions, labels, class 1 threshold of a contribution,
+         number of members to select
+  Output: array of member indices in the order they were added
+  '''
+  n_members = len(scores)
+  max_size = n_members if max_size is None else min(max_size, n_members)
+  margin = margin_order(scores, y, threshold)
+  #candidates in margin order, so argmax breaks ties in favour of margin
+  scores = scores[margin]
+  selected = []
+  remaining = np.ones(n_members, dtype=bool)
+  total = np.zeros(scores.shape[1])
+  for _ in range(max_size):
+    candidates = np.flatnonzero(remaining)
+    auc = subset_auc(total[None, :] + scores[candidates], y)
+    best = candidates[int(np.argmax(auc))]
+    selected.append(best)
+    remaining[best] = False
+    total += scores[best]
+  return margin[np.asarray(selected, dtype=int)]
+
+def margin_order(scores, y, threshold):
+  '''Members by their mean signed margin on the validation set, largest
+  first; contributions are centred on the class 1 threshold, so averaging
+  and boosting ensembles are treated alike'''
+  sign = 2. * (np.asarray(y) == 1) - 1
+  return np.argsort(-((scores - threshold) * sign).mean(axis=1), kind='stable')
+
+###############################################################################
+#
+#  trade-off curve and pruned model
+#
+###############################################################################
+
+def tradeoff_curve(scores, weights, threshold, y, order, n_points=50):
+  '''AUC and accuracy of the first k members of an ordering for k on a
+  geometric grid up to the full ordering'''
+  sizes = np.unique(np.round(np.geomspace(1, len(order), n_points)).astype(int))
+  cumulative = np.cumsum(scores[order], axis=0)[sizes - 1]
+  weight = np.cumsum(weights[order])[sizes - 1]
+  predicted = cumulative / weight[:, None] > threshold
+  return pd.DataFrame({'members': sizes,
+                       'auc': subset_auc(cumulative, y),
+                       'accuracy': (predicted == (np.asarray(y) == 1)[None, :]).mean(axis=1)})
+
+def prune_model(model, keep):
+  '''Copy of an ensemble with only the members at the indices in keep'''
+  keep = np.asarray(keep, dtype=int)
+  pruned = copy.copy(model)
+  pruned.estimators_ = [model.estimators_[index] for index in keep]
+  #per member attributes of bagging and AdaBoost; one that is not in step
+  #with estimators_ (the _seeds of a warm started bagging) is dropped
+  for attribute in ('estimators_features_', '_seeds', 'estimator_weights_',
+                    'estimator_errors_'):
+    values = getattr(model, attribute, None)
+    if values is None:
+      continue
+    if len(values) != len(model.estimators_):
+      delattr(pruned, attribute)
+    elif isinstance(values, list):
+      setattr(pruned, attribute, [values[index] for index in keep])
+    else:
+      setattr(pruned, attribute, np.asarray(values)[keep])
+  pruned.n_estimators = len(keep)
+  pruned.pruned_from_ = len(model.estimators_)
+  return pruned
+
+def prune(model, X, y, method='greedy', tolerance=0.005, max_size=250, random_state=42):
+  '''Order the members, compute the trade-off curve and prune.
+  ******
+  Input: fitted ensemble, validation features and labels, 'greedy' or
+         'margin', largest loss of AUC and of accuracy accepted, members
+         the greedy search selects at most, seed of the split of the
+         validation set
+  Output: pruned model, curve dataframe, AUC and accuracy of the full
+          ensemble on the rows of the curve
+  '''
+  if method not in ('greedy', 'margin'):
+    raise ValueError('unknown pruning method %s' %method)
+  scores, weights, threshold = member_scores(model, X)
+  y = np.asarray(y)
+  order_rows, curve_rows = train_test_split(np.arange(len(y)), test_size=0.5,
+                                            random_state=random_state, stratify=y)
+  order = margin_order(scores[:, order_rows], y[order_rows], threshold)
+  if method == 'greedy':
+    selected = greedy_order(scores[:, order_rows], y[order_rows], threshold, max_size)
+    #members the greedy search did not reach follow in margin order, so the
+    #curve ends at the full ensemble
+    order = np.concatenate([selected, order[~np.isin(order, selected)]])
+  scores, y = scores[:, curve_rows], y[curve_rows]
+  full_auc = float(subset_auc(scores.sum(axis=0), y)[0])
+  full_accuracy = float(np.mean((scores.sum(axis=0) / weights.sum() > threshold) == (y == 1)))
+  curve = tradeoff_curve(scores, weights, threshold, y, order)
+  good = curve[(curve['auc'] >= full_auc - tolerance)
+               & (curve['accuracy'] >= full_accuracy - tolerance)]
+  size = int(good['members'].iloc[0])
+  if size == len(order):
+    print('*    No subset is within %s of the full ensemble, all members are kept'
+          %tolerance)
+  return prune_model(model, order[:size]), curve, full_auc, full_accuracy
+
+###############################################################################
+#
+#  command line interface
+#
+###############################################################################
+
+def parse_command_line():
+  '''defining the command line input to make it runable'''
+  parser = argparse.ArgumentParser(description='Prune a tree ensemble on a validation set')
+
+  parser.add_argument(
+    '--model',
+    type=str,
+    dest='model',
+    default='',
+    help='The pickled ensemble')
+
+  parser.add_argument(
+    '--input',
+    type=str,
+    dest='input',
+    default='',
+    help='Validation data as CSV file, not used to train the model')
+
+  parser.add_argument(
+    '--features',
+    type=str,
+    dest='features',
+    default='',
+    help='Comma separated features in training order; default the feature names stored in the model')
+
+  parser.add_argument(
+    '--target',
+    type=str,
+    dest='target',
+    default='',
+    help='Target column; default EP_success or MR_success')
+
+  parser.add_argument(
+    '--method',
+    type=str,
+    dest='method',
+    default='greedy',
+    choices=['greedy', 'margin'],
+    help='Greedy AUC forward selection or ordering by margin')
+
+  parser.add_argument(
+    '--tolerance',
+    type=float,
+    dest='tolerance',
+    default=0.005,
+    help='Largest loss in validation AUC and accuracy accepted')
+
+  parser.add_argument(
+    '--max_size',
+    type=int,
+    dest='max_size',
+    default=250,
+    help='Members the greedy selection adds at most')
+
+  parser.add_argument(
+    '--outdir',
+    type=str,
+    dest='outdir',
+    default='',
+    help='Specify output directory')
+
+  args = parser.parse_args()
+  if args.model == '' or args.input == '':
+    parser.print_help()
+    exit(0)
+  return args
+
+def run():
+  args = parse_command_line()
+  model = load(args.model)
+  data = load_metrix_table(args.input)
+  if args.features:
+    features = [name.strip() for name in args.features.split(',')]
+  elif hasattr(model, 'feature_names_in_'):
+    features = list(model.feature_names_in_)
+  else:
+    raise ValueError('the model stores no feature names, give them with --features')
+  target = args.target or ('MR_success' if 'MR_success' in data else 'EP_success')
+  X = data[features].fillna(0)
+  y = data[target].astype(int)
+
+  output_dir = os.path.join(args.outdir, 'ensemble_pruning')
+  os.makedirs(output_dir, exist_ok=True)
+  name = os.path.splitext(os.path.basename(args.model))[0]
+  datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+
+  pruned, curve, full_auc, full_accuracy = prune(model, X, y, args.method, args.tolerance,
+                                                 args.max_size)
+  curve.to_csv(os.path.join(output_dir, '%s_pruning_curve_%s.csv' %(name, datestring)),
+               index=False)
+  dump(pruned, os.path.join(output_dir, '%s_pruned_%s_%s.pkl'
+                            %(name, pruned.n_estimators, datestring)))
+
+  fig, ax = plt.subplots(figsize=(8, 5))
+  for score, full, colour in (('auc', full_auc, 'C0'), ('accuracy', full_accuracy, 'C1')):
+    ax.plot(curve['members'], curve[score], marker='o', markersize=3, color=colour,
+            label='%s of the pruned model' %score)
+    ax.axhline(full, color=colour, linestyle='--',
+               label='%s of all %s members' %(score, pruned.pruned_from_))
+  ax.axvline(pruned.n_estimators, color='grey', linestyle=':')
+  ax.set_xscale('log')
+  ax.set_xlabel('Members kept')
+  ax.set_ylabel('Validation score')
+  ax.set_title('Ensemble pruning (%s) of %s' %(args.method, name))
+  ax.legend(loc='lower right')
+  fig.savefig(os.path.join(output_dir, '%s_pruning_curve_%s.png' %(name, datestring)),
+              dpi=600)
+  plt.close(fig)
+
+  print('*' *80)
+  kept = curve.set_index('members').loc[pruned.n_estimators]
+  print('*    Kept %s of %s members; validation AUC %.4f, all members %.4f'
+        %(pruned.n_estimators, pruned.pruned_from_, kept['auc'], full_auc))
+  print('*    Validation accuracy %.4f, all members %.4f' %(kept['accuracy'], full_accuracy))
+  print('*' *80)
+  print(curve.to_string(index=False, float_format='%.4f'))
@@ -0,0 +1,253 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Ledger of every estimator fit in a run; while the ledger is open the fit
+methods of all scikit-learn estimators are wrapped and each call records
+the estimator class, its parameters, n_samples, n_features, the trees it
+built and how long it took. Fits nested in other fits (a voting classifier
+fitting its members, cross_val_score fitting clones) are recorded with
+their depth. Fits running in joblib worker processes, e.g. the candidates of
+a search with n_jobs=-1, cannot be seen from the trainer process; for
+searches they are counted from cv_results_, for cross_val_score and
+cross_validate from the fold scores. cross_val_predict and RFECV in worker
+processes stay uncounted'''
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+from sklearn.base import clone
+
+from metrix_ml.utils.model_registry import describe
+
+COLUMNS = ['order', 'depth', 'nested', 'estimator', 'n_samples', 'n_features', 'trees',
+           'inner_fits', 'inner_trees', 'seconds', 'params']
+
+###############################################################################
+#
+#  trees and fits of a fitted estimator
+#
+###############################################################################
+
+def count_trees(estimator):
+  '''Number of decision trees in a fitted estimator, 0 for other models'''
+  if hasattr(estimator, 'tree_'):
+    return 1
+  if hasattr(estimator, 'best_estimator_'):
+    return count_trees(estimator.best_estimator_)
+  members = getattr(estimator, 'estimators_', None)
+  if members is None:
+    members = [step for _, step in getattr(estimator, 'steps', [])]
+  members = [member for member in (members if isinstance(members, list) else [])
+             if member is not None]
+  return sum(count_trees(member) for member in members)
+
+def expected_trees(estimator):
+  '''Trees one fit of an unfitted estimator builds'''
+  params = estimator.get_params(deep=False)
+  if 'n_estimators' not in params:
+    return 1 if 'criterion' in params and 'max_depth' in params else 0
+  if 'criterion' in params:
+    return params['n_estimators']
+  base = params.get('estimator', params.get('base_estimator'))
+  if base is None or isinstance(base, str):
+    #AdaBoost and bagging default to decision trees
+    return params['n_estimators']
+  return params['n_estimators'] * expected_trees(base)
+
+def search_fits(search):
+  '''Candidate fits of a fitted search and the trees they built; the refit
+  runs in the trainer process and is recorded as a fit of its own'''
+  results = getattr(search, 'cv_results_', None)
+  if results is None or not hasattr(search, 'n_splits_'):
+    return None, None
+  estimator = search.estimator
+  fits = len(results['params']) * search.n_splits_
+  trees = search.n_splits_ * sum(expected_trees(clone(estimator).set_params(**params))
+                                 for params in results['params'])
+  return fits, trees
+
+###############################################################################
+#
+#  ledger
+#
+###############################################################################
+
+class FitLedger(object):
+  '''Records fits while installed'''
+
+  def __init__(self):
+    self.records = []
+    self.local = threading.local()
+    self.originals = {}
+    self.cross_validate = None
+
+  def install(self):
+    '''Wrap fit of every scikit-learn class that defines one and
+    cross_validate, which cross_val_score calls'''
+    from sklearn.utils import all_estimators
+    from sklearn.model_selection import _validation
+    for _, estimator_class in all_estimators():
+      for klass in estimator_class.__mro__:
+        if 'fit' in klass.__dict__ and klass not in self.originals:
+          self.originals[klass] = klass.__dict__['fit']
+          klass.fit = self.wrap(klass.__dict__['fit'])
+    self.cross_validate = _validation.cross_validate
+    _validation.cross_validate = self.wrap_cross_validate(self.cross_validate)
+
+  def uninstall(self):
+    for klass, fit in self.originals.items():
+      klass.fit = fit
+    self.originals = {}
+    if self.cross_validate is not None:
+      from sklearn.model_selection import _validation
+      _validation.cross_validate = self.cross_validate
+      self.cross_validate = None
+
+  def wrap(self, fit):
+    ledger = self
+    def fit_recorded(estimator, X, *args, **kwargs):
+      fitting = getattr(ledger.local, 'fitting', [])
+      #a fit calling the fit of its parent class is one fit
+      if any(other is estimator for other in fitting):
+        return fit(estimator, X, *args, **kwargs)
+      ledger.local.fitting = fitting + [estimator]
+      first = len(ledger.records)
+      start = time.perf_counter()
+      try:
+        return fit(estimator, X, *args, **kwargs)
+      finally:
+        ledger.local.fitting = fitting
+        ledger.record(estimator, X, len(fitting), time.perf_counter() - start,
+                      len(ledger.records) - first)
+    fit_recorded.__name__ = fit.__name__
+    fit_recorded.__doc__ = fit.__doc__
+    fit_recorded.__wrapped__ = fit
+    return fit_recorded
+
+  def wrap_cross_validate(self, cross_validate):
+    '''cross_validate recorded as a fit without trees of its own; the fold
+    fits are counted from the scores unless they ran in this process'''
+    ledger = self
+    def cross_validate_recorded(estimator, X, *args, **kwargs):
+      fitting = getattr(ledger.local, 'fitting', [])
+      ledger.local.fitting = fitting + [cross_validate]
+      first = len(ledger.records)
+      start = time.perf_counter()
+      scores = None
+      try:
+        scores = cross_validate(estimator, X, *args, **kwargs)
+        return scores
+      finally:
+        ledger.local.fitting = fitting
+        folds = len(scores['test_score']) if isinstance(scores, dict) else 0
+        ledger.record(estimator, X, len(fitting), time.perf_counter() - start,
+                      len(ledger.records) - first, name='cross_validate',
+                      inner=(folds, folds * expected_trees(estimator)))
+    cross_validate_recorded.__name__ = cross_validate.__name__
+    cross_validate_recorded.__doc__ = cross_validate.__doc__
+    cross_validate_recorded.__wrapped__ = cross_validate
+    return cross_validate_recorded
+
+  def record(self, estimator, X, depth, seconds, nested, name=None, inner=None):
+    shape = getattr(X, 'shape', None)
+    inner_fits, inner_trees = inner if inner is not None else search_fits(estimator)
+    if inner_fits is not None and nested >= inner_fits:
+      #the fits ran in this process and are recorded already
+      inner_fits, inner_trees = None, None
+    self.records.append({'order': len(self.records),
+                         'depth': depth,
+                         'nested': nested,
+                         'estimator': name or type(estimator).__name__,
+                         'n_samples': shape[0] if shape else len(X),
+                         'n_features': shape[1] if shape is not None and len(shape) > 1 else None,
+                         'trees': 0 if name else count_trees(estimator),
+                         'inner_fits': inner_fits,
+                         'inner_trees': inner_trees,
+                         'seconds': seconds,
+                         'params': json.dumps(describe(estimator.get_params(deep=False)))})
+
+  def table(self):
+    return pd.DataFrame(self.records, columns=COLUMNS)
+
+  def summary(self):
+    '''Fits per estimator class: all recorded fits, outermost fits, search
+    candidates fitted in worker processes, trees built, time of the outermost
+    fits'''
+    table = self.table()
+    if table.empty:
+      return table
+    table['outermost'] = (table['depth'] == 0).astype(int)
+    table['trees'] = table['trees'].where(table['nested'] == 0, 0)
+    outer = table[table['depth'] == 0]
+    grouped = table.groupby('estimator')
+    summary = pd.DataFrame({'fits': grouped.size(),
+                            'outermost': grouped['outermost'].sum(),
+                            'inner_fits': grouped['inner_fits'].sum(),
+                            'trees': grouped['trees'].sum(),
+                            'inner_trees': grouped['inner_trees'].sum(),
+                            'seconds': outer.groupby('estimator')['seconds'].sum()}).fillna(0)
+    counts = ['fits', 'outermost', 'inner_fits', 'trees', 'inner_trees']
+    summary[counts] = summary[counts].astype(int)
+    return summary.sort_values(['seconds', 'fits'], ascending=False)
+
+  def totals(self):
+    '''Fits and trees of the whole run; the trees of a fit with nested fits
+    are built by those, so only fits without nested fits count their trees'''
+    table = self.table()
+    outer = table['depth'] == 0
+    built = table['nested'] == 0
+    calls = table['estimator'] != 'cross_validate'
+    return {'fits': int(calls.sum() + table['inner_fits'].fillna(0).sum()),
+            'trees': int(table.loc[built, 'trees'].sum() + table['inner_trees'].fillna(0).sum()),
+            'seconds': float(table.loc[outer, 'seconds'].sum())}
+
+###############################################################################
+#
+#  ledger used by the trainers
+#
+###############################################################################
+
+_active = None
+
+def open_fit_ledger():
+  '''Start recording every estimator fit'''
+  global _active
+  close_fit_ledger()
+  _active = FitLedger()
+  _active.install()
+  return _active
+
+def close_fit_ledger(directory=None, trainer=None):
+  '''Stop recording; with a directory write every fit as fit_ledger_<date>.csv,
+  append the run totals to fit_totals.csv there and print the summary'''
+  global _active
+  ledger, _active = _active, None
+  if ledger is None:
+    return None
+  ledger.uninstall()
+  if directory is None:
+    return ledger
+
+  datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+  ledger.table().to_csv(os.path.join(directory, 'fit_ledger_'+datestring+'.csv'), index=False)
+  totals = ledger.totals()
+  try:
+    from importlib.metadata import version
+    release = version('metrix_ml')
+  except Exception:
+    release = 'unknown'
+  totals_file = os.path.join(directory, 'fit_totals.csv')
+  pd.DataFrame([dict(date=datestring, trainer=trainer, release=release, **totals)]).to_csv(
+    totals_file, mode='a', header=not os.path.exists(totals_file), index=False)
+
+  print('*' *80)
+  print('*    Estimator fits in this run: %s fits, %s trees, %.1f s'
+        %(totals['fits'], totals['trees'], totals['seconds']))
+  print('*' *80)
+  print(ledger.summary().to_string(float_format='%.2f'))
+  return ledger
@@ -0,0 +1,155 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Feature importances for every model family
+  * tree_importances: impurity importances of all trees of a forest, bagging
+    or AdaBoost ensemble stacked into one array
+  * permutation_importances: drop in test score when one feature is shuffled,
+    for any fitted estimator; features and repeats run in parallel and only
+    rows whose value changed are predicted again, the others keep the cached
+    unpermuted prediction'''
+import os
+from datetime import datetime
+
+import matplotlib
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn import metrics
+
+SCORINGS = ('accuracy', 'roc_auc')
+
+###############################################################################
+#
+#  importances of the trees of an ensemble
+#
+###############################################################################
+
+def tree_importance_matrix(clf, n_features=None):
+  '''Impurity importances of every tree of an ensemble, one row per tree;
+  trees of a bagging ensemble fitted on a feature subset get zeros for the
+  features they did not see, so the number of training features has to be
+  given for bagging'''
+  per_tree = np.stack([tree.feature_importances_ for tree in clf.estimators_])
+  subsets = getattr(clf, 'estimators_features_', None)
+  if subsets is None:
+    return per_tree
+  if n_features is None:
+    raise ValueError('n_features is needed for the trees of a bagging ensemble')
+  if per_tree.shape[1] == n_features:
+    return per_tree
+  matrix = np.zeros((len(per_tree), n_features))
+  np.put_along_axis(matrix, np.stack(subsets), per_tree, axis=1)
+  return matrix
+
+def tree_importances(clf, feature_names):
+  '''Mean and standard deviation of the importances over all trees.
+  ******
+  Input: fitted ensemble with estimators_, feature names
+  Output: dataframe indexed by feature with the columns mean and std
+  '''
+  feature_names = list(feature_names)
+  matrix = tree_importance_matrix(clf, len(feature_names))
+  return pd.DataFrame({'mean': matrix.mean(axis=0),
+                       'std': matrix.std(axis=0, ddof=1) if len(matrix) > 1 else 0.0},
+                      index=feature_names)
+
+###############################################################################
+#
+#  permutation importances
+#
+###############################################################################
+
+def score_predictions(y, prediction, scoring):
+  if scoring == 'accuracy':
+    return np.mean(prediction == y)
+  return metrics.roc_auc_score(y, prediction)
+
+def predict_for(estimator, X, scoring):
+  '''Labels for accuracy, class 1 scores for roc_auc'''
+  if scoring == 'accuracy':
+    return estimator.predict(X)
+  if hasattr(estimator, 'predict_proba'):
+    try:
+      return estimator.predict_proba(X)[:, 1]
+    except AttributeError:
+      pass
+  return estimator.decision_function(X)
+
+def permuted_scores(estimator, X, y, baseline, column, seeds, scoring, columns=None):
+  '''Scores with one column shuffled, once per seed; top level function so
+  it can run in a worker process. Estimators fitted on a dataframe get the
+  rows back as a dataframe with the same columns'''
+  scores = []
+  for seed in seeds:
+    permuted = X[np.random.RandomState(seed).permutation(len(X)), column]
+    changed = permuted != X[:, column]
+    prediction = baseline.copy()
+    if changed.any():
+      X_changed = X[changed].copy()
+      X_changed[:, column] = permuted[changed]
+      if columns is not None:
+        X_changed = pd.DataFrame(X_changed, columns=columns)
+      prediction[changed] = predict_for(estimator, X_changed, scoring)
+    scores.append(score_predictions(y, prediction, scoring))
+  return scores
+
+def permutation_importances(estimator, X, y, feature_names=None, scoring='accuracy',
+                            n_repeats=5, n_jobs=-1, random_state=42):
+  '''Permutation importance of every feature.
+  ******
+  Input: fitted estimator, test data, labels, feature names (default the
+         columns of X), one of SCORINGS, shuffles per feature, parallel jobs,
+         seed
+  Output: dataframe indexed by feature with the columns mean and std of the
+          score decrease, sorted by mean
+  '''
+  if scoring not in SCORINGS:
+    raise ValueError('unknown scoring %s, use one of %s' %(scoring, ', '.join(SCORINGS)))
+  columns = getattr(X, 'columns', None)
+  if feature_names is None:
+    feature_names = columns
+  baseline = np.asarray(predict_for(estimator, X, scoring))
+  X = np.asarray(X)
+  y = np.asarray(y)
+  baseline_score = score_predictions(y, baseline, scoring)
+
+  seeds = np.random.RandomState(random_state).randint(np.iinfo(np.int32).max,
+                                                      size=(X.shape[1], n_repeats))
+  scores = Parallel(n_jobs=n_jobs)(
+    delayed(permuted_scores)(estimator, X, y, baseline, column, seeds[column], scoring,
+                             columns)
+    for column in range(X.shape[1]))
+  decrease = baseline_score - np.asarray(scores)
+  importances = pd.DataFrame({'mean': decrease.mean(axis=1),
+                              'std': decrease.std(axis=1)},
+                             index=list(feature_names))
+  return importances.sort_values('mean', ascending=False)
+
+def permutation_report(estimator, X, y, name, directory, log_name, feature_names=None,
+                       scoring='accuracy', n_repeats=5, n_jobs=-1):
+  '''Permutation importances of a trainer's final model written as CSV, bar
+  plot and to the log'''
+  importances = permutation_importances(estimator, X, y, feature_names, scoring,
+                                        n_repeats, n_jobs)
+  datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+  importances.to_csv(os.path.join(directory, 'permutation_importances_'+name+datestring+'.csv'),
+                     index_label='feature')
+
+  importances['mean'].plot(kind='bar', color='b', yerr=[importances['std']], align="center",
+                           figsize=(20,10), rot=90)
+  plt.title('Permutation importances (%s decrease) using features %s ' %(scoring, name))
+  plt.xlabel('Features')
+  plt.tight_layout()
+  plt.savefig(os.path.join(directory, 'permutation_importances_bar_plot_'+name+datestring+'.png'))
+  plt.close()
+
+  with open(os.path.join(directory, log_name), 'a') as text_file:
+    text_file.write('Permutation importances, %s decrease over %s shuffles: \n%s \n'
+                    %(scoring, n_repeats, importances.to_string()))
+  return importances
@@ -0,0 +1,185 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Incremental updates of random forests, extra trees and bagging ensembles
+when rows are appended to the database. Every row gets a fingerprint; the
+fingerprints of the training and test rows are pickled with the model, so
+the next run finds the rows added since, keeps the earlier split, adds new
+trees fitted with warm_start on bootstrap samples that include the new rows
+and can retire the oldest trees. The updates are recorded as the lineage of
+the model. AdaBoost has no warm_start, its trees depend on all earlier ones,
+and still has to be refitted'''
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sklearn import metrics
+from sklearn.model_selection import train_test_split
+
+from metrix_ml.utils.model_registry import data_fingerprint
+
+###############################################################################
+#
+#  row fingerprints
+#
+###############################################################################
+
+def row_fingerprints(X, y):
+  '''64 bit hash of the feature values and the label of every row'''
+  rows = pd.DataFrame(np.asarray(X, dtype=np.float64))
+  rows['label'] = np.asarray(y)
+  return pd.util.hash_pandas_object(rows, index=False).values
+
+def start_lineage(model, X_train, y_train, X_test, y_test):
+  '''Attach the row fingerprints and the first lineage entry to a model
+  fitted from scratch, so it can be updated incrementally later'''
+  model.row_fingerprints_ = {'train': row_fingerprints(X_train, y_train),
+                             'test': row_fingerprints(X_test, y_test)}
+  model.lineage_ = [{'generation': 0,
+                     'date': datetime.now().isoformat(timespec='seconds'),
+                     'n_train': len(y_train),
+                     'n_test': len(y_test),
+                     'n_new_train': len(y_train),
+                     'n_new_test': len(y_test),
+                     'trees_added': len(model.estimators_),
+                     'trees_retired': 0,
+                     'n_estimators': len(model.estimators_),
+                     'random_state': model.random_state,
+                     'data_hash': data_fingerprint(X_train, y_train)}]
+  return model
+
+###############################################################################
+#
+#  split that keeps the rows of earlier generations where they were
+#
+###############################################################################
+
+def incremental_split(X, y, previous, test_size=0.2, random_state=42):
+  '''Train/test split for an incremental update; rows the previous model
+  trained or was tested on stay on their side, only the new rows are split
+  with a stratified split.
+  ******
+  Input: features, labels, previous model with row_fingerprints_, test
+         fraction and seed of the split of the new rows
+  Output: X_train, X_test, y_train, y_test, number of new train and test rows
+  '''
+  if not hasattr(previous, 'row_fingerprints_'):
+    raise ValueError('the previous model has no row fingerprints; fit it from scratch once')
+  fingerprints = row_fingerprints(X, y)
+  old_train = np.isin(fingerprints, previous.row_fingerprints_['train'])
+  old_test = np.isin(fingerprints, previous.row_fingerprints_['test']) & ~old_train
+  new = np.flatnonzero(~old_train & ~old_test)
+
+  new_train, new_test = np.array([], dtype=int), np.array([], dtype=int)
+  if len(new) > 1:
+    labels = np.asarray(y)[new]
+    stratify = labels if np.bincount(labels.astype(int)).min() > 1 else None
+    new_train, new_test = train_test_split(new, test_size=test_size,
+                                           random_state=random_state, stratify=stratify)
+  elif len(new) == 1:
+    new_train = new
+
+  train = np.sort(np.concatenate([np.flatnonzero(old_train), new_train]))
+  test = np.sort(np.concatenate([np.flatnonzero(old_test), new_test]))
+  return (X.iloc[train], X.iloc[test], y.iloc[train], y.iloc[test],
+          len(new_train), len(new_test))
+
+###############################################################################
+#
+#  warm start update
+#
+###############################################################################
+
+def retire_trees(model, n_retire):
+  '''Drop the n_retire oldest trees of a forest or bagging ensemble'''
+  n_retire = min(n_retire, len(model.estimators_) - 1)
+  if n_retire <= 0:
+    return 0
+  model.estimators_ = model.estimators_[n_retire:]
+  if hasattr(model, 'estimators_features_'):
+    model.estimators_features_ = model.estimators_features_[n_retire:]
+    model._seeds = model._seeds[n_retire:]
+  model.n_estimators = len(model.estimators_)
+  return n_retire
+
+def incremental_update(model, X_train, y_train, X_test, y_test, new_trees=500,
+                       retire=0, n_new_train=None, n_new_test=None, max_trees=None):
+  '''Add trees fitted on the grown training set to a fitted forest or
+  bagging ensemble and optionally retire the oldest trees. Without retiring
+  the ensemble grows by new_trees every generation; max_trees retires as
+  many more of the oldest trees as needed to stay at that size.
+  ******
+  Input: previous model, training and test data of this generation, number
+         of trees to add, number of oldest trees to drop, new rows in the
+         train and test set, largest number of trees kept
+  Output: the updated model with extended lineage_ and row_fingerprints_
+  '''
+  if not hasattr(model, 'warm_start'):
+    raise ValueError('%s has no warm_start; fit it from scratch' %type(model).__name__)
+  lineage = list(getattr(model, 'lineage_', []))
+  generation = len(lineage)
+
+  if max_trees:
+    retire = max(retire, len(model.estimators_) + new_trees - max_trees)
+  retired = retire_trees(model, retire)
+  #a fresh seed per generation; warm_start skips one seed per existing tree,
+  #which after retiring trees would hand out seeds already used
+  base_state = lineage[0]['random_state'] if lineage else model.random_state
+  model.random_state = (base_state or 0) + generation
+  retained_seeds = getattr(model, '_seeds', None)
+  model.set_params(warm_start=True, n_estimators=len(model.estimators_) + new_trees)
+  model.fit(X_train, y_train)
+  model.set_params(warm_start=False)
+  if retained_seeds is not None:
+    #a warm start fit of bagging keeps only the seeds of the trees it added;
+    #estimators_samples_ needs one seed per tree
+    model._seeds = np.concatenate([retained_seeds, model._seeds[-new_trees:]])
+
+  model.row_fingerprints_ = {'train': row_fingerprints(X_train, y_train),
+                             'test': row_fingerprints(X_test, y_test)}
+  lineage.append({'generation': generation,
+                  'date': datetime.now().isoformat(timespec='seconds'),
+                  'n_train': len(y_train),
+                  'n_test': len(y_test),
+                  'n_new_train': n_new_train,
+                  'n_new_test': n_new_test,
+                  'trees_added': new_trees,
+                  'trees_retired': retired,
+                  'n_estimators': len(model.estimators_),
+                  'random_state': model.random_state,
+                  'data_hash': data_fingerprint(X_train, y_train)})
+  model.lineage_ = lineage
+  return model
+
+def update_scores(model, X_test, y_test, previous_test):
+  '''Scores of an updated model on the held-out test set and on the test
+  rows new in this generation; used instead of cross-validation, which
+  would refit every tree of the grown ensemble.
+  ******
+  Input: updated model, test data, row fingerprints of the test set of the
+         previous generation
+  Output: dataframe of accuracy, roc_auc, recall, precision and f1 with one
+          row for all and one for the new test rows
+  '''
+  y_test = np.asarray(y_test)
+  proba = model.predict_proba(X_test)[:, 1]
+  predicted = model.classes_[(proba > 0.5).astype(int)]
+  new = ~np.isin(row_fingerprints(X_test, y_test), previous_test)
+  rows = []
+  for name, rows_of in (('test', np.ones(len(y_test), dtype=bool)), ('new test rows', new)):
+    y, p, score = y_test[rows_of], predicted[rows_of], proba[rows_of]
+    both = len(np.unique(y)) == 2
+    rows.append({'rows': name, 'n': int(rows_of.sum()),
+                 'accuracy': metrics.accuracy_score(y, p) if len(y) else np.nan,
+                 'roc_auc': metrics.roc_auc_score(y, score) if both else np.nan,
+                 'recall': metrics.recall_score(y, p, zero_division=0) if len(y) else np.nan,
+                 'precision': metrics.precision_score(y, p, zero_division=0) if len(y) else np.nan,
+                 'f1': metrics.f1_score(y, p, zero_division=0) if len(y) else np.nan})
+  return pd.DataFrame(rows).set_index('rows')
+
+def describe_lineage(model):
+  '''Lineage of a model as text for the log'''
+  lineage = getattr(model, 'lineage_', [])
+  return pd.DataFrame(lineage).to_string(index=False) if lineage else 'no lineage'
@@ -0,0 +1,383 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Local model registry; a SQLite index with one row per stored artifact
+recording trainer, estimator, parameters, features, target, search space,
+data fingerprint, scores, file size and fit time. Every configuration gets a
+key from a hash of everything that determines the fit, so a trainer can look
+up an identical earlier result and load it instead of fitting again'''
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from joblib import dump, load
+
+COLUMNS = ('id', 'created', 'config_key', 'trainer', 'estimator', 'params',
+           'features', 'target', 'search_space', 'data_hash', 'cv_score',
+           'test_score', 'file_size', 'fit_time', 'path')
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS artifacts (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  created TEXT NOT NULL,
+  config_key TEXT NOT NULL,
+  trainer TEXT,
+  estimator TEXT,
+  params TEXT,
+  features TEXT,
+  target TEXT,
+  search_space TEXT,
+  data_hash TEXT,
+  cv_score REAL,
+  test_score REAL,
+  file_size INTEGER,
+  fit_time REAL,
+  path TEXT NOT NULL)'''
+
+###############################################################################
+#
+#  canonical descriptions and hashes
+#
+###############################################################################
+
+def describe(value):
+  '''JSON-able description of parameters, search spaces and estimators that
+  is the same in every run; reprs of frozen scipy distributions and
+  estimators would otherwise contain memory addresses'''
+  if isinstance(value, dict):
+    return {str(key): describe(value[key]) for key in sorted(value, key=str)}
+  if isinstance(value, (list, tuple)):
+    return [describe(item) for item in value]
+  if hasattr(value, 'dist') and hasattr(value, 'args'):
+    return '%s%s' %(value.dist.name, tuple(value.args) + tuple(sorted(value.kwds.items())))
+  if hasattr(value, 'get_params'):
+    return {type(value).__name__: describe(value.get_params(deep=False))}
+  if isinstance(value, np.generic):
+    return value.item()
+  if value is None or isinstance(value, (bool, int, float, str)):
+    return value
+  return repr(value)
+
+def data_fingerprint(X, y=None):
+  '''sha1 of the column names, the feature values and the labels'''
+  sha = hashlib.sha1()
+  if hasattr(X, 'columns'):
+    sha.update(json.dumps([str(column) for column in X.columns]).encode())
+  sha.update(np.ascontiguousarray(np.asarray(X, dtype=np.float64)).tobytes())
+  if y is not None:
+    sha.update(np.ascontiguousarray(np.asarray(y)).tobytes())
+  return sha.hexdigest()
+
+def config_key(trainer, estimator, search_space, features, target, data_hash):
+  '''Key of a configuration; equal keys mean an identical fit'''
+  config = json.dumps({'trainer': trainer,
+                       'estimator': describe(estimator),
+                       'search_space': describe(search_space),
+                       'features': features,
+                       'target': target,
+                       'data_hash': data_hash}, sort_keys=True)
+  return hashlib.sha1(config.encode()).hexdigest()
+
+def search_settings(search):
+  '''Parameter distributions plus the settings of a search that change its
+  result'''
+  space = getattr(search, 'param_distributions', None)
+  if space is None:
+    space = getattr(search, 'param_grid', None)
+  settings = {'space': space,
+              'n_iter': getattr(search, 'n_iter', None),
+              'cv': search.cv,
+              'scoring': search.scoring,
+              'random_state': getattr(search, 'random_state', None)}
+  #staged AdaBoost searches; only added when present so keys of the plain
+  #searches stay as they were
+  if hasattr(search, 'patience'):
+    settings['patience'] = search.patience
+  #model-based searches
+  if hasattr(search, 'gamma'):
+    settings['tpe'] = {'n_startup': search.n_startup, 'gamma': search.gamma,
+                       'n_samples': search.n_samples,
+                       'prior': None if search.prior is None else len(search.prior)}
+  return settings
+
+###############################################################################
+#
+#  registry
+#
+###############################################################################
+
+class ModelRegistry(object):
+  '''SQLite index of model artifacts; artifacts fitted through the registry
+  are stored in an artifacts folder next to the database'''
+
+  def __init__(self, path):
+    self.path = path
+    #data, search space and artifact of the last fit, for the models a
+    #trainer writes from it
+    self.last_fit = None
+    self.artifact_dir = os.path.join(os.path.dirname(os.path.abspath(path)), 'artifacts')
+    os.makedirs(self.artifact_dir, exist_ok=True)
+    with self._connect() as connection:
+      connection.execute(SCHEMA)
+      connection.execute('CREATE INDEX IF NOT EXISTS config_key_index ON artifacts (config_key)')
+
+  @contextmanager
+  def _connect(self):
+    '''connection that commits on success and is always closed'''
+    connection = sqlite3.connect(self.path)
+    connection.row_factory = sqlite3.Row
+    try:
+      with connection:
+        yield connection
+    finally:
+      connection.close()
+
+  def register(self, path, config_key, trainer=None, estimator=None, params=None,
+               features=None, target=None, search_space=None, data_hash=None,
+               cv_score=None, test_score=None, fit_time=None):
+    '''Add one artifact to the index and return its id'''
+    row = (datetime.now().isoformat(timespec='seconds'), config_key, trainer,
+           estimator, json.dumps(describe(params)), json.dumps(features), target,
+           json.dumps(describe(search_space)), data_hash, cv_score, test_score,
+           os.path.getsize(path), fit_time, os.path.abspath(path))
+    with self._connect() as connection:
+      cursor = connection.execute('INSERT INTO artifacts (%s) VALUES (%s)'
+                                  %(', '.join(COLUMNS[1:]), ', '.join('?' * len(row))), row)
+      return cursor.lastrowid
+
+  def lookup(self, config_key):
+    '''Newest artifact of a configuration whose file still exists, or None'''
+    with self._connect() as connection:
+      rows = connection.execute('SELECT * FROM artifacts WHERE config_key = ? '
+                                'ORDER BY id DESC', (config_key,)).fetchall()
+    for row in rows:
+      if os.path.exists(row['path']):
+        return dict(row)
+    return None
+
+  def set_test_score(self, artifact_id, test_score):
+    with self._connect() as connection:
+      connection.execute('UPDATE artifacts SET test_score = ? WHERE id = ?',
+                         (float(test_score), artifact_id))
+
+  def query(self, trainer=None, target=None, estimator=None, feature=None,
+            min_cv_score=None):
+    '''Artifacts matching all given filters as a dataframe, newest first'''
+    where = []
+    values = []
+    for column, value in (('trainer', trainer), ('target', target), ('estimator', estimator)):
+      if value:
+        where.append('%s = ?' %column)
+        values.append(value)
+    if feature:
+      where.append('features LIKE ?')
+      values.append('%%"%s"%%' %feature)
+    if min_cv_score is not None:
+      where.append('cv_score >= ?')
+      values.append(min_cv_score)
+    sql = 'SELECT * FROM artifacts'
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+    with self._connect() as connection:
+      return pd.read_sql_query(sql + ' ORDER BY id DESC', connection, params=values)
+
+  def garbage_collect(self, keep=1, dry_run=False, min_age=3600):
+    '''Drop index rows of missing files, drop all but the newest `keep`
+    artifacts of every configuration and delete files in the artifacts
+    folder that are not indexed. Only files in the artifacts folder are
+    deleted; of models written elsewhere, e.g. the best_* pickles in the
+    trainers' output folders, only the index rows are dropped. Unindexed
+    files younger than min_age seconds are left, a running fit may not
+    have registered them yet.
+    ******
+    Input: artifacts kept per configuration, only report if True, age in
+           seconds below which unindexed files are kept
+    Output: list of removed ids and paths with True where the file is
+            deleted
+    '''
+    with self._connect() as connection:
+      rows = connection.execute('SELECT id, config_key, path FROM artifacts '
+                                'ORDER BY id DESC').fetchall()
+    artifact_dir = os.path.abspath(self.artifact_dir)
+    seen = {}
+    remove = []
+    for row in rows:
+      if not os.path.exists(row['path']):
+        remove.append((row['id'], row['path'], False))
+        continue
+      seen[row['config_key']] = seen.get(row['config_key'], 0) + 1
+      if seen[row['config_key']] > keep:
+        owned = os.path.dirname(os.path.abspath(row['path'])) == artifact_dir
+        remove.append((row['id'], row['path'], owned))
+    indexed = set(row['path'] for row in rows)
+    now = time.time()
+    orphans = [path for path in [os.path.join(artifact_dir, name)
+                                 for name in os.listdir(artifact_dir)]
+               if path not in indexed and now - os.path.getmtime(path) >= min_age]
+
+    if not dry_run:
+      with self._connect() as connection:
+        connection.executemany('DELETE FROM artifacts WHERE id = ?',
+                               [(artifact_id,) for artifact_id, _, _ in remove])
+      for path in [path for _, path, owned in remove if owned] + orphans:
+        os.remove(path)
+    return remove + [(None, path, True) for path in orphans]
+
+  def fit(self, search, X, y, trainer):
+    '''Fit a search or estimator unless an identical configuration is
+    already registered, in which case the stored fitted object is loaded.
+    ******
+    Input: unfitted search or estimator, training data, labels, trainer name
+    Output: fitted search or estimator
+    '''
+    features = [str(column) for column in X.columns] if hasattr(X, 'columns') else None
+    target = getattr(y, 'name', None)
+    estimator = getattr(search, 'estimator', search)
+    space = search_settings(search) if estimator is not search else None
+    data_hash = data_fingerprint(X, y)
+    key = config_key(trainer, estimator, space, features, target, data_hash)
+
+    self.last_fit = {'trainer': trainer, 'features': features, 'target': target,
+                     'data_hash': data_hash, 'search_space': space}
+    prior = self.lookup(key)
+    if prior is not None:
+      print('*    Reusing registered artifact %s from %s' %(prior['path'], prior['created']))
+      self.last_fit.update(id=prior['id'], cv_score=prior['cv_score'])
+      return load(prior['path'])
+
+    start = time.time()
+    fitted = search.fit(X, y)
+    fit_time = time.time() - start
+
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    path = os.path.join(self.artifact_dir, '%s_%s_%s.pkl' %(trainer, key[:12], datestring))
+    dump(fitted, path)
+    cv_score = getattr(fitted, 'best_score_', None)
+    artifact_id = self.register(path, key, trainer, type(estimator).__name__,
+                                getattr(fitted, 'best_params_', None) or describe(estimator),
+                                features, target, space, data_hash,
+                                cv_score=cv_score, fit_time=fit_time)
+    self.last_fit.update(id=artifact_id, cv_score=cv_score)
+    return fitted
+
+  def dump(self, model, path):
+    '''Write a model fitted on the data of the last fit through the registry
+    to path and index it; returns its id, None without an earlier fit'''
+    dump(model, path)
+    if self.last_fit is None:
+      return None
+    fit = self.last_fit
+    key = config_key(fit['trainer'], model, None, fit['features'], fit['target'],
+                     fit['data_hash'])
+    return self.register(path, key, fit['trainer'], type(model).__name__, describe(model),
+                         fit['features'], fit['target'], fit['search_space'],
+                         fit['data_hash'], cv_score=fit['cv_score'])
+
+###############################################################################
+#
+#  registry used by the trainers
+#
+###############################################################################
+
+_active = None
+#artifact ids of the models written by registry_dump, by id() of the model
+_dumped = {}
+
+def open_registry(path):
+  '''Make the registry at path the one used by registry_fit; an empty path
+  switches the registry off'''
+  global _active
+  _active = ModelRegistry(path) if path else None
+  _dumped.clear()
+  return _active
+
+def registry_fit(search, X, y, trainer):
+  '''search.fit(X, y) through the open registry, or a plain fit without one'''
+  if _active is None:
+    return search.fit(X, y)
+  return _active.fit(search, X, y, trainer)
+
+def registry_dump(model, path):
+  '''joblib.dump(model, path), indexed in the open registry with the data,
+  search space and CV score of the last registry_fit'''
+  if _active is None:
+    dump(model, path)
+    return
+  artifact_id = _active.dump(model, path)
+  if artifact_id is not None:
+    _dumped.setdefault(id(model), []).append(artifact_id)
+
+def registry_test_score(model, y_test, y_pred):
+  '''Record the test set accuracy of a model for the artifacts registry_dump
+  wrote of it and for the search of the last registry_fit, whose refit has
+  the same parameters'''
+  if _active is None or _active.last_fit is None:
+    return
+  accuracy = float(np.mean(np.asarray(y_test) == np.asarray(y_pred)))
+  for artifact_id in [_active.last_fit['id']] + _dumped.get(id(model), []):
+    _active.set_test_score(artifact_id, accuracy)
+
+###############################################################################
+#
+#  command line interface
+#
+###############################################################################
+
+def parse_command_line():
+  '''defining the command line input to make it runable'''
+  parser = argparse.ArgumentParser(description='List, query and clean up the model registry')
+
+  parser.add_argument(
+    '--registry',
+    type=str,
+    dest='registry',
+    default='',
+    help='The SQLite registry file')
+
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.add_parser('list', help='List all artifacts')
+
+  query = subparsers.add_parser('query', help='List artifacts matching filters')
+  query.add_argument('--trainer', type=str, dest='trainer', default='')
+  query.add_argument('--target', type=str, dest='target', default='')
+  query.add_argument('--estimator', type=str, dest='estimator', default='')
+  query.add_argument('--feature', type=str, dest='feature', default='',
+                     help='Only artifacts trained with this feature')
+  query.add_argument('--min_cv_score', type=float, dest='min_cv_score', default=None)
+
+  collect = subparsers.add_parser('gc', help='Remove stale and duplicate artifacts')
+  collect.add_argument('--keep', type=int, dest='keep', default=1,
+                       help='Artifacts kept per configuration')
+  collect.add_argument('--dry_run', dest='dry_run', action='store_true',
+                       help='Only report what would be removed')
+
+  args = parser.parse_args()
+  if args.registry == '' or args.command is None:
+    parser.print_help()
+    exit(0)
+  return args
+
+def run():
+  args = parse_command_line()
+  registry = ModelRegistry(args.registry)
+  summary = ['id', 'created', 'trainer', 'estimator', 'target', 'cv_score',
+             'test_score', 'file_size', 'fit_time', 'path']
+
+  if args.command == 'list':
+    print(registry.query()[summary].to_string(index=False))
+  elif args.command == 'query':
+    print(registry.query(args.trainer, args.target, args.estimator, args.feature,
+                         args.min_cv_score)[summary].to_string(index=False))
+  else:
+    removed = registry.garbage_collect(args.keep, args.dry_run)
+    for artifact_id, path, deleted in removed:
+      print('%s %s %s%s' %('would remove' if args.dry_run else 'removed', artifact_id, path,
+                           '' if deleted else ' (index row only)'))
@@ -0,0 +1,166 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Per-stage instrumentation of the trainers; the `stage` decorator records
+wall time, CPU time and peak resident memory of every decorated method or
+helper, nested stages included. With profiling switched on the outermost
+stages also write cProfile statistics and tracemalloc snapshots. CPU time
+and memory are those of the trainer process; work done in joblib worker
+processes shows up as wall time only'''
+import cProfile
+import functools
+import os
+import resource
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+###############################################################################
+#
+#  peak resident memory
+#
+###############################################################################
+
+def read_hwm():
+  '''Peak resident set size in MB since the last reset; VmHWM on Linux,
+  else the lifetime peak from getrusage'''
+  try:
+    with open('/proc/self/status') as status:
+      for line in status:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) / 1024.
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def reset_hwm():
+  '''Reset the peak to the current resident size where the kernel allows it'''
+  try:
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+      clear_refs.write('5')
+  except OSError:
+    pass
+
+###############################################################################
+#
+#  recording stages
+#
+###############################################################################
+
+class StageProfiler(object):
+  '''Collects one record per stage call; with profile=True the outermost
+  stages are run under cProfile and, with memory=True, a tracemalloc
+  snapshot is written when they end'''
+
+  def __init__(self, directory, profile=False, memory=False):
+    self.directory = directory
+    self.profile = profile
+    self.memory = memory
+    self.records = []
+    self.stack = []
+    self.calls = 0
+    if profile:
+      self.profile_dir = os.path.join(directory, 'profile')
+      os.makedirs(self.profile_dir, exist_ok=True)
+      if memory:
+        tracemalloc.start()
+
+  def start(self, name):
+    #the peak so far belongs to every open stage before it is reset
+    hwm = read_hwm()
+    for frame in self.stack:
+      frame['peak'] = max(frame['peak'], hwm)
+    reset_hwm()
+    frame = {'name': name, 'order': self.calls, 'depth': len(self.stack),
+             'peak': read_hwm(), 'wall': time.perf_counter(),
+             'cpu': time.process_time(), 'profiler': None}
+    if self.profile and not self.stack:
+      frame['profiler'] = cProfile.Profile()
+      frame['profiler'].enable()
+    self.stack.append(frame)
+    self.calls += 1
+
+  def stop(self):
+    frame = self.stack.pop()
+    wall = time.perf_counter() - frame['wall']
+    cpu = time.process_time() - frame['cpu']
+    peak = max(frame['peak'], read_hwm())
+    for parent in self.stack:
+      parent['peak'] = max(parent['peak'], peak)
+    order = frame['order']
+    if frame['profiler'] is not None:
+      frame['profiler'].disable()
+      frame['profiler'].dump_stats(os.path.join(self.profile_dir, '%02d_%s.pstats'
+                                                %(order, frame['name'])))
+      if self.memory:
+        tracemalloc.take_snapshot().dump(os.path.join(self.profile_dir, '%02d_%s.tracemalloc'
+                                                      %(order, frame['name'])))
+    self.records.append({'order': order, 'stage': frame['name'], 'depth': frame['depth'],
+                         'wall_s': wall, 'cpu_s': cpu, 'peak_rss_mb': peak})
+
+  def summary(self):
+    '''Stages in the order they started'''
+    table = pd.DataFrame(self.records, columns=['order', 'stage', 'depth', 'wall_s',
+                                                'cpu_s', 'peak_rss_mb'])
+    #records are appended when a stage ends, so children come before parents
+    return table.sort_values('order').drop(columns='order').reset_index(drop=True)
+
+  def write(self):
+    '''Write the stage table as CSV into the output directory and print it'''
+    table = self.summary()
+    datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H%M')
+    table.to_csv(os.path.join(self.directory, 'stage_timings_'+datestring+'.csv'), index=False)
+    names = ['  ' * depth + name for name, depth in zip(table['stage'], table['depth'])]
+    width = max([len(name) for name in names] + [5])
+    shown = table.assign(stage=[name.ljust(width) for name in names])
+    print('*' *80)
+    print('*    Time and memory per stage')
+    print('*' *80)
+    print(shown.drop(columns='depth').to_string(index=False, float_format='%.2f'))
+    if self.profile and self.memory:
+      tracemalloc.stop()
+    return table
+
+###############################################################################
+#
+#  profiler used by the trainers
+#
+###############################################################################
+
+_active = None
+
+def open_profiler(directory, profile=False, memory=False):
+  '''Record the stages of this run into directory; profile adds cProfile
+  output of the outermost stages, memory adds tracemalloc snapshots'''
+  global _active
+  os.makedirs(directory, exist_ok=True)
+  _active = StageProfiler(directory, profile, memory)
+  return _active
+
+def close_profiler():
+  '''Write the stage table of the open profiler and switch it off'''
+  global _active
+  if _active is None:
+    return None
+  table = _active.write()
+  _active = None
+  return table
+
+def stage(function):
+  '''Decorator recording a method or helper as a stage of the open profiler;
+  without an open profiler the function runs unchanged'''
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    profiler = _active
+    if profiler is None:
+      return function(*args, **kwargs)
+    profiler.start(function.__name__)
+    try:
+      return function(*args, **kwargs)
+    finally:
+      profiler.stop()
+  return wrapper
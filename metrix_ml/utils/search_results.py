@@ -0,0 +1,337 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Store of the full cv_results_ of every search; a SQLite file with one row
+per search run and one row per candidate holding its parameters, the mean,
+spread and rank of its test scores, the split scores and the fit and score
+times. Later analyses (sensitivity of the score to a parameter, choosing
+the refit with a different rule, seeding a new search) read the stored
+candidates instead of running the search again'''
+import argparse
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from metrix_ml.utils.model_registry import (config_key, data_fingerprint, describe,
+                                            search_settings)
+
+SCHEMA = ('''CREATE TABLE IF NOT EXISTS runs (
+  run_id TEXT PRIMARY KEY,
+  created TEXT NOT NULL,
+  trainer TEXT,
+  estimator TEXT,
+  config_key TEXT,
+  data_hash TEXT,
+  search_space TEXT,
+  scoring TEXT,
+  n_candidates INTEGER,
+  n_splits INTEGER,
+  best_index INTEGER,
+  best_score REAL,
+  best_params TEXT)''',
+          '''CREATE TABLE IF NOT EXISTS candidates (
+  run_id TEXT NOT NULL REFERENCES runs (run_id),
+  candidate INTEGER NOT NULL,
+  params TEXT,
+  rank_test_score INTEGER,
+  mean_test_score REAL,
+  std_test_score REAL,
+  mean_fit_time REAL,
+  std_fit_time REAL,
+  mean_score_time REAL,
+  std_score_time REAL,
+  split_test_scores TEXT,
+  other_scores TEXT,
+  PRIMARY KEY (run_id, candidate))''',
+          'CREATE INDEX IF NOT EXISTS runs_config_key_index ON runs (config_key)')
+
+CANDIDATE_COLUMNS = ['rank_test_score', 'mean_test_score', 'std_test_score',
+                     'mean_fit_time', 'std_fit_time', 'mean_score_time', 'std_score_time']
+
+###############################################################################
+#
+#  cv_results_ as rows
+#
+###############################################################################
+
+def _value(value):
+  '''Plain python value of a cv_results_ entry; masked entries become None'''
+  if value is np.ma.masked:
+    return None
+  if isinstance(value, np.generic):
+    return value.item()
+  return value
+
+def candidate_rows(run_id, results):
+  '''One tuple per candidate of a cv_results_ dictionary'''
+  split_keys = sorted([key for key in results if key.startswith('split')
+                       and key.endswith('_test_score')],
+                      key=lambda key: int(key[5:].split('_')[0]))
+  other_keys = [key for key in results if key not in CANDIDATE_COLUMNS
+                and key not in split_keys and key != 'params'
+                and not key.startswith('param_')]
+  rows = []
+  for index, params in enumerate(results['params']):
+    rows.append((run_id, index, json.dumps(describe(params)))
+                + tuple(_value(results[key][index]) if key in results else None
+                        for key in CANDIDATE_COLUMNS)
+                + (json.dumps([_value(results[key][index]) for key in split_keys]),
+                   json.dumps({key: _value(results[key][index]) for key in other_keys})))
+  return rows
+
+def expand_params(table):
+  '''Add a param_<name> column for every parameter in the params JSON'''
+  params = [json.loads(value) for value in table['params']]
+  names = sorted(set(name for entry in params for name in entry))
+  for name in names:
+    values = [entry.get(name) for entry in params]
+    table['param_'+name] = [json.dumps(value) if isinstance(value, (dict, list)) else value
+                            for value in values]
+  return table
+
+###############################################################################
+#
+#  results store
+#
+###############################################################################
+
+class ResultsStore(object):
+  '''SQLite file with the candidates of every stored search run'''
+
+  def __init__(self, path):
+    self.path = path
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with self._connect() as connection:
+      for statement in SCHEMA:
+        connection.execute(statement)
+
+  @contextmanager
+  def _connect(self):
+    '''connection that commits on success and is always closed'''
+    connection = sqlite3.connect(self.path)
+    connection.row_factory = sqlite3.Row
+    try:
+      with connection:
+        yield connection
+    finally:
+      connection.close()
+
+  def lookup(self, key):
+    '''run_id of the newest run of a configuration, or None'''
+    with self._connect() as connection:
+      row = connection.execute('SELECT run_id FROM runs WHERE config_key = ? '
+                               'ORDER BY created DESC LIMIT 1', (key,)).fetchone()
+    return None if row is None else row['run_id']
+
+  def store(self, search, trainer, key=None, data_hash=None):
+    '''Store the cv_results_ of a fitted search and return its run id; a
+    configuration stored before is not stored twice.
+    ******
+    Input: fitted search, trainer name, configuration key and data hash from
+           the model registry
+    Output: run id
+    '''
+    if key is not None:
+      prior = self.lookup(key)
+      if prior is not None:
+        return prior
+    results = search.cv_results_
+    now = datetime.now()
+    run_id = '%s_%s%s' %(trainer, datetime.strftime(now, '%Y%m%d_%H%M%S'),
+                         '_'+key[:8] if key else '')
+    best_index = getattr(search, 'best_index_', None)
+    run = (run_id, now.isoformat(timespec='seconds'), trainer,
+           type(search.estimator).__name__, key, data_hash,
+           json.dumps(describe(search_settings(search))), json.dumps(describe(search.scoring)),
+           len(results['params']), getattr(search, 'n_splits_', None),
+           None if best_index is None else int(best_index),
+           _value(getattr(search, 'best_score_', None)),
+           json.dumps(describe(getattr(search, 'best_params_', None))))
+    rows = candidate_rows(run_id, results)
+    with self._connect() as connection:
+      connection.execute('INSERT INTO runs VALUES (%s)' %', '.join('?' * len(run)), run)
+      connection.executemany('INSERT INTO candidates VALUES (%s)'
+                             %', '.join('?' * len(rows[0])), rows)
+    return run_id
+
+  def runs(self, trainer=None, estimator=None):
+    '''Stored runs matching the filters as a dataframe, newest first'''
+    where = []
+    values = []
+    for column, value in (('trainer', trainer), ('estimator', estimator)):
+      if value:
+        where.append('%s = ?' %column)
+        values.append(value)
+    sql = 'SELECT * FROM runs'
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+    with self._connect() as connection:
+      return pd.read_sql_query(sql + ' ORDER BY created DESC', connection, params=values)
+
+  def candidates(self, run_id):
+    '''Candidates of a run with one column per parameter, best first'''
+    with self._connect() as connection:
+      table = pd.read_sql_query('SELECT * FROM candidates WHERE run_id = ? '
+                                'ORDER BY rank_test_score, candidate', connection,
+                                params=[run_id])
+    if table.empty:
+      raise KeyError('no stored run %s' %run_id)
+    return expand_params(table)
+
+###############################################################################
+#
+#  analyses of stored runs
+#
+###############################################################################
+
+def sensitivity(candidates, param, bins=10):
+  '''Mean test score per value of a parameter; numeric parameters with many
+  values are grouped into quantile bins.
+  ******
+  Input: candidates of a run, parameter name, number of bins
+  Output: dataframe with count, mean, std and max of mean_test_score
+  '''
+  column = 'param_'+param
+  if column not in candidates:
+    raise KeyError('%s is not a parameter of this run' %param)
+  values = candidates[column]
+  numeric = pd.to_numeric(values, errors='coerce')
+  if numeric.notnull().all() and numeric.nunique() > bins:
+    values = pd.qcut(numeric, bins, duplicates='drop')
+  else:
+    #None is a value of its own, e.g. class_weight None
+    values = values.fillna('None').astype(str)
+  return candidates.groupby(values, observed=True)['mean_test_score'].agg(
+                                        ['count', 'mean', 'std', 'max'])
+
+def select(candidates, rule='best'):
+  '''Candidate chosen by a selection rule; 'best' is the refit of the
+  search, 'one_std' the fastest fitting candidate whose mean score is
+  within one standard deviation of the best one'''
+  best = candidates.loc[candidates['mean_test_score'].idxmax()]
+  if rule == 'best':
+    return best
+  if rule == 'one_std':
+    close = candidates[candidates['mean_test_score']
+                       >= best['mean_test_score'] - best['std_test_score']]
+    return close.loc[close['mean_fit_time'].idxmin()]
+  raise ValueError('unknown selection rule %s' %rule)
+
+###############################################################################
+#
+#  store used by the trainers
+#
+###############################################################################
+
+_active = None
+
+def open_results(path):
+  '''Make the store at path the one searches are written to; an empty path
+  switches storing off'''
+  global _active
+  _active = ResultsStore(path) if path else None
+  return _active
+
+def store_search(search, X, y, trainer):
+  '''Store the cv_results_ of a fitted search in the open store; returns the
+  run id, None without a store or for plain estimators'''
+  if _active is None or not hasattr(search, 'cv_results_'):
+    return None
+  features = [str(column) for column in X.columns] if hasattr(X, 'columns') else None
+  data_hash = data_fingerprint(X, y)
+  key = config_key(trainer, search.estimator, search_settings(search), features,
+                   getattr(y, 'name', None), data_hash)
+  run_id = _active.store(search, trainer, key, data_hash)
+  print('*    Search results are run %s in %s' %(run_id, _active.path))
+  return run_id
+
+def stored_candidates(estimator, data_hash):
+  '''Candidates of all runs in the open store that searched the same
+  estimator on the same data, None without a store'''
+  if _active is None:
+    return None
+  runs = _active.runs(estimator=estimator)
+  runs = runs[runs['data_hash'] == data_hash]
+  if runs.empty:
+    return None
+  return pd.concat([_active.candidates(run_id) for run_id in runs['run_id']],
+                   ignore_index=True, sort=False)
+
+###############################################################################
+#
+#  command line interface
+#
+###############################################################################
+
+def parse_command_line():
+  '''defining the command line input to make it runable'''
+  parser = argparse.ArgumentParser(description='List and query stored search results')
+
+  parser.add_argument(
+    '--results',
+    type=str,
+    dest='results',
+    default='',
+    help='The SQLite results store')
+
+  subparsers = parser.add_subparsers(dest='command')
+  runs = subparsers.add_parser('list', help='List stored search runs')
+  runs.add_argument('--trainer', type=str, dest='trainer', default='')
+  runs.add_argument('--estimator', type=str, dest='estimator', default='')
+
+  show = subparsers.add_parser('show', help='Show the best candidates of a run')
+  show.add_argument('run_id', type=str)
+  show.add_argument('--top', type=int, dest='top', default=20,
+                    help='Number of candidates shown')
+
+  sensitive = subparsers.add_parser('sensitivity', help='Mean score per parameter value')
+  sensitive.add_argument('run_id', type=str)
+  sensitive.add_argument('--param', type=str, dest='param', required=True)
+  sensitive.add_argument('--bins', type=int, dest='bins', default=10)
+
+  choose = subparsers.add_parser('select', help='Parameters chosen by a selection rule')
+  choose.add_argument('run_id', type=str)
+  choose.add_argument('--rule', type=str, dest='rule', default='best',
+                      choices=['best', 'one_std'])
+
+  export = subparsers.add_parser('export', help='Write the candidates of a run as CSV')
+  export.add_argument('run_id', type=str)
+  export.add_argument('--output', type=str, dest='output', required=True)
+
+  args = parser.parse_args()
+  if args.results == '' or args.command is None:
+    parser.print_help()
+    exit(0)
+  return args
+
+def run():
+  args = parse_command_line()
+  store = ResultsStore(args.results)
+  summary = ['run_id', 'created', 'trainer', 'estimator', 'n_candidates', 'n_splits',
+             'best_score']
+
+  if args.command == 'list':
+    print(store.runs(args.trainer, args.estimator)[summary].to_string(index=False))
+    return
+  candidates = store.candidates(args.run_id)
+  shown = ['rank_test_score', 'mean_test_score', 'std_test_score', 'mean_fit_time'] + \
+          [column for column in candidates if column.startswith('param_')]
+  if args.command == 'show':
+    print(candidates[shown].head(args.top).to_string(index=False))
+  elif args.command == 'sensitivity':
+    print(sensitivity(candidates, args.param, args.bins).to_string())
+  elif args.command == 'select':
+    chosen = select(candidates, args.rule)
+    print(chosen[shown].to_string())
+    print(json.dumps(json.loads(chosen['params'])))
+  else:
+    candidates.to_csv(args.output, index=False)
+    print('*    Wrote %s candidates to %s' %(len(candidates), args.output))
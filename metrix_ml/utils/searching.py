@@ -0,0 +1,31 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Hyperparameter searches of the trainers; a search gets the folds of the
+open split registry and becomes a TPE search while open_tpe is on, is then
+fitted through the model registry and its cv_results_ go to the results
+store. Each of those is switched on or off in its own module'''
+from metrix_ml.utils.model_registry import registry_fit
+from metrix_ml.utils.search_results import store_search
+from metrix_ml.utils.split_registry import registered_cv
+from metrix_ml.utils.tpe_search import model_based
+
+###############################################################################
+#
+#  search used by the trainers
+#
+###############################################################################
+
+def run_search(search, X, y, trainer):
+  '''search.fit(X, y) with the open split registry, TPE backend, model
+  registry and results store.
+  ******
+  Input: unfitted search or estimator, training data, labels, trainer name
+  Output: fitted search or estimator
+  '''
+  search = registered_cv(model_based(search, X, y), y)
+  fitted = registry_fit(search, X, y, trainer)
+  store_search(fitted, X, y, trainer)
+  return fitted
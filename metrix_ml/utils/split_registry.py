@@ -0,0 +1,133 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Registry of train/test splits and cross-validation folds shared by all
+trainers. Indices are computed once per dataset fingerprint, split settings
+and seed, stored as int32 .npy files and handed out as read-only memory
+maps, so every trainer on the same data trains and tests on the same rows
+whatever columns it uses. The fingerprint covers the row index and the
+labels only. Splits are made exactly as train_test_split and the default
+StratifiedKFold of the searches make them, so results stay comparable with
+earlier runs'''
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold, train_test_split
+
+###############################################################################
+#
+#  fingerprints and stored indices
+#
+###############################################################################
+
+def label_fingerprint(y):
+  '''sha1 of the row index and the labels'''
+  labels = y if isinstance(y, pd.Series) else pd.Series(np.asarray(y))
+  return hashlib.sha1(pd.util.hash_pandas_object(labels, index=True).values.tobytes()).hexdigest()
+
+class RegisteredFolds(object):
+  '''CV splitter handing out stored fold indices; positions refer to the rows
+  of the training set the folds were registered for'''
+
+  def __init__(self, key, folds):
+    self.key = key
+    self.folds = folds
+
+  def split(self, X=None, y=None, groups=None):
+    for train, test in self.folds:
+      yield train, test
+
+  def get_n_splits(self, X=None, y=None, groups=None):
+    return len(self.folds)
+
+  def __repr__(self):
+    return 'RegisteredFolds(%r)' %self.key
+
+class SplitRegistry(object):
+  '''Directory of stored split indices'''
+
+  def __init__(self, directory):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+  def _path(self, key, name):
+    return os.path.join(self.directory, '%s_%s.npy' %(key, name))
+
+  def _load(self, key, names):
+    paths = [self._path(key, name) for name in names]
+    if not all(os.path.exists(path) for path in paths):
+      return None
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+  def _save(self, key, arrays):
+    for name, array in arrays.items():
+      #written under a temporary name, so a parallel trainer never reads a
+      #half written file
+      temporary = self._path(key, name) + '.%s.tmp' %os.getpid()
+      with open(temporary, 'wb') as index_file:
+        np.save(index_file, np.asarray(array, dtype=np.int32))
+      os.replace(temporary, self._path(key, name))
+
+  def holdout(self, y, test_size=0.2, random_state=42, stratify=True):
+    '''Positions of the train and test rows.
+    ******
+    Input: labels, test fraction, seed, stratify on the labels
+    Output: read-only int32 arrays of train and test positions
+    '''
+    key = 'holdout_%s_%s_%s%s' %(label_fingerprint(y)[:16], test_size, random_state,
+                                 '_stratified' if stratify else '')
+    stored = self._load(key, ['train', 'test'])
+    if stored is None:
+      train, test = train_test_split(np.arange(len(y)), test_size=test_size,
+                                     random_state=random_state,
+                                     stratify=y if stratify else None)
+      self._save(key, {'train': train, 'test': test})
+      stored = self._load(key, ['train', 'test'])
+    return stored[0], stored[1]
+
+  def folds(self, y, n_splits=3):
+    '''Stratified folds of a training set as a CV splitter'''
+    key = 'folds_%s_%s' %(label_fingerprint(y)[:16], n_splits)
+    names = ['test%s' %fold for fold in range(n_splits)]
+    stored = self._load(key, names)
+    if stored is None:
+      splits = StratifiedKFold(n_splits).split(np.zeros(len(y)), y)
+      self._save(key, {name: test for name, (_, test) in zip(names, splits)})
+      stored = self._load(key, names)
+    rows = np.arange(len(y), dtype=np.int32)
+    folds = [(np.setdiff1d(rows, test, assume_unique=True), test) for test in stored]
+    return RegisteredFolds(key, folds)
+
+###############################################################################
+#
+#  registry used by the trainers
+#
+###############################################################################
+
+_active = None
+
+def open_splits(directory):
+  '''Make the registry in directory the one used by registry_split and
+  registered_cv; an empty directory switches it off'''
+  global _active
+  _active = SplitRegistry(directory) if directory else None
+  return _active
+
+def registry_split(X, y, test_size=0.2, random_state=42, stratify=None):
+  '''train_test_split(X, y, ...) with the rows taken from the open registry;
+  a plain train_test_split without one'''
+  if _active is None:
+    return train_test_split(X, y, test_size=test_size, random_state=random_state,
+                            stratify=stratify)
+  train, test = _active.holdout(y, test_size, random_state, stratify is not None)
+  return X.iloc[train], X.iloc[test], y.iloc[train], y.iloc[test]
+
+def registered_cv(search, y):
+  '''Give a search with an integer cv the stored folds of its training set'''
+  if _active is None or not isinstance(getattr(search, 'cv', None), int):
+    return search
+  return search.set_params(cv=_active.folds(y, search.cv))
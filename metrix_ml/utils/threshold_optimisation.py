@@ -0,0 +1,174 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Threshold optimisation for binary classifiers; the scores are sorted once
+and the confusion counts at every distinct threshold come from a cumulative
+sum, so ROC, precision-recall, sensitivity, specificity and F-beta curves
+are all read off the same table'''
+import matplotlib
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+CRITERIA = ('youden', 'f_beta', 'accuracy', 'sensitivity', 'specificity')
+
+###############################################################################
+#
+#  confusion counts at every threshold
+#
+###############################################################################
+
+def threshold_curves(y_true, scores, beta=1.0):
+  '''Confusion counts and derived rates for predicting class 1 when
+  score >= threshold, for every distinct score.
+  ******
+  Input: true labels with class 1 as positive, scores for class 1, beta of
+         the F-beta score
+  Output: dataframe with one row per threshold in descending order, starting
+          with threshold inf where nothing is predicted positive; columns
+          threshold, tp, fp, tn, fn, sensitivity, specificity, fpr, precision,
+          recall, f_beta, accuracy, youden
+  '''
+  scores = np.asarray(scores, dtype=np.float64)
+  positive = np.asarray(y_true) == 1
+  order = np.argsort(scores, kind='mergesort')[::-1]
+  scores = scores[order]
+  positive = positive[order]
+
+  #last position of every run of equal scores
+  last = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+  tp = np.r_[0, np.cumsum(positive)[last]]
+  fp = np.r_[0, last + 1] - tp
+  n_pos = positive.sum()
+  n_neg = len(positive) - n_pos
+  fn = n_pos - tp
+  tn = n_neg - fp
+
+  with np.errstate(invalid='ignore', divide='ignore'):
+    sensitivity = tp / n_pos if n_pos else np.zeros(len(tp))
+    fpr = fp / n_neg if n_neg else np.zeros(len(fp))
+    #nothing predicted positive counts as precision 1 like sklearn
+    precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+    b2 = beta ** 2
+    denominator = b2 * precision + sensitivity
+    f_beta = np.where(denominator > 0,
+                      (1 + b2) * precision * sensitivity / denominator, 0.0)
+
+  return pd.DataFrame({'threshold': np.r_[np.inf, scores[last]],
+                       'tp': tp,
+                       'fp': fp,
+                       'tn': tn,
+                       'fn': fn,
+                       'sensitivity': sensitivity,
+                       'specificity': 1 - fpr,
+                       'fpr': fpr,
+                       'precision': precision,
+                       'recall': sensitivity,
+                       'f_beta': f_beta,
+                       'accuracy': (tp + tn) / len(positive),
+                       'youden': sensitivity - fpr})
+
+def roc_arrays(curves):
+  '''fpr, tpr and thresholds laid out like sklearn.metrics.roc_curve'''
+  return (curves['fpr'].values, curves['sensitivity'].values,
+          curves['threshold'].values)
+
+def precision_recall_arrays(curves):
+  '''precisions, recalls and thresholds laid out like
+  sklearn.metrics.precision_recall_curve'''
+  finite = curves.iloc[1:][::-1]
+  return (np.r_[finite['precision'].values, 1.0],
+          np.r_[finite['recall'].values, 0.0],
+          finite['threshold'].values)
+
+def roc_auc(curves):
+  '''Area under the ROC curve by the trapezoidal rule'''
+  fpr, tpr, _ = roc_arrays(curves)
+  return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+###############################################################################
+#
+#  choosing and evaluating thresholds
+#
+###############################################################################
+
+def evaluate_thresholds(curves, thresholds):
+  '''Rows of the curves table for predicting class 1 at score >= threshold
+  for every requested threshold'''
+  descending = -curves['threshold'].values
+  rows = np.searchsorted(descending, -np.asarray(thresholds, dtype=np.float64),
+                         side='right') - 1
+  evaluated = curves.iloc[rows].copy()
+  evaluated.insert(0, 'requested', thresholds)
+  return evaluated.reset_index(drop=True)
+
+def choose_threshold(curves, criterion='youden', target=None):
+  '''Pick a threshold from the curves table.
+  ******
+  Input: output of threshold_curves, criterion, target rate for the
+         'sensitivity' and 'specificity' criteria
+  Output: dict with the chosen row of the curves table and the criterion;
+          youden, f_beta and accuracy are maximised, sensitivity keeps the
+          highest threshold reaching the target sensitivity and specificity
+          the lowest threshold still reaching the target specificity
+  '''
+  if criterion not in CRITERIA:
+    raise ValueError('unknown threshold criterion %s, use one of %s'
+                     %(criterion, ', '.join(CRITERIA)))
+  finite = curves.iloc[1:]
+  if criterion in ('sensitivity', 'specificity'):
+    if target is None:
+      raise ValueError('criterion %s needs a target rate' %criterion)
+    reached = np.flatnonzero(finite[criterion].values >= target)
+    if len(reached) == 0:
+      raise ValueError('no threshold reaches %s %s' %(criterion, target))
+    row = reached[0] if criterion == 'sensitivity' else reached[-1]
+  else:
+    row = int(np.argmax(finite[criterion].values))
+  chosen = finite.iloc[row].to_dict()
+  chosen['criterion'] = criterion
+  chosen['target'] = target
+  return chosen
+
+###############################################################################
+#
+#  threshold in the model artifact
+#
+###############################################################################
+
+def store_threshold(model, chosen):
+  '''Attach the chosen threshold to a fitted model so it is pickled with it'''
+  model.threshold_metadata_ = dict(chosen)
+  return model
+
+def load_threshold(model, default=0.5):
+  '''Threshold stored with a model or the default for older pickles'''
+  metadata = getattr(model, 'threshold_metadata_', None)
+  if metadata is None:
+    return default
+  return metadata['threshold']
+
+###############################################################################
+#
+#  plotting
+#
+###############################################################################
+
+def plot_threshold_curves(curves, chosen, title, file_name):
+  '''Draw sensitivity, specificity, precision and F-beta against the
+  threshold and mark the chosen one'''
+  finite = curves.iloc[1:]
+  for column in ('sensitivity', 'specificity', 'precision', 'f_beta'):
+    plt.plot(finite['threshold'], finite[column], label=column)
+  plt.axvline(chosen['threshold'], color='k', linestyle='--',
+              label='chosen (%s)' %chosen['criterion'])
+  plt.title(title)
+  plt.xlabel('Threshold')
+  plt.ylim([0, 1])
+  plt.legend(loc='best')
+  plt.savefig(file_name)
+  plt.close()
@@ -0,0 +1,323 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Model-based hyperparameter search with a tree-structured Parzen estimator
+(TPE). Every parameter is mapped onto the quantiles of its distribution in
+param_distributions, so the search starts from exactly the prior a
+randomised search samples from; after a few random candidates each new
+candidate is the one, out of a number drawn from the density of the best
+candidates so far, with the highest ratio of that density to the density
+of the others. Candidates are cross-validated in parallel worker processes
+and a new one is proposed as soon as a worker is free. Candidates of
+earlier searches, e.g. from the results store, can seed the densities'''
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from joblib import effective_n_jobs
+from scipy.stats import norm, rankdata, rv_discrete
+from sklearn.base import BaseEstimator, clone
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import check_cv
+
+from metrix_ml.utils.model_registry import data_fingerprint, describe
+from metrix_ml.utils.search_results import stored_candidates
+
+###############################################################################
+#
+#  parameters as points in the unit cube
+#
+###############################################################################
+
+class ParzenSpace(object):
+  '''param_distributions as a vector of dimensions; scipy distributions
+  become quantiles in (0, 1), lists become category indices'''
+
+  def __init__(self, param_distributions):
+    self.names = sorted(param_distributions)
+    self.dimensions = [param_distributions[name] for name in self.names]
+    self.choice = [not hasattr(dimension, 'ppf') for dimension in self.dimensions]
+    self.discrete = [not choice and isinstance(dimension.dist, rv_discrete)
+                     for dimension, choice in zip(self.dimensions, self.choice)]
+
+  def sample(self, rng, n):
+    '''n points drawn from the prior'''
+    points = rng.uniform(size=(n, len(self.names)))
+    for d, dimension in enumerate(self.dimensions):
+      if self.choice[d]:
+        points[:, d] = rng.randint(len(dimension), size=n)
+    return points
+
+  def to_params(self, point):
+    params = {}
+    for d, (name, dimension) in enumerate(zip(self.names, self.dimensions)):
+      if self.choice[d]:
+        params[name] = dimension[int(point[d])]
+      elif self.discrete[d]:
+        params[name] = int(dimension.ppf(point[d]))
+      else:
+        params[name] = float(dimension.ppf(point[d]))
+    return params
+
+  def from_params(self, params):
+    '''Point of a parameter set, None if it lies outside this space'''
+    point = []
+    for d, (name, dimension) in enumerate(zip(self.names, self.dimensions)):
+      if name not in params:
+        return None
+      value = params[name]
+      if self.choice[d]:
+        #stored parameters went through describe, so compare descriptions
+        matches = [k for k, option in enumerate(dimension)
+                   if describe(option) == describe(value)]
+        if not matches:
+          return None
+        point.append(matches[0])
+        continue
+      try:
+        value = float(value)
+      except (TypeError, ValueError):
+        return None
+      low, high = dimension.support()
+      if not low <= value <= high:
+        return None
+      if self.discrete[d]:
+        #the middle of the quantiles that give this value
+        quantile = (dimension.cdf(value - 1) + dimension.cdf(value)) / 2
+      else:
+        quantile = dimension.cdf(value)
+      point.append(min(max(quantile, 1e-9), 1 - 1e-9))
+    return np.asarray(point, dtype=float)
+
+###############################################################################
+#
+#  Parzen estimators
+#
+###############################################################################
+
+def _bandwidth(centres):
+  if len(centres) < 2:
+    return 0.25
+  return float(np.clip(1.06 * centres.std() * len(centres) ** -0.2, 0.03, 0.5))
+
+def log_density(x, centres, n_options=None):
+  '''Log density of a Parzen estimator at x; a mixture of the uniform prior
+  and a Gaussian truncated to (0, 1) at every centre, or for a categorical
+  dimension the option counts plus one'''
+  if n_options is not None:
+    counts = np.bincount(centres.astype(int), minlength=n_options) + 1.
+    return np.log(counts[x.astype(int)] / counts.sum())
+  if len(centres) == 0:
+    return np.zeros(len(x))
+  bandwidth = _bandwidth(centres)
+  mass = norm.cdf((1 - centres) / bandwidth) - norm.cdf(-centres / bandwidth)
+  kernels = norm.pdf((x[:, None] - centres[None, :]) / bandwidth) / (bandwidth * mass)
+  return np.log((1. + kernels.sum(axis=1)) / (len(centres) + 1))
+
+def sample_density(rng, centres, n, n_options=None):
+  '''n draws from the Parzen estimator of log_density'''
+  if n_options is not None:
+    counts = np.bincount(centres.astype(int), minlength=n_options) + 1.
+    return rng.choice(n_options, size=n, p=counts / counts.sum()).astype(float)
+  component = rng.randint(len(centres) + 1, size=n)
+  draws = rng.uniform(size=n)
+  kernel = component > 0
+  if kernel.any():
+    centre = centres[component[kernel] - 1]
+    bandwidth = _bandwidth(centres)
+    low = norm.cdf(-centre / bandwidth)
+    high = norm.cdf((1 - centre) / bandwidth)
+    draws[kernel] = centre + bandwidth * norm.ppf(low + draws[kernel] * (high - low))
+  return np.clip(draws, 1e-9, 1 - 1e-9)
+
+def propose(space, points, scores, rng, n_startup=10, gamma=0.25, n_samples=24):
+  '''Next candidate point.
+  ******
+  Input: ParzenSpace, points and scores of the candidates so far, random
+         state, candidates drawn from the prior first, fraction of the
+         candidates counted as good, draws compared per proposal
+  Output: point of the next candidate
+  '''
+  if len(points) < n_startup:
+    return space.sample(rng, 1)[0]
+  points = np.asarray(points)
+  order = np.argsort(-np.asarray(scores), kind='stable')
+  n_good = max(1, int(np.ceil(gamma * len(points))))
+  good, bad = points[order[:n_good]], points[order[n_good:]]
+  candidates = np.empty((n_samples, len(space.names)))
+  ratio = np.zeros(n_samples)
+  for d, dimension in enumerate(space.dimensions):
+    n_options = len(dimension) if space.choice[d] else None
+    candidates[:, d] = sample_density(rng, good[:, d], n_samples, n_options)
+    ratio += (log_density(candidates[:, d], good[:, d], n_options)
+              - log_density(candidates[:, d], bad[:, d], n_options))
+  return candidates[int(np.argmax(ratio))]
+
+###############################################################################
+#
+#  evaluating a candidate
+#
+###############################################################################
+
+def evaluate_candidate(estimator, params, X, y, folds, scoring):
+  '''Cross-validated test scores, fit and score times of one candidate'''
+  scorer = check_scoring(estimator, scoring)
+  scores, fit_times, score_times = [], [], []
+  for train, test in folds:
+    model = clone(estimator).set_params(**params)
+    start = time.perf_counter()
+    model.fit(X[train], y[train])
+    fit_times.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    scores.append(scorer(model, X[test], y[test]))
+    score_times.append(time.perf_counter() - start)
+  return scores, fit_times, score_times
+
+###############################################################################
+#
+#  search
+#
+###############################################################################
+
+class TPESearchCV(BaseEstimator):
+  '''Drop-in for RandomizedSearchCV with candidates proposed by TPE; fit sets
+  cv_results_, best_params_, best_score_, best_index_, n_splits_ and, with
+  refit, best_estimator_. prior is a dataframe of earlier candidates with a
+  JSON params column and mean_test_score, as the results store returns
+  them; they seed the densities but are not refitted. Candidates still
+  being evaluated are not known to the proposals, so the first n_jobs
+  proposals of a seeded search are made from the same densities'''
+
+  def __init__(self, estimator, param_distributions, n_iter=50, cv=3, scoring=None,
+               n_startup=10, gamma=0.25, n_samples=24, prior=None, refit=True,
+               random_state=None, n_jobs=None):
+    self.estimator = estimator
+    self.param_distributions = param_distributions
+    self.n_iter = n_iter
+    self.cv = cv
+    self.scoring = scoring
+    self.n_startup = n_startup
+    self.gamma = gamma
+    self.n_samples = n_samples
+    self.prior = prior
+    self.refit = refit
+    self.random_state = random_state
+    self.n_jobs = n_jobs
+
+  def _prior_points(self, space):
+    points, scores = [], []
+    if self.prior is None:
+      return points, scores
+    for params, score in zip(self.prior['params'], self.prior['mean_test_score']):
+      point = space.from_params(json.loads(params) if isinstance(params, str) else params)
+      if point is not None and score is not None and np.isfinite(score):
+        points.append(point)
+        scores.append(float(score))
+    return points, scores
+
+  def fit(self, X, y):
+    space = ParzenSpace(self.param_distributions)
+    rng = np.random.RandomState(self.random_state)
+    folds = list(check_cv(self.cv, y, classifier=True).split(X, y))
+    X_array = np.asarray(X)
+    y_array = np.asarray(y)
+
+    points, scores = self._prior_points(space)
+    self.n_prior_ = len(points)
+    evaluated = []
+
+    def record(params, point, result):
+      evaluated.append((params, result))
+      points.append(point)
+      scores.append(float(np.mean(result[0])))
+
+    n_workers = min(effective_n_jobs(self.n_jobs), self.n_iter)
+    if n_workers == 1:
+      for _ in range(self.n_iter):
+        point = propose(space, points, scores, rng, self.n_startup, self.gamma, self.n_samples)
+        params = space.to_params(point)
+        record(params, point, evaluate_candidate(self.estimator, params, X_array, y_array,
+                                                 folds, self.scoring))
+    else:
+      with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = {}
+        submitted = 0
+        while submitted < self.n_iter or pending:
+          while len(pending) < n_workers and submitted < self.n_iter:
+            point = propose(space, points, scores, rng, self.n_startup, self.gamma,
+                            self.n_samples)
+            params = space.to_params(point)
+            future = executor.submit(evaluate_candidate, self.estimator, params, X_array,
+                                     y_array, folds, self.scoring)
+            pending[future] = (params, point)
+            submitted += 1
+          done, _ = wait(pending, return_when=FIRST_COMPLETED)
+          for future in done:
+            params, point = pending.pop(future)
+            record(params, point, future.result())
+
+    self.cv_results_ = self._results(space, evaluated, len(folds))
+    self.n_splits_ = len(folds)
+    self.best_index_ = int(np.argmax(self.cv_results_['mean_test_score']))
+    self.best_params_ = self.cv_results_['params'][self.best_index_]
+    self.best_score_ = float(self.cv_results_['mean_test_score'][self.best_index_])
+
+    if self.refit:
+      self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+      self.best_estimator_.fit(X, y)
+    return self
+
+  def _results(self, space, evaluated, n_splits):
+    '''cv_results_ in the layout of RandomizedSearchCV, candidates in the
+    order they finished'''
+    test_scores = np.array([result[0] for _, result in evaluated])
+    fit_times = np.array([result[1] for _, result in evaluated])
+    score_times = np.array([result[2] for _, result in evaluated])
+    results = {'params': [params for params, _ in evaluated]}
+    for name in space.names:
+      results['param_' + name] = np.ma.masked_array([params[name] for params, _ in evaluated],
+                                                    dtype=object)
+    for split in range(n_splits):
+      results['split%s_test_score' %split] = test_scores[:, split]
+    results['mean_test_score'] = test_scores.mean(axis=1)
+    results['std_test_score'] = test_scores.std(axis=1)
+    results['rank_test_score'] = rankdata(-results['mean_test_score'], method='min').astype(np.int32)
+    results['mean_fit_time'] = fit_times.mean(axis=1)
+    results['std_fit_time'] = fit_times.std(axis=1)
+    results['mean_score_time'] = score_times.mean(axis=1)
+    results['std_score_time'] = score_times.std(axis=1)
+    return results
+
+###############################################################################
+#
+#  backend used by run_search
+#
+###############################################################################
+
+_active = None
+
+def open_tpe(n_iter, seed=False):
+  '''Replace the randomised searches of this run with TPE searches of n_iter
+  candidates, seeded with stored candidates if seed is True; n_iter 0 keeps
+  the randomised searches'''
+  global _active
+  _active = {'n_iter': n_iter, 'seed': seed} if n_iter else None
+  return _active
+
+def model_based(search, X, y):
+  '''The TPE search replacing a randomised search while open_tpe is on, else
+  the search itself'''
+  if _active is None or not hasattr(search, 'param_distributions') \
+     or not isinstance(search.param_distributions, dict) or hasattr(search, 'patience'):
+    return search
+  prior = None
+  if _active['seed']:
+    prior = stored_candidates(type(search.estimator).__name__, data_fingerprint(X, y))
+    print('*    Seeding TPE search with %s stored candidates'
+          %(0 if prior is None else len(prior)))
+  return TPESearchCV(search.estimator, search.param_distributions, n_iter=_active['n_iter'],
+                     cv=search.cv, scoring=search.scoring, prior=prior, refit=search.refit,
+                     random_state=search.random_state, n_jobs=search.n_jobs)
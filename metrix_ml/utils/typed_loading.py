@@ -0,0 +1,171 @@
+###############################################################################
+#
+#  imports and set up environment
+#
+###############################################################################
+'''Typed loading of the EP and MR tables; measurements are read as float32,
+space group numbers, molecules per ASU and tncs as small integers and the
+targets as booleans, text columns become categoricals. A typed table takes
+about half the memory of the float64/int64/object table pandas reads by
+default, and so does every column selection, transformation and split the
+trainers make from it. Integer columns with missing values stay float32 so
+the trainers' fillna(0) still applies'''
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+import pandas as pd
+
+from metrix_ml.utils.profiling import read_hwm, reset_hwm
+
+EP_MEASUREMENTS = ['IoverSigma', 'cchalf', 'RmergediffI', 'RmergeI', 'RmeasI',
+                   'RmeasdiffI', 'RpimdiffI', 'RpimI', 'totalobservations',
+                   'totalunique', 'multiplicity', 'completeness', 'lowreslimit',
+                   'highreslimit', 'wilsonbfactor', 'anomalousslope',
+                   'anomalousCC', 'anomalousmulti', 'anomalouscompl', 'diffI',
+                   'diffF', 'f', 'wavelength', 'cell_a', 'cell_b', 'cell_c',
+                   'cell_alpha', 'cell_beta', 'cell_gamma', 'Vcell', 'solvent_content',
+                   'Matth_coeff', 'No_atom_chain', 'MW_chain', 'sites_ASU']
+
+MR_MEASUREMENTS = ['IoverSigma', 'completeness', 'RmergeI', 'lowreslimit', 'RpimI',
+                   'multiplicity', 'RmeasdiffI', 'wilsonbfactor', 'RmeasI',
+                   'highreslimit', 'RpimdiffI', 'RmergediffI', 'totalobservations',
+                   'cchalf', 'totalunique', 'mr_reso', 'eLLG', 'seq_ident', 'model_res',
+                   'No_atom_chain', 'MW_chain', 'No_res_chain', 'No_res_asu',
+                   'xia2_cell_volume', 'Vs', 'Vm', 'MW_asu', 'No_atom_asu', 'LLG',
+                   'TFZ', 'RMSD', 'VRMS', 'PAK']
+
+SCHEMAS = {'EP': dict([(column, 'float32') for column in EP_MEASUREMENTS]
+                      + [('sg_number', 'int16'), ('No_mol_ASU', 'int8'),
+                         ('EP_success', 'bool')]),
+           'MR': dict([(column, 'float32') for column in MR_MEASUREMENTS]
+                      + [('likely_sg_no', 'int16'), ('mr_sg_no', 'int16'),
+                         ('No_mol_asu', 'int8'), ('tncs', 'int8'),
+                         ('MR_success', 'bool')])}
+
+###############################################################################
+#
+#  loading
+#
+###############################################################################
+
+def table_schema(columns):
+  '''Name and schema of a table from its columns; None for other tables'''
+  for name, target in (('MR', 'MR_success'), ('EP', 'EP_success')):
+    if target in columns:
+      return name, SCHEMAS[name]
+  return None, {}
+
+def apply_schema(frame, schema, downcast=True):
+  '''Convert the columns of a frame to the schema in place; with downcast
+  other float and integer columns become float32 and the smallest integer
+  type, text columns become categoricals'''
+  for column in frame.columns:
+    dtype = schema.get(column)
+    values = frame[column]
+    if dtype in ('bool', 'int8', 'int16'):
+      #integers and targets with missing values stay float32
+      if values.isnull().any() or not np.all(np.mod(values, 1) == 0):
+        frame[column] = values.astype('float32')
+      elif dtype == 'bool':
+        if not values.isin([0, 1]).all():
+          raise ValueError('target %s has values other than 0 and 1' %column)
+        frame[column] = values.astype(bool)
+      else:
+        frame[column] = values.astype(dtype)
+    elif dtype is not None:
+      frame[column] = values.astype(dtype)
+    elif downcast and values.dtype == np.float64:
+      frame[column] = values.astype('float32')
+    elif downcast and values.dtype == np.int64:
+      frame[column] = pd.to_numeric(values, downcast='integer')
+    elif downcast and (values.dtype == object or pd.api.types.is_string_dtype(values.dtype)):
+      frame[column] = values.astype('category')
+  return frame
+
+def load_metrix_table(csv_path, downcast=True):
+  '''Read an EP or MR table with the declared schema.
+  ******
+  Input: CSV file, downcast columns not in the schema too
+  Output: dataframe
+  '''
+  name, schema = table_schema(pd.read_csv(csv_path, nrows=0).columns)
+  #float columns are parsed straight into float32; the integer and target
+  #columns are converted after reading as they may have missing values
+  dtype = {column: kind for column, kind in schema.items() if kind == 'float32'}
+  return apply_schema(pd.read_csv(csv_path, dtype=dtype), schema, downcast)
+
+###############################################################################
+#
+#  memory report
+#
+###############################################################################
+
+def _current_rss():
+  '''Resident set size in MB, 0 where /proc is missing'''
+  try:
+    with open('/proc/self/status') as status:
+      for line in status:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) / 1024.
+  except OSError:
+    pass
+  return 0.
+
+def _measure(csv_path, typed):
+  '''Load a table in a fresh process and return resident memory before the
+  load, peak resident memory of the load, size of the frame and seconds'''
+  reset_hwm()
+  base = _current_rss()
+  start = time.time()
+  frame = load_metrix_table(csv_path) if typed else pd.read_csv(csv_path)
+  seconds = time.time() - start
+  return base, read_hwm(), frame.memory_usage(deep=True).sum() / 1024. ** 2, seconds
+
+def memory_report(csv_path):
+  '''Peak resident memory and frame size of the default and the typed load,
+  each measured in a process of its own'''
+  context = multiprocessing.get_context('spawn')
+  rows = []
+  for label, typed in (('default', False), ('typed', True)):
+    with context.Pool(1) as pool:
+      base, peak, size, seconds = pool.apply(_measure, (csv_path, typed))
+    rows.append({'load': label, 'frame_mb': size, 'peak_rss_mb': peak,
+                 'load_rss_mb': peak - base, 'seconds': seconds})
+  report = pd.DataFrame(rows).set_index('load')
+  report.loc['reduction'] = 1 - report.loc['typed'] / report.loc['default']
+  return report
+
+###############################################################################
+#
+#  command line interface
+#
+###############################################################################
+
+def parse_command_line():
+  '''defining the command line input to make it runable'''
+  parser = argparse.ArgumentParser(description='Compare memory of default and typed loading')
+
+  parser.add_argument(
+    '--input',
+    type=str,
+    dest='input',
+    default='',
+    help='The EP or MR database as CSV file')
+
+  args = parser.parse_args()
+  if args.input == '':
+    parser.print_help()
+    exit(0)
+  return args
+
+def run():
+  args = parse_command_line()
+  name, schema = table_schema(pd.read_csv(args.input, nrows=0).columns)
+  print('*' *80)
+  print('*    Memory of loading %s (%s schema)' %(args.input, name or 'no'))
+  print('*' *80)
+  print(memory_report(args.input).to_string(float_format='%.2f'))
+  frame = load_metrix_table(args.input)
+  print(frame.dtypes.value_counts().to_string())
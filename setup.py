@@ -73,7 +73,14 @@ setup(
       'bin/voting/voting',
       'bin/voting/voting_retrain',
       'bin/k_means_clustering/k_means_clustering',
-      'bin/dbscan_clustering/dbscan_clustering'
+      'bin/dbscan_clustering/dbscan_clustering',
+      'bin/evaluation/nested_cv',
+      'bin/evaluation/feature_sets',
+      'bin/utils/model_registry',
+      'bin/utils/search_results',
+      'bin/utils/typed_loading',
+      'bin/utils/ensemble_pruning',
+      'bin/predict/watch'
     ],
     install_requires=[
       'matplotlib==3.1.0',
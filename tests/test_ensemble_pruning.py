@@ -0,0 +1,23 @@
+import numpy as np
+from sklearn.datasets import make_classification
+from sklearn.ensemble import BaggingClassifier
+from sklearn.tree import DecisionTreeClassifier
+
+from metrix_ml.utils.ensemble_pruning import prune_model
+
+def test_prune_warm_started_bagging():
+  X, y = make_classification(200, 5, random_state=0)
+  model = BaggingClassifier(DecisionTreeClassifier(), n_estimators=10, random_state=0)
+  model.fit(X, y)
+  model.set_params(warm_start=True, n_estimators=15)
+  model.fit(X, y)
+  assert len(model._seeds) != len(model.estimators_)
+
+  pruned = prune_model(model, [0, 3, 12])
+
+  assert len(pruned.estimators_) == 3
+  assert len(pruned.estimators_features_) == 3
+  assert not hasattr(pruned, '_seeds')
+  assert len(model._seeds) == 5
+  assert pruned.predict_proba(X).shape == (200, 2)
+  assert np.all(pruned.estimators_features_[2] == model.estimators_features_[12])
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from sklearn.datasets import make_classification
+from sklearn.ensemble import BaggingClassifier
+from sklearn.tree import DecisionTreeClassifier
+
+from metrix_ml.utils.incremental import (incremental_update, row_fingerprints,
+                                         start_lineage, update_scores)
+
+def test_bagging_seeds_follow_trees_after_retiring():
+  X, y = make_classification(200, 5, random_state=0)
+  X, y = pd.DataFrame(X), pd.Series(y)
+  model = BaggingClassifier(DecisionTreeClassifier(), n_estimators=40, random_state=0)
+  model.fit(X[:150], y[:150])
+  start_lineage(model, X[:150], y[:150], X[150:], y[150:])
+  seeds = list(model._seeds)
+
+  incremental_update(model, X[:180], y[:180], X[180:], y[180:], new_trees=10, retire=5)
+
+  assert len(model.estimators_) == 45
+  assert len(model._seeds) == len(model.estimators_)
+  assert list(model._seeds[:35]) == seeds[5:]
+  assert len(model.estimators_samples_) == len(model.estimators_)
+
+
+def test_max_trees_caps_growth_and_scores_new_rows():
+  X, y = make_classification(200, 5, random_state=0)
+  X, y = pd.DataFrame(X), pd.Series(y)
+  model = BaggingClassifier(DecisionTreeClassifier(), n_estimators=20, random_state=0)
+  model.fit(X[:100], y[:100])
+  start_lineage(model, X[:100], y[:100], X[150:170], y[150:170])
+  previous_test = model.row_fingerprints_['test']
+
+  for generation in range(3):
+    incremental_update(model, X[:120 + 10 * generation], y[:120 + 10 * generation],
+                       X[150:], y[150:], new_trees=10, max_trees=20)
+    assert len(model.estimators_) == 20
+    assert len(model._seeds) == 20
+
+  scores = update_scores(model, X[150:], y[150:], previous_test)
+  assert list(scores.index) == ['test', 'new test rows']
+  assert scores.loc['test', 'n'] == 50
+  assert scores.loc['new test rows', 'n'] == 30
+  assert np.all(np.isin(row_fingerprints(X[150:170], y[150:170]), previous_test))